@@ -4,18 +4,80 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
-from email.header import Header
+from email.header import Header, make_header, decode_header
 import warnings
 import concurrent.futures
 import threading
+import queue
+import traceback
+import multiprocessing
+import json
+import glob
+import zlib
+import sqlite3
+import re
+import itertools
+import cProfile
+import pstats
+import tracemalloc
+import io
+import html
+from string import Template
+from contextlib import contextmanager
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import bisect
+import atexit
+
+try:
+    import fcntl  # 多进程写存档时加文件锁（Windows下不可用，仅使用线程锁）
+except ImportError:
+    fcntl = None
+try:
+    import tomllib  # 读取TOML格式的监控清单（Python 3.11+）
+except ImportError:
+    try:
+        import tomli as tomllib  # Python 3.10及以下使用接口相同的tomli
+    except ImportError:
+        tomllib = None
+try:
+    import yaml  # 读取YAML格式的监控清单（需安装PyYAML）
+except ImportError:
+    yaml = None
+try:
+    from PIL import Image, features  # 图表压缩、缩放和WebP输出（matplotlib自带依赖）
+    WEBP_SUPPORTED = features.check('webp')
+except ImportError:
+    Image = None
+    WEBP_SUPPORTED = False
+import argparse
 
 # ===================== 【核心自定义参数】=====================
 # 股票配置列表
+# 可选参数 'timeframe': 'weekly' / 'monthly' 表示用周线/月线判断（由日线聚合，默认日线）
+# 可选参数 'consecutive_bars': N 表示连续N根站上均线才预警（three_above_ma，默认3）
+# 可选参数 'within_bars': K 表示最近K根内出现过金叉即预警（golden_cross，默认1即仅当根）
+# 预警类型 'macd_cross' 为MACD金叉预警，可选参数 'fast'/'slow'/'signal'（默认12/26/9）
+# 预警类型 'percentile_low' 为低分位预警：'window'（默认750根）、'threshold'（默认0.10）、'method'（'rank'按收盘价分布/'range'按最高最低区间）
+# 预警类型 'dividend_yield' 为股息率红绿灯预警：'green_yield'/'red_yield'（默认0.05/0.03）、'green_percentile'/'red_percentile'（默认0.8/0.2）、
+#   'window'（股息率分位窗口，默认750根）、'alert_lights'（切换到哪些颜色时提醒，默认['绿灯']），使用未复权价格
+# 预警类型 'relative_strength' 为跑赢基准预警：'benchmark'（默认'沪深300'）、'period'（默认20根）、'threshold'（超额收益，默认0）
+# 可选参数 'benchmark': '沪深300' / '中证红利' / 指数代码，用于均线、MACD、分位、回撤类预警时改为判断个股相对基准的强弱
+# 预警类型 'basket_breadth' 为篮子宽度预警：成分来自 'members'（[{'name','code'}]）、'board'（行业板块名）或 'index'（指数代码），
+#   'metric'（'pct_above_ma'站上均线比例/'new_crosses'当日上穿数）、'ma_line'（默认20）、'threshold'、'direction'（'above'/'below'）、
+#   'trigger'（'first'条件首次成立的那根K线触发，默认；'level'条件成立期间每根K线都触发）；
+#   'code' 填写篮子的唯一标识即可
+# 预警类型 'drawdown' 为回撤预警：'window'（默认250根）、'threshold'（默认0.20即回撤20%）
+# 预警类型 'expression' 为表达式预警：'expr' 为条件表达式，'title' 为预警名称（可选），例如
+#   'ma(close,10) crosses_above ma(close,20) and close > ma(close,60) for 3 bars'
+#   字段：open/high/low/close/volume/amount；函数：ma/ema/std/highest/lowest/percentile/drawdown/rsi/ref/roc/dif/dea/macd/abs；
+#   运算：+ - * /、> < >= <= == !=、crosses_above/crosses_below、and/or/not、for N bars（连续N根）、within N bars（N根内成立过）
 STOCK_CONFIGS = [
     {
         'name': '长城汽车',
@@ -129,6 +191,18 @@ matplotlib.rcParams['axes.unicode_minus'] = False
 # 定义保存HTML输出的文件夹
 ALERT_OUTPUT_DIR = os.environ.get('ALERT_OUTPUT_DIR', os.path.join(os.getcwd(), 'alert_output'))
 
+# 定义本地数据缓存文件夹（盘前触发价等中间结果）
+DATA_CACHE_DIR = os.environ.get('DATA_CACHE_DIR', os.path.join(os.getcwd(), 'data_cache'))
+
+# 本地K线存档（内存映射列式存储），设置BAR_ARCHIVE=0可关闭
+BAR_ARCHIVE_ENABLED = os.environ.get('BAR_ARCHIVE', '1') == '1'
+BAR_ARCHIVE_DIR = os.path.join(DATA_CACHE_DIR, 'raw_bars')  # 存档只保存未复权价格
+MARKET_CLOSE_TIME = '15:30'  # 此时间之前当天的K线视为未完成，不写入存档
+
+# 复权方式：qfq 前复权（默认）、hfq 后复权、none 不复权。复权因子表单独缓存，每天最多刷新一次
+PRICE_ADJUST = os.environ.get('PRICE_ADJUST', 'qfq')
+ADJUST_FACTOR_DIR = os.path.join(DATA_CACHE_DIR, 'adjust_factors')
+
 # 定义当天日期的文件夹
 TODAY_DATE = datetime.now().strftime('%Y%m%d')
 TODAY_DIR = os.path.join(ALERT_OUTPUT_DIR, TODAY_DATE)
@@ -143,637 +217,3009 @@ if not os.path.exists(PICTURE_DIR):
 else:
     print(f"📁 图片保存目录已存在：{PICTURE_DIR}")
 
+# ===================== 运行时限 =====================
+# 完整检查和分片执行有整体截止时间（GitHub Actions 在 timeout-minutes 到达时直接结束进程，什么都不会留下）。
+# 剩余时间越少，数据获取的重试次数和等待越短；按优先级降级：先放弃非预警图表，
+# 最后阶段不再获取新数据、不再绘图，只保证已得到的预警发出通知并写出报告和运行日志。
+RUN_DEADLINE_MINUTES = float(os.environ.get('RUN_DEADLINE_MINUTES', '22'))       # 0表示不限时
+DEADLINE_TIGHT_SECONDS = int(os.environ.get('DEADLINE_TIGHT_SECONDS', '300'))    # 剩余少于此时间进入收紧阶段
+DEADLINE_FINAL_SECONDS = int(os.environ.get('DEADLINE_FINAL_SECONDS', '120'))    # 剩余少于此时间进入收尾阶段
+# 各阶段的(重试次数, 等待时间倍数)
+DEADLINE_RETRY_POLICY = {'normal': (3, 1.0), 'tight': (2, 0.3), 'final': (1, 0.0)}
+# 各阶段仍然执行的工作：预警通知和报告始终执行
+DEADLINE_ALLOWED = {
+    'normal': {'fetch', 'alert_chart', 'chart', 'notify', 'report'},
+    'tight': {'fetch', 'alert_chart', 'notify', 'report'},
+    'final': {'notify', 'report'},
+}
+
+class RunDeadline:
+    """整次运行的截止时间，从进程启动开始计时；未启用时始终处于正常阶段"""
+
+    def __init__(self, minutes: float = 0):
+        self.started = time.monotonic()
+        self.deadline = None
+        self.current = 'normal'
+        self.skipped = {}  # 因时间不足跳过的工作 -> 次数
+        self._lock = threading.Lock()
+        self.set_budget(minutes)
+
+    def set_budget(self, minutes: float):
+        """设置总时长（分钟，从启动时算起），0表示不限时"""
+        self.deadline = self.started + minutes * 60 if minutes and minutes > 0 else None
+
+    def remaining(self) -> float:
+        return float('inf') if self.deadline is None else self.deadline - time.monotonic()
+
+    def phase(self) -> str:
+        """当前阶段：normal / tight / final，阶段变化时打印提示"""
+        remaining = self.remaining()
+        phase = 'final' if remaining < DEADLINE_FINAL_SECONDS else 'tight' if remaining < DEADLINE_TIGHT_SECONDS else 'normal'
+        if phase != self.current:
+            with self._lock:
+                if phase != self.current:
+                    self.current = phase
+                    if phase == 'normal':
+                        return phase
+                    action = '只发送预警通知和生成报告' if phase == 'final' else '跳过非预警图表，缩短重试'
+                    print(f"\n⏰ 剩余时间{max(0, remaining) / 60:.1f}分钟，进入{'收尾' if phase == 'final' else '收紧'}阶段：{action}")
+        return phase
+
+    def allows(self, work: str) -> bool:
+        """当前阶段是否还执行该工作（fetch/alert_chart/chart/notify/report），不执行时计入跳过统计"""
+        if work in DEADLINE_ALLOWED[self.phase()]:
+            return True
+        with self._lock:
+            self.skipped[work] = self.skipped.get(work, 0) + 1
+        return False
+
+    def retry_policy(self) -> tuple:
+        """数据获取的(重试次数, 等待时间倍数)"""
+        return DEADLINE_RETRY_POLICY[self.phase()]
+
+    def timeout(self):
+        """等待单项工作的最长时间（留出收尾时间），不限时为None"""
+        return None if self.deadline is None else max(1.0, self.remaining() - DEADLINE_FINAL_SECONDS)
+
+    def summary(self) -> str:
+        labels = {'fetch': '数据获取', 'alert_chart': '预警图表', 'chart': '非预警图表'}
+        return '，'.join(f"{labels.get(work, work)}{count}项" for work, count in self.skipped.items())
+
+RUN_DEADLINE = RunDeadline()
+
 # ===================== 数据获取函数 =====================
+def market_prefix(stock_code: str) -> str:
+    """根据代码判断所属交易所：sh 上交所、sz 深交所、bj 北交所"""
+    if stock_code.startswith(('92', '4', '8')):
+        return 'bj'
+    if stock_code.startswith(('5', '6', '9')):
+        return 'sh'
+    return 'sz'
+
+def _prefixed_symbol(stock_code: str) -> str:
+    """加上市场前缀的股票代码（sh/sz/bj）"""
+    return f'{market_prefix(stock_code)}{stock_code}' if len(stock_code) == 6 else stock_code
+
 def safe_get_data(func, *args, **kwargs):
-    """安全获取数据，带重试机制"""
-    max_retries = 3
+    """安全获取数据，带重试机制（临近运行截止时间时减少重试次数和等待）"""
+    max_retries, wait_scale = RUN_DEADLINE.retry_policy()
     for attempt in range(max_retries):
         try:
             result = func(*args, **kwargs)
             if result is not None and not result.empty:
                 return result
-            time.sleep(2)
+            if attempt < max_retries - 1:
+                time.sleep(2 * wait_scale)
         except Exception as e:
             print(f"  第{attempt+1}次尝试失败: {e}")
             if attempt < max_retries - 1:
-                time.sleep(3)
+                time.sleep(3 * wait_scale)
             else:
                 print(f"  所有尝试都失败了")
     return None
 
-def get_stock_data(stock_code: str, stock_name: str) -> pd.DataFrame:
-    """获取股票历史数据，使用多种数据源作为备用，带重试机制"""
-    print(f"📥 正在获取{stock_name}({stock_code})历史数据...")
-    
-    try:
-        # 定义akshare的多种数据源获取函数，优先使用腾讯数据源
-        ak_sources = [
-            ("腾讯", ak.stock_zh_a_hist_tx),  # 腾讯数据源，需要带市场前缀
-            ("东方财富", ak.stock_zh_a_hist),   # 东财数据源，支持纯数字代码
-        ]
-        
-        for source_name, source_func in ak_sources:
-            try:
-                print(f"  尝试数据源: {source_name}")
-                
-                # 根据数据源调整参数
-                call_params = {
-                    'start_date': DATA_START_DATE,
-                    'end_date': DATA_END_DATE,
-                    'adjust': 'qfq'  # 前复权
-                }
-                
-                # 调整股票代码格式和参数
-                symbol = stock_code
-                if source_name == "腾讯":
-                    # 腾讯数据源需要市场前缀，并且不接受period参数
-                    if len(stock_code) == 6:
-                        if stock_code.startswith('6'):
-                            symbol = f'sh{stock_code}'
-                        else:
-                            symbol = f'sz{stock_code}'
-                else:
-                    # 默认数据源(东财)支持纯数字代码，需要period参数
-                    call_params['period'] = 'daily'
-                
-                call_params['symbol'] = symbol
-                
-                # 使用带重试机制的安全数据获取
-                df = safe_get_data(source_func, **call_params)
-                
-                if df is not None and not df.empty:
-                    print(f"  ✅ {source_name}数据源获取{stock_name}({stock_code})数据成功，共{len(df)}条")
-                    
-                    # 重命名列（处理不同数据源的列名差异）
-                    column_mapping = {
-                        # 中文列名（东方财富）
-                        "日期": "date",
-                        "开盘": "open",
-                        "最高": "high",
-                        "最低": "low",
-                        "收盘": "close",
-                        "成交量": "volume",
-                        "成交额": "amount",
-                        # 英文列名（腾讯或其他数据源）
-                        "date": "date",
-                        "open": "open",
-                        "high": "high",
-                        "low": "low",
-                        "close": "close",
-                        "volume": "volume",
-                        "amount": "amount",
-                        "vol": "volume",  # 腾讯数据源可能使用vol表示成交量
-                        "turnover": "amount"  # 腾讯数据源可能使用turnover表示成交额
-                    }
-                    
-                    # 只重命名存在的列
-                    rename_dict = {}
-                    for old_col, new_col in column_mapping.items():
-                        if old_col in df.columns:
-                            rename_dict[old_col] = new_col
-                    
-                    if rename_dict:
-                        df.rename(columns=rename_dict, inplace=True)
-                    
-                    # 打印当前数据框的列名，方便调试
-                    print(f"  📋 {source_name}数据源返回的列名: {list(df.columns)}")
-                    
-                    # 确保必要的列存在
-                    required_columns = ["date", "open", "high", "low", "close"]
-                    # 成交量和成交额是可选的，如果缺少则设置为0
-                    optional_columns = ["volume", "amount"]
-                    
-                    if all(col in df.columns for col in required_columns):
-                        # 如果缺少成交量或成交额，设置为0
-                        for col in optional_columns:
-                            if col not in df.columns:
-                                df[col] = 0
-                                print(f"  ⚠️  缺少{col}列，已设置为0")
-                        
-                        # 数据清洗
-                        df["date"] = pd.to_datetime(df["date"])
-                        df = df.drop_duplicates(subset=["date"]).sort_values("date").reset_index(drop=True)
-                        
-                        print(f"  ✅ {source_name}数据源数据格式检查通过，共{len(df)}条数据")
-                        return df
-                    else:
-                        missing_cols = [col for col in required_columns if col not in df.columns]
-                        print(f"  ❌ {source_name}数据源数据格式不符合要求，缺少必要列: {missing_cols}")
-                        continue
-            except Exception as e:
-                print(f"  ❌ {source_name}数据源获取失败：{e}")
-                continue
-        
-        # 尝试不同复权方式作为备用
-        print("  尝试备用方案：不同复权方式")
-        adjust_methods = [
-            ("不复权", ""),
-            ("后复权", "hfq")
-        ]
-        
-        for adjust_name, adjust_method in adjust_methods:
+# ===================== 数据源适配器 =====================
+# 每个数据源一个适配器，声明代码格式、列名映射、日期格式和支持的市场，
+# 统一输出标准K线格式：date(datetime64[ns]) + open/high/low/close/volume/amount(float64)。
+# 新增数据源只需继承BarSourceAdapter并在BAR_SOURCE_ADAPTERS中登记。
+BAR_COLUMNS = ['date', 'open', 'high', 'low', 'close', 'volume', 'amount']
+REQUIRED_BAR_COLUMNS = ['date', 'open', 'high', 'low', 'close']
+BAR_SOURCE_ORDER = os.environ.get('BAR_SOURCES', 'local,tx,em,sina')  # 数据源尝试顺序
+LOCAL_BAR_DIR = os.environ.get('LOCAL_BAR_DIR', os.path.join(DATA_CACHE_DIR, 'local_bars'))
+
+class BarSourceAdapter:
+    """数据源适配器基类"""
+
+    name = ''
+    symbol_format = 'plain'          # plain: 600900；prefixed: sh600900
+    column_map = {}                  # 数据源列名 -> 标准列名
+    date_format = None               # 日期字符串格式，None表示由pandas自动识别
+    markets = ('sh', 'sz', 'bj')     # 支持的交易所
+    capabilities = frozenset()       # raw: 提供未复权价格；date_range: 支持按日期区间获取
+
+    def supports(self, stock_code: str) -> bool:
+        """是否支持该股票代码"""
+        return market_prefix(stock_code) in self.markets
+
+    def format_symbol(self, stock_code: str) -> str:
+        """转换为数据源要求的代码格式"""
+        return _prefixed_symbol(stock_code) if self.symbol_format == 'prefixed' else stock_code
+
+    def call(self, symbol: str, start_date: str, end_date: str) -> pd.DataFrame:
+        """调用数据源接口，返回原始数据"""
+        raise NotImplementedError
+
+    def fetch(self, stock_code: str, start_date: str, end_date: str) -> pd.DataFrame:
+        """获取并标准化K线数据"""
+        df = safe_get_data(self.call, self.format_symbol(stock_code), start_date, end_date)
+        if df is None:
+            return pd.DataFrame()
+        df = self.normalize(df)
+        if 'date_range' not in self.capabilities and not df.empty:
+            df = df[(df['date'] >= pd.Timestamp(start_date)) & (df['date'] <= pd.Timestamp(end_date))].reset_index(drop=True)
+        return df
+
+    def normalize(self, df: pd.DataFrame) -> pd.DataFrame:
+        """一次遍历把原始数据转换为标准K线格式"""
+        sources = {}
+        for source_col, target_col in self.column_map.items():
+            if source_col in df.columns and target_col not in sources:
+                sources[target_col] = source_col
+        missing = [col for col in REQUIRED_BAR_COLUMNS if col not in sources]
+        if missing:
+            raise ValueError(f"{self.name}数据源缺少必要列: {missing}，返回的列名: {list(df.columns)}")
+
+        dates = pd.to_datetime(df[sources['date']], format=self.date_format).to_numpy(dtype='datetime64[ns]')
+        empty = np.zeros(len(df))
+        bars = pd.DataFrame({'date': dates})
+        for col in BAR_COLUMNS[1:]:
+            bars[col] = pd.to_numeric(df[sources[col]], errors='coerce').to_numpy(dtype=float) if col in sources else empty
+
+        # 数据源通常已按日期升序且无重复，只在必要时才排序和去重
+        if not bars['date'].is_monotonic_increasing:
+            bars = bars.sort_values('date', kind='stable')
+        if not bars['date'].is_unique:
+            bars = bars.drop_duplicates(subset=['date'], keep='last')
+        return bars.reset_index(drop=True)
+
+class TencentAdapter(BarSourceAdapter):
+    """腾讯数据源"""
+
+    name = '腾讯'
+    symbol_format = 'prefixed'
+    column_map = {'date': 'date', 'open': 'open', 'high': 'high', 'low': 'low', 'close': 'close',
+                  'volume': 'volume', 'vol': 'volume', 'amount': 'amount'}
+    date_format = '%Y-%m-%d'
+    markets = ('sh', 'sz')
+    capabilities = frozenset({'raw', 'date_range'})
+
+    def call(self, symbol, start_date, end_date):
+        return ak.stock_zh_a_hist_tx(symbol=symbol, start_date=start_date, end_date=end_date, adjust='')
+
+class EastMoneyAdapter(BarSourceAdapter):
+    """东方财富数据源"""
+
+    name = '东方财富'
+    column_map = {'日期': 'date', '开盘': 'open', '最高': 'high', '最低': 'low', '收盘': 'close',
+                  '成交量': 'volume', '成交额': 'amount'}
+    date_format = '%Y-%m-%d'
+    capabilities = frozenset({'raw', 'date_range'})
+
+    def call(self, symbol, start_date, end_date):
+        return ak.stock_zh_a_hist(symbol=symbol, period='daily', start_date=start_date, end_date=end_date, adjust='')
+
+class SinaAdapter(BarSourceAdapter):
+    """新浪数据源（同时提供复权因子）"""
+
+    name = '新浪'
+    symbol_format = 'prefixed'
+    column_map = {'date': 'date', 'open': 'open', 'high': 'high', 'low': 'low', 'close': 'close',
+                  'volume': 'volume', 'amount': 'amount'}  # turnover是换手率，不映射
+    date_format = '%Y-%m-%d'
+    capabilities = frozenset({'raw', 'date_range', 'adjust_factors'})
+
+    def call(self, symbol, start_date, end_date):
+        return ak.stock_zh_a_daily(symbol=symbol, start_date=start_date, end_date=end_date, adjust='')
+
+class LocalCSVAdapter(BarSourceAdapter):
+    """本地CSV数据源：LOCAL_BAR_DIR/<代码>.csv，列为date,open,high,low,close[,volume,amount]，价格未复权"""
+
+    name = '本地CSV'
+    column_map = {col: col for col in BAR_COLUMNS}
+    date_format = '%Y-%m-%d'
+    capabilities = frozenset({'raw'})
+
+    def __init__(self, path: str = LOCAL_BAR_DIR):
+        self.path = path
+
+    def supports(self, stock_code):
+        return os.path.exists(os.path.join(self.path, f'{stock_code}.csv'))
+
+    def call(self, symbol, start_date, end_date):
+        return pd.read_csv(os.path.join(self.path, f'{symbol}.csv'))
+
+BAR_SOURCE_ADAPTERS = {
+    'local': LocalCSVAdapter,
+    'tx': TencentAdapter,
+    'em': EastMoneyAdapter,
+    'sina': SinaAdapter,
+}
+
+def get_bar_sources() -> list:
+    """按BAR_SOURCES配置的顺序返回数据源适配器"""
+    return [BAR_SOURCE_ADAPTERS[key.strip()]() for key in BAR_SOURCE_ORDER.split(',') if key.strip() in BAR_SOURCE_ADAPTERS]
+
+def fetch_stock_data(stock_code: str, stock_name: str, start_date: str = None) -> pd.DataFrame:
+    """从网络获取股票未复权历史数据，按顺序尝试各数据源，带重试机制
+
+    所有数据源统一获取未复权价格，复权在本地用复权因子计算，避免不同复权方式的数据混用。
+    """
+    start_date = start_date or DATA_START_DATE
+    print(f"📥 正在获取{stock_name}({stock_code})历史数据（{start_date}起）...")
+
+    for adapter in get_bar_sources():
+        if not adapter.supports(stock_code):
+            continue
+        try:
+            print(f"  尝试数据源: {adapter.name}")
+            df = adapter.fetch(stock_code, start_date, DATA_END_DATE)
+            if not df.empty:
+                print(f"  ✅ {adapter.name}数据源获取{stock_name}({stock_code})数据成功，共{len(df)}条")
+                return df
+        except Exception as e:
+            print(f"  ❌ {adapter.name}数据源获取失败：{e}")
+
+    # 所有数据源都失败
+    print(f"❌ 所有数据源都失败，未获取到{stock_name}({stock_code})的数据")
+    return pd.DataFrame()
+
+# ===================== 本地K线存档 =====================
+# 每个字段一个连续的列文件（date/open/high/low/close/volume/amount），index.json记录每只股票
+# 在列文件中的[起始行, 行数, 容量]以及全部交易日历。读取通过numpy.memmap零拷贝切片完成，
+# 冷启动只产生缺页而不需要解析，多个进程可共享同一份页缓存。每只股票的区段预留了空余容量，
+# 新交易日的数据直接原地追加；容量用完时区段整体搬到文件末尾。
+class BarArchive:
+    """内存映射的列式K线存档"""
+
+    FIELDS = {
+        'date': np.int64,      # 自1970-01-01起的天数
+        'open': np.float64,
+        'high': np.float64,
+        'low': np.float64,
+        'close': np.float64,
+        'volume': np.int64,
+        'amount': np.float64,
+    }
+    # 旧版存档（索引中没有dtypes）的价格列为float32，打开时转换为float64
+    LEGACY_FIELDS = {**FIELDS, 'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32}
+    PRICE_DECIMALS = 3  # 转换时价格按0.001元取整，去掉float32的表示误差
+    APPEND_SLACK = 260  # 每个区段预留约一年的追加空间
+    INDEX_SAVE_EVERY = 200    # 索引每写入多少只股票写出一次
+    INDEX_SAVE_SECONDS = 30   # 距上次写出超过多少秒时也写出
+
+    def __init__(self, path: str = BAR_ARCHIVE_DIR):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.symbols = {}   # code -> [offset, length, capacity]
+        self.size = 0       # 列文件已分配的行数
+        self.calendar = np.empty(0, dtype=np.int64)
+        self.coverage = {}  # code -> 已按此日期（自1970-01-01起的天数）起下载过完整历史
+        self._columns = {}
+        self._dtypes = dict(self.FIELDS)  # 列文件中实际的数据类型
+        self._index_mtime = None
+        self._pending = {}          # 尚未写出到索引文件的条目：code -> 区段
+        self._pending_coverage = {}
+        self._saved_at = time.time()
+        self._lock = threading.RLock()
+        self._reload()
+        if self._dtypes != self.FIELDS:
+            self._migrate()
+        # 索引按批写出，进程退出时写出剩余的改动
+        atexit.register(self.flush)
+
+    def _column_file(self, field: str) -> str:
+        return os.path.join(self.path, f'{field}.bin')
+
+    def _index_file(self) -> str:
+        return os.path.join(self.path, 'index.json')
+
+    def _reload(self):
+        """索引有变化（包括其他进程写入）时重新加载索引并重新映射列文件"""
+        index_file = self._index_file()
+        if not os.path.exists(index_file):
+            return
+        mtime = os.stat(index_file).st_mtime_ns
+        if mtime == self._index_mtime:
+            return
+        with open(index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        # 本进程尚未写出的条目覆盖磁盘上的同名条目（区段按列文件的实际长度分配，两边不会重叠）
+        self.symbols = {**index['symbols'], **self._pending}
+        self.size = max(index['size'], self.size) if self._pending else index['size']
+        calendar = np.asarray(index['calendar'], dtype=np.int64)
+        self.calendar = np.union1d(calendar, self.calendar) if self._pending else calendar
+        self.coverage = {**index.get('coverage', {}), **self._pending_coverage}
+        self._dtypes = {field: np.dtype(dtype).type for field, dtype in index['dtypes'].items()} if 'dtypes' in index else dict(self.LEGACY_FIELDS)
+        self._map_columns()
+        self._index_mtime = mtime
+
+    def _map_columns(self):
+        """按当前行数重新映射列文件"""
+        self._columns = {
+            field: np.memmap(self._column_file(field), dtype=dtype, mode='r', shape=(self.size,))
+            for field, dtype in self._dtypes.items()
+        } if self.size else {}
+
+    def _save_index(self):
+        """原子地写出索引（先合并其他进程已写出的条目）"""
+        self._reload()
+        index_file = self._index_file()
+        with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'size': self.size, 'symbols': self.symbols, 'calendar': self.calendar.tolist(), 'coverage': self.coverage,
+                       'dtypes': {field: np.dtype(dtype).name for field, dtype in self._dtypes.items()}}, f)
+        os.replace(index_file + '.tmp', index_file)
+        self._pending, self._pending_coverage = {}, {}
+        self._saved_at = time.time()
+        self._index_mtime = None
+        self._reload()
+
+    def _migrate(self):
+        """把旧版存档的列文件转换为当前的数据类型（每个列文件整体转换后原子替换）"""
+        with self._write_lock():
+            if self._dtypes == self.FIELDS:
+                return
+            print("🔧 正在把K线存档的价格列转换为float64...")
+            for field, dtype in self.FIELDS.items():
+                stored = self._dtypes.get(field, dtype)
+                column_file = self._column_file(field)
+                if stored == dtype or not os.path.exists(column_file):
+                    continue
+                values = np.fromfile(column_file, dtype=stored).astype(dtype)
+                if field in ('open', 'high', 'low', 'close'):
+                    values = np.round(values, self.PRICE_DECIMALS)
+                values.tofile(column_file + '.tmp')
+                os.replace(column_file + '.tmp', column_file)
+            self._dtypes = dict(self.FIELDS)
+            self._map_columns()
+            self._save_index()
+
+    def flush(self):
+        """写出尚未保存的索引改动"""
+        with self._lock:
+            if not self._pending:
+                return
+            with self._write_lock():
+                self._save_index()
+
+    @contextmanager
+    def _write_lock(self):
+        """写操作加锁：线程锁 + 跨进程文件锁"""
+        with self._lock:
+            lock_file = None
+            if fcntl is not None:
+                lock_file = open(os.path.join(self.path, '.lock'), 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
             try:
-                print(f"    尝试{adjust_name}")
-                df = safe_get_data(ak.stock_zh_a_hist,
-                                 symbol=stock_code,
-                                 period="daily",
-                                 start_date=DATA_START_DATE,
-                                 end_date=DATA_END_DATE,
-                                 adjust=adjust_method)
-                
-                if df is not None and not df.empty:
-                    # 重命名列
-                    df.rename(columns={
-                        "日期": "date",
-                        "开盘": "open",
-                        "最高": "high",
-                        "最低": "low",
-                        "收盘": "close",
-                        "成交量": "volume",
-                        "成交额": "amount"
-                    }, inplace=True)
-                    
-                    # 确保必要的列存在
-                    required_columns = ["date", "open", "high", "low", "close", "volume", "amount"]
-                    if all(col in df.columns for col in required_columns):
-                        # 数据清洗
-                        df["date"] = pd.to_datetime(df["date"])
-                        df = df.drop_duplicates(subset=["date"]).sort_values("date").reset_index(drop=True)
-                        
-                        print(f"  ✅ {adjust_name}数据获取成功，共{len(df)}条")
-                        return df
-            except Exception as e:
-                print(f"    ❌ {adjust_name}获取失败：{e}")
-                continue
-        
-        # 所有数据源都失败
-        print(f"❌ 所有数据源都失败，未获取到{stock_name}({stock_code})的数据")
-        return pd.DataFrame()
-        
-    except Exception as e:
-        print(f"❌ 获取{stock_name}({stock_code})数据时发生错误：{e}")
-        return pd.DataFrame()
+                self._reload()
+                yield
+            finally:
+                if lock_file is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
 
-# ===================== 均线计算和预警判断 =====================
-def calculate_ma_and_check_alert(df: pd.DataFrame, stock_config: dict) -> dict:
-    """计算均线并检查预警信号"""
-    if df.empty:
-        return {
-            'has_alert': False,
-            'alert_type': None,
-            'latest_data': None,
-            'df': pd.DataFrame()
-        }
-    
-    df = df.copy()
-    stock_name = stock_config['name']
-    alert_type = stock_config['alert_type']
-    
-    if alert_type == 'golden_cross':
-        # 金叉预警逻辑
-        ma_short = stock_config['ma_short']
-        ma_long = stock_config['ma_long']
-        
-        # 计算均线
-        df[f'ma{ma_short}'] = df['close'].rolling(window=ma_short).mean()
-        df[f'ma{ma_long}'] = df['close'].rolling(window=ma_long).mean()
-        
-        # 计算均线差值
-        df['ma_diff'] = df[f'ma{ma_short}'] - df[f'ma{ma_long}']
-        
-        # 检查上穿信号（金叉）
-        # 条件：昨天 ma_short < ma_long，今天 ma_short > ma_long
-        df['golden_cross'] = (df['ma_diff'].shift(1) <= 0) & (df['ma_diff'] > 0)
-        
-        # 获取最新数据
-        latest_row = df.iloc[-1]
-        
-        # 检查是否有预警信号
-        has_alert = latest_row['golden_cross']
-        alert_name = '金叉预警' if has_alert else None
-        
-        latest_data = {
-            'date': latest_row['date'].strftime('%Y-%m-%d'),
-            'close': latest_row['close'],
-            f'ma{ma_short}': latest_row[f'ma{ma_short}'],
-            f'ma{ma_long}': latest_row[f'ma{ma_long}'],
-            'ma_diff': latest_row['ma_diff']
-        }
-        
-    elif alert_type == 'three_above_ma':
-        # 连续三根k线站上20日均线预警逻辑
-        ma_line = stock_config['ma_line']
-        
-        # 计算均线
-        df[f'ma{ma_line}'] = df['close'].rolling(window=ma_line).mean()
-        
-        # 检查收盘价是否站在均线上方
-        df['above_ma'] = df['close'] > df[f'ma{ma_line}']
-        
-        # 检查连续三根k线站上均线
-        # 使用rolling窗口计算连续为True的天数
-        df['consecutive_above_ma'] = df['above_ma'].rolling(window=3).sum()
-        
-        # 连续三根都站在均线上方
-        df['three_above_ma'] = df['consecutive_above_ma'] == 3
-        
-        # 检查是否是第一次出现连续三根（前一天不是连续三根）
-        df['first_three_above_ma'] = False
-        if len(df) > 1:
-            df['first_three_above_ma'] = df['three_above_ma'] & (~df['three_above_ma'].shift(1).fillna(False))
-        
-        # 获取最新数据
-        latest_row = df.iloc[-1]
-        
-        # 检查是否有预警信号（只在第一次出现连续三根时触发）
-        has_alert = latest_row['first_three_above_ma']
-        alert_name = '连续三根k线站上20日均线预警' if has_alert else None
-        
-        latest_data = {
-            'date': latest_row['date'].strftime('%Y-%m-%d'),
-            'close': latest_row['close'],
-            f'ma{ma_line}': latest_row[f'ma{ma_line}'],
-            'consecutive_above_ma': int(latest_row['consecutive_above_ma'])
-        }
-    
-    elif alert_type == 'three_carriers_above_ma':
-        # 三个运营商都站在20日均线上方预警逻辑
-        ma_line = stock_config['ma_line']
-        carriers = stock_config['carriers']
-        
-        # 存储三个运营商的数据
-        carriers_data = []
-        all_above_ma = True
-        
-        # 对每个运营商获取数据并检查
-        for carrier in carriers:
-            carrier_name = carrier['name']
-            carrier_code = carrier['code']
-            
-            # 获取运营商股票数据
-            carrier_df = get_stock_data(carrier_code, carrier_name)
-            
-            if carrier_df.empty:
-                print(f"❌ 未获取到{carrier_name}数据")
-                all_above_ma = False
-                break
-            
-            # 计算20日均线
-            carrier_df[f'ma{ma_line}'] = carrier_df['close'].rolling(window=ma_line).mean()
-            
-            # 获取最新数据
-            latest_carrier_row = carrier_df.iloc[-1]
-            latest_close = latest_carrier_row['close']
-            latest_ma = latest_carrier_row[f'ma{ma_line}']
-            above_ma = latest_close > latest_ma
-            
-            # 存储数据
-            carriers_data.append({
-                'name': carrier_name,
-                'code': carrier_code,
-                'close': latest_close,
-                f'ma{ma_line}': latest_ma,
-                'above_ma': above_ma
-            })
-            
-            # 检查是否站在均线上方
-            if not above_ma:
-                all_above_ma = False
-        
-        # 检查是否有预警信号
-        has_alert = all_above_ma and len(carriers_data) == 3
-        alert_name = '三大运营商都站在20日均线上方预警' if has_alert else None
-        
-        # 获取最新日期
-        latest_date = datetime.now().strftime('%Y-%m-%d')
-        if carriers_data:
-            latest_date = carriers_data[0]['close'].name.strftime('%Y-%m-%d') if hasattr(carriers_data[0]['close'], 'name') else latest_date
-        
-        # 构建最新数据
-        latest_data = {
-            'date': latest_date,
-            'carriers': carriers_data
-        }
-        
-        # 构建df（仅用于图表）
-        df = pd.DataFrame()
-    
+    def _grow(self, rows: int):
+        """在列文件末尾分配rows行，返回起始行（按文件实际长度分配，其他进程尚未写出索引的区段也不会被覆盖）"""
+        date_file = self._column_file('date')
+        allocated = os.path.getsize(date_file) // np.dtype(self.FIELDS['date']).itemsize if os.path.exists(date_file) else 0
+        offset = max(self.size, allocated)
+        for field, dtype in self.FIELDS.items():
+            column_file = self._column_file(field)
+            with open(column_file, 'ab'):
+                pass
+            os.truncate(column_file, (offset + rows) * np.dtype(dtype).itemsize)
+        self.size = offset + rows
+        self._map_columns()
+        return offset
+
+    def _write_rows(self, offset: int, columns: dict):
+        """把各列数据写到列文件的offset行处"""
+        for field, dtype in self.FIELDS.items():
+            with open(self._column_file(field), 'r+b') as f:
+                f.seek(offset * np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(columns[field], dtype=dtype).tobytes())
+
+    @classmethod
+    def _to_columns(cls, df: pd.DataFrame) -> dict:
+        """把K线DataFrame转换为存档的列格式"""
+        columns = {'date': df['date'].to_numpy(dtype='datetime64[D]').astype(np.int64)}
+        for field in ('open', 'high', 'low', 'close', 'amount'):
+            columns[field] = df[field].to_numpy(dtype=float) if field in df.columns else np.zeros(len(df))
+        volume = df['volume'].to_numpy(dtype=float) if 'volume' in df.columns else np.zeros(len(df))
+        columns['volume'] = np.rint(np.nan_to_num(volume))
+        return columns
+
+    def _place(self, columns: dict, length: int) -> list:
+        """把一只股票的完整数据写入新的区段（文件末尾），返回区段[offset, length, capacity]"""
+        capacity = length + self.APPEND_SLACK
+        offset = self._grow(capacity)
+        self._write_rows(offset, columns)
+        return [offset, length, capacity]
+
+    def _commit(self, code: str, entry: list, dates: np.ndarray, coverage: int = None):
+        """数据写入成功后才更新内存中的索引（写入中途失败时索引保持原样），索引文件按批写出"""
+        self.symbols[code] = self._pending[code] = entry
+        if coverage is not None:
+            self.coverage[code] = self._pending_coverage[code] = coverage
+        self.calendar = np.union1d(self.calendar, dates)
+        if len(self._pending) >= self.INDEX_SAVE_EVERY or time.time() - self._saved_at >= self.INDEX_SAVE_SECONDS:
+            self._save_index()
+
+    def write(self, code: str, df: pd.DataFrame, start_date: str = None):
+        """写入（替换）一只股票的全部历史数据，start_date为这份数据下载时的起始日期"""
+        if df.empty:
+            return
+        columns = self._to_columns(df)
+        # 上市晚于起始日期时数据从上市日开始，同样视为已覆盖到start_date
+        coverage = int(np.datetime64(pd.Timestamp(start_date).date(), 'D').astype(np.int64)) if start_date else None
+        with self._write_lock():
+            entry = self.symbols.get(code)
+            if entry and entry[2] >= len(df):
+                self._write_rows(entry[0], columns)
+                entry = [entry[0], len(df), entry[2]]
+            else:
+                entry = self._place(columns, len(df))
+            self._commit(code, entry, columns['date'], coverage)
+
+    def append(self, code: str, df: pd.DataFrame):
+        """追加一只股票的新交易日数据，容量足够时原地写入"""
+        if df.empty:
+            return
+        columns = self._to_columns(df)
+        with self._write_lock():
+            entry = self.symbols.get(code)
+            if entry is None:
+                entry = self._place(columns, len(df))
+            elif entry[1] + len(df) <= entry[2]:
+                self._write_rows(entry[0] + entry[1], columns)
+                entry = [entry[0], entry[1] + len(df), entry[2]]
+            else:
+                # 容量不足：旧数据和新数据一起搬到文件末尾
+                offset, length, _ = entry
+                merged = {field: np.concatenate([np.asarray(self._columns[field][offset:offset + length]), columns[field]])
+                          for field in self.FIELDS}
+                entry = self._place(merged, length + len(df))
+            self._commit(code, entry, columns['date'])
+
+    def covered_from(self, code: str) -> pd.Timestamp:
+        """存档中该股票完整历史的起始日期（没有记录时为存档中的第一根K线）"""
+        with self._lock:
+            self._reload()
+            if code in self.coverage:
+                return pd.Timestamp(np.datetime64(self.coverage[code], 'D'))
+            entry = self.symbols.get(code)
+            if entry is None or not self._columns:
+                return None
+            return pd.Timestamp(np.datetime64(int(self._columns['date'][entry[0]]), 'D'))
+
+    def column(self, code: str, field: str) -> np.ndarray:
+        """零拷贝读取一只股票某个字段的全部数据（只读视图）"""
+        with self._lock:
+            self._reload()
+            entry = self.symbols.get(code)
+            if entry is None or not self._columns:
+                return np.empty(0, dtype=self.FIELDS[field])
+            offset, length, _ = entry
+            return self._columns[field][offset:offset + length]
+
+    def read_frame(self, code: str) -> pd.DataFrame:
+        """读取一只股票的K线DataFrame"""
+        with self._lock:
+            self._reload()
+            if code not in self.symbols:
+                return pd.DataFrame()
+            data = {field: self.column(code, field) for field in self.FIELDS}
+        df = pd.DataFrame({field: np.asarray(values, dtype=float) for field, values in data.items() if field != 'date'})
+        df.insert(0, 'date', pd.to_datetime(np.asarray(data['date']).astype('datetime64[D]')))
+        return df
+
+    def compact(self):
+        """压缩存档：去掉搬迁后留下的空洞，所有区段重新连续排列"""
+        with self._write_lock():
+            data = {code: {field: np.array(self._columns[field][o:o + n]) for field in self.FIELDS}
+                    for code, (o, n, _) in self.symbols.items()}
+            for field in self.FIELDS:
+                os.truncate(self._column_file(field), 0)
+            self.size = 0
+            self.symbols = {code: self._place(columns, len(columns['date'])) for code, columns in data.items()}
+            self._pending = dict(self.symbols)
+            self._save_index()
+
+_bar_archive = None
+_bar_archive_lock = threading.Lock()
+
+def get_bar_archive() -> BarArchive:
+    """获取全局K线存档对象"""
+    global _bar_archive
+    with _bar_archive_lock:
+        if _bar_archive is None:
+            _bar_archive = BarArchive()
+        return _bar_archive
+
+def _complete_bars(df: pd.DataFrame) -> pd.DataFrame:
+    """去掉盘中尚未完成的当日K线，只有完整的K线才写入存档"""
+    if datetime.now().strftime('%H:%M') >= MARKET_CLOSE_TIME:
+        return df
+    return df[df['date'] < pd.Timestamp(datetime.now().date())]
+
+def get_raw_stock_data(stock_code: str, stock_name: str, start_date: str = None) -> pd.DataFrame:
+    """获取未复权历史数据：优先读取本地K线存档，只从网络补充存档之后的新数据
+
+    start_date早于存档覆盖的起始日期时（规则需要更长的历史），重新下载完整历史回填存档。
+    """
+    start_date = start_date or DATA_START_DATE
+    if not BAR_ARCHIVE_ENABLED:
+        return fetch_stock_data(stock_code, stock_name, start_date=start_date)
+
+    archive = get_bar_archive()
+    cached = archive.read_frame(stock_code)
+    covered_from = archive.covered_from(stock_code)
+    if cached.empty or covered_from > pd.Timestamp(start_date):
+        if not cached.empty:
+            print(f"  📚 {stock_name}({stock_code})存档从{covered_from.strftime('%Y-%m-%d')}开始，回填{start_date}起的历史")
+        df = fetch_stock_data(stock_code, stock_name, start_date=start_date)
+        if df.empty:
+            return cached[cached['date'] >= pd.Timestamp(start_date)].reset_index(drop=True)
+        archive.write(stock_code, _complete_bars(df), start_date)
+        return df
+
+    # 从存档最后一天开始补数据，重叠的一天用来校验存档与数据源是否一致
+    last_date = cached['date'].iloc[-1]
+    tail = fetch_stock_data(stock_code, stock_name, start_date=last_date.strftime('%Y%m%d'))
+    if tail.empty:
+        print(f"  ⚠️  {stock_name}({stock_code})网络数据获取失败，使用本地存档数据")
+        return cached[cached['date'] >= pd.Timestamp(start_date)].reset_index(drop=True)
+
+    overlap = tail.loc[tail['date'] == last_date, 'close']
+    if overlap.empty or not np.isclose(overlap.iloc[0], cached['close'].iloc[-1], rtol=1e-4):
+        print(f"  ♻️  {stock_name}({stock_code})存档数据与数据源不一致，重新下载完整历史")
+        df = fetch_stock_data(stock_code, stock_name, start_date=min(start_date, covered_from.strftime('%Y%m%d')))
+        if df.empty:
+            return cached[cached['date'] >= pd.Timestamp(start_date)].reset_index(drop=True)
+        archive.write(stock_code, _complete_bars(df), min(start_date, covered_from.strftime('%Y%m%d')))
+        return df[df['date'] >= pd.Timestamp(start_date)].reset_index(drop=True)
+
+    new_rows = tail[tail['date'] > last_date]
+    archive.append(stock_code, _complete_bars(new_rows))
+    print(f"  📦 {stock_name}({stock_code})使用本地存档{len(cached)}条 + 新数据{len(new_rows)}条")
+    df = pd.concat([cached, new_rows[cached.columns]], ignore_index=True)
+    return df[df['date'] >= pd.Timestamp(start_date)].reset_index(drop=True)
+
+def fetch_adjust_factors(stock_code: str) -> pd.DataFrame:
+    """从新浪获取前复权/后复权因子表（每次除权除息对应一行）"""
+    symbol = _prefixed_symbol(stock_code)
+    tables = []
+    for adjust in ('qfq', 'hfq'):
+        factor_df = safe_get_data(ak.stock_zh_a_daily, symbol=symbol, adjust=f'{adjust}-factor')
+        if factor_df is None:
+            return pd.DataFrame()
+        factor_df = factor_df[['date', f'{adjust}_factor']].copy()
+        factor_df['date'] = pd.to_datetime(factor_df['date'])
+        factor_df[f'{adjust}_factor'] = pd.to_numeric(factor_df[f'{adjust}_factor'], errors='coerce')
+        tables.append(factor_df.set_index('date'))
+    return pd.concat(tables, axis=1).sort_index().ffill().bfill().reset_index()
+
+def get_adjust_factors(stock_code: str) -> pd.DataFrame:
+    """获取复权因子表：本地缓存当天有效，过期后重新下载；下载失败时沿用旧缓存"""
+    factor_file = os.path.join(ADJUST_FACTOR_DIR, f'{stock_code}.csv')
+    cached = pd.DataFrame()
+    if os.path.exists(factor_file):
+        cached = pd.read_csv(factor_file, parse_dates=['date'])
+        if datetime.fromtimestamp(os.path.getmtime(factor_file)).strftime('%Y%m%d') == TODAY_DATE:
+            return cached
+
+    factors = fetch_adjust_factors(stock_code)
+    if factors.empty:
+        if not cached.empty:
+            print(f"  ⚠️  {stock_code}复权因子更新失败，沿用本地缓存")
+        return cached
+
+    if not os.path.exists(ADJUST_FACTOR_DIR):
+        os.makedirs(ADJUST_FACTOR_DIR)
+    factors.to_csv(factor_file + '.tmp', index=False)
+    os.replace(factor_file + '.tmp', factor_file)
+    return factors
+
+def apply_adjustment(df: pd.DataFrame, factors: pd.DataFrame, adjust: str = 'qfq') -> pd.DataFrame:
+    """用复权因子把未复权K线换算为复权价格（向量化）
+
+    每根K线使用日期不晚于它的最近一条因子：前复权价 = 原价 / qfq_factor，后复权价 = 原价 * hfq_factor。
+    """
+    column = f'{adjust}_factor'
+    if df.empty or factors.empty or column not in factors.columns:
+        return df
+    factor_dates = factors['date'].to_numpy(dtype='datetime64[D]')
+    position = np.searchsorted(factor_dates, df['date'].to_numpy(dtype='datetime64[D]'), side='right') - 1
+    factor = factors[column].to_numpy(dtype=float)[np.clip(position, 0, len(factor_dates) - 1)]
+
+    adjusted = df.copy()
+    prices = adjusted[['open', 'high', 'low', 'close']].to_numpy(dtype=float)
+    prices = prices / factor[:, None] if adjust == 'qfq' else prices * factor[:, None]
+    adjusted[['open', 'high', 'low', 'close']] = prices
+    return adjusted
+
+def get_stock_data(stock_code: str, stock_name: str, adjust: str = None, start_date: str = None) -> pd.DataFrame:
+    """获取股票历史数据：未复权K线来自本地存档+增量下载，复权价格在本地用复权因子计算"""
+    adjust = PRICE_ADJUST if adjust is None else adjust
+    df = get_raw_stock_data(stock_code, stock_name, start_date)
+    if df.empty or adjust not in ('qfq', 'hfq'):
+        return df
+    factors = get_adjust_factors(stock_code)
+    if factors.empty:
+        print(f"  ⚠️  {stock_name}({stock_code})未获取到复权因子，使用未复权价格")
+        return df
+    return apply_adjustment(df, factors, adjust)
+
+# 股息率要用实际派息金额除以当时的成交价，因此使用未复权价格
+RULE_PRICE_ADJUST = {'dividend_yield': ''}
+
+def config_adjust(stock_config: dict) -> str:
+    """预警配置使用的复权方式：配置中的'adjust'优先，其次是预警类型的默认值，最后是全局PRICE_ADJUST"""
+    return stock_config.get('adjust', RULE_PRICE_ADJUST.get(stock_config['alert_type'], PRICE_ADJUST))
+
+# ===================== 多周期K线 =====================
+# 周线/月线由已缓存的日线按交易日历聚合得到（周期标签为该周期最后一个交易日），不需要额外的网络请求。
+# 聚合使用reduceat对日期×股票面板一次完成；单只股票的已结束周期只计算一次，
+# 之后只有最后一个未结束的周期随新日线增量更新。
+TIMEFRAME_UNITS = {'daily': '日', 'weekly': '周', 'monthly': '月'}
+TIMEFRAME_LABELS = {'daily': '', 'weekly': '周线', 'monthly': '月线'}
+TIMEFRAME_BAR_UNITS = {'daily': '个交易日', 'weekly': '周', 'monthly': '个月'}
+
+def timeframe_unit(stock_config: dict) -> str:
+    """均线周期单位：日/周/月"""
+    return TIMEFRAME_UNITS[stock_config.get('timeframe', 'daily')]
+
+def timeframe_label(stock_config: dict) -> str:
+    """预警名称前缀：日线为空，周线/月线分别为周线/月线"""
+    return TIMEFRAME_LABELS[stock_config.get('timeframe', 'daily')]
+
+def timeframe_bar_unit(stock_config: dict) -> str:
+    """K线根数的量词：个交易日/周/个月"""
+    return TIMEFRAME_BAR_UNITS[stock_config.get('timeframe', 'daily')]
+
+def period_keys(dates, timeframe: str) -> np.ndarray:
+    """每个日期所属周期的编号（周一开始的自然周 / 自然月）"""
+    days = np.asarray(dates, dtype='datetime64[D]')
+    if timeframe == 'weekly':
+        return (days.astype(np.int64) + 3) // 7  # 1970-01-01是周四
+    if timeframe == 'monthly':
+        return days.astype('datetime64[M]').astype(np.int64)
+    return days.astype(np.int64)
+
+def _first_valid(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """每个周期内每列第一个非NaN值"""
+    rows = np.arange(len(values))[:, None]
+    index = np.where(np.isnan(values), len(values), rows)
+    index = np.minimum.accumulate(index[::-1], axis=0)[::-1][starts]
+    result = np.take_along_axis(values, np.minimum(index, len(values) - 1), axis=0)
+    result[index > ends[:, None]] = np.nan
+    return result
+
+def _last_valid(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """每个周期内每列最后一个非NaN值"""
+    rows = np.arange(len(values))[:, None]
+    index = np.maximum.accumulate(np.where(np.isnan(values), -1, rows), axis=0)[ends]
+    result = np.take_along_axis(values, np.maximum(index, 0), axis=0)
+    result[index < starts[:, None]] = np.nan
+    return result
+
+def resample_panel(dates, fields: dict, timeframe: str):
+    """把日线面板（日期×股票的二维数组）按周/月聚合，所有股票一次完成
+
+    返回(周期最后交易日, 周期编号, 聚合后的各字段面板)。缺失的数据用NaN表示，不影响其他股票。
+    """
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    keys = period_keys(dates, timeframe)
+    if len(keys) == 0:
+        return dates, keys, {field: np.asarray(values, dtype=float) for field, values in fields.items()}
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+
+    resampled = {}
+    for field, values in fields.items():
+        values = np.asarray(values, dtype=float)
+        if field == 'open':
+            resampled[field] = _first_valid(values, starts, ends)
+        elif field == 'close':
+            resampled[field] = _last_valid(values, starts, ends)
+        elif field == 'high':
+            resampled[field] = np.fmax.reduceat(values, starts, axis=0)
+        elif field == 'low':
+            resampled[field] = np.fmin.reduceat(values, starts, axis=0)
+        else:
+            resampled[field] = np.add.reduceat(np.nan_to_num(values), starts, axis=0)
+    return dates[ends], keys[starts], resampled
+
+def resample_bars(df: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+    """把单只股票的日线聚合为周线/月线"""
+    fields = {col: df[col].to_numpy(dtype=float)[:, None] for col in BAR_COLUMNS[1:] if col in df.columns}
+    dates, keys, resampled = resample_panel(df['date'].to_numpy(), fields, timeframe)
+    bars = pd.DataFrame({'date': dates})
+    for col, values in resampled.items():
+        bars[col] = values[:, 0]
+    bars['period'] = keys
+    return bars
+
+class ResampledBars:
+    """单只股票的周线/月线，已结束的周期缓存复用，只重算最后一个未结束的周期"""
+
+    def __init__(self, timeframe: str):
+        self.timeframe = timeframe
+        self.closed = pd.DataFrame()  # 已结束的周期
+        self.open_start = None        # 未结束周期第一根日线的日期
+
+    def _history_unchanged(self, df: pd.DataFrame) -> bool:
+        """已结束周期的收盘价与日线一致（复权因子更新等会导致历史价格整体变化）"""
+        if self.closed.empty:
+            return True
+        last = self.closed.iloc[-1]
+        position = df['date'].searchsorted(last['date'])
+        return position < len(df) and df['date'].iloc[position] == last['date'] \
+            and np.isclose(df['close'].iloc[position], last['close'])
+
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """用最新日线更新，返回完整的周线/月线"""
+        if self.open_start is None or not self._history_unchanged(df):
+            bars = resample_bars(df, self.timeframe)
+            self.closed = bars.iloc[:-1]
+        else:
+            # 只聚合未结束周期起的日线：可能仍是同一个周期，也可能已经进入新的周期
+            tail = resample_bars(df[df['date'] >= self.open_start], self.timeframe)
+            self.closed = pd.concat([self.closed, tail.iloc[:-1]], ignore_index=True)
+            bars = pd.concat([self.closed, tail.iloc[-1:]], ignore_index=True)
+        if not bars.empty:
+            open_key = bars['period'].iloc[-1]
+            self.open_start = df['date'].iloc[int(np.argmax(period_keys(df['date'].to_numpy(), self.timeframe) == open_key))]
+        return bars
+
+_resampled_bars = {}
+_resampled_bars_lock = threading.Lock()
+
+def get_timeframe_bars(stock_code: str, df: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+    """获取指定周期的K线，同一股票同一周期的聚合结果在进程内复用"""
+    if timeframe == 'daily' or df.empty:
+        return df
+    with _resampled_bars_lock:
+        state = _resampled_bars.setdefault((stock_code, timeframe), ResampledBars(timeframe))
+    return state.update(df)
+
+# ===================== 指标库 =====================
+# 所有指标都以日期×股票的二维数组（面板）为输入，一次计算全部股票：
+# 滑动窗口类指标用累计和实现，EMA/RSI/ATR等递推类指标沿时间方向递推、在股票方向向量化。
+# 递推类指标可传入上次计算返回的state，只对新增的K线做增量计算。
+def build_panel(frames: dict, field: str = 'close'):
+    """把多只股票的K线对齐为面板，返回(日期数组, 股票代码列表, 日期×股票数组)，缺失为NaN"""
+    codes = [code for code, df in frames.items() if df is not None and not df.empty]
+    if not codes:
+        return np.empty(0, dtype='datetime64[ns]'), [], np.empty((0, 0))
+    dates = np.unique(np.concatenate([frames[code]['date'].to_numpy(dtype='datetime64[ns]') for code in codes]))
+    panel = np.full((len(dates), len(codes)), np.nan)
+    for j, code in enumerate(codes):
+        df = frames[code]
+        panel[np.searchsorted(dates, df['date'].to_numpy(dtype='datetime64[ns]')), j] = df[field].to_numpy(dtype=float)
+    return dates, codes, panel
+
+def stack_bars(frames: dict, field: str = 'close'):
+    """把多只股票按各自的K线轴（不按日期对齐）右对齐堆叠，返回(股票代码列表, 行×股票数组)，较短的序列前面补NaN
+
+    停牌日不会在序列中间留下NaN，均线、游程和之后N根的收益都与逐只计算完全一致；只适用于不需要跨股票同日比较的计算。
+    """
+    codes = [code for code, df in frames.items() if df is not None and not df.empty]
+    length = max((len(frames[code]) for code in codes), default=0)
+    panel = np.full((length, len(codes)), np.nan)
+    for j, code in enumerate(codes):
+        values = frames[code][field].to_numpy(dtype=float)
+        panel[length - len(values):, j] = values
+    return codes, panel
+
+def _as_panel(values) -> np.ndarray:
+    """一维序列视为单列面板"""
+    values = np.asarray(values, dtype=float)
+    return values[:, None] if values.ndim == 1 else values
+
+def _restore_shape(result: np.ndarray, values) -> np.ndarray:
+    """输入是一维序列时返回一维结果"""
+    return result[:, 0] if np.ndim(values) == 1 else result
+
+def sma(values, window: int) -> np.ndarray:
+    """简单移动平均（累计和实现），窗口内有NaN时结果为NaN"""
+    x = _as_panel(values)
+    valid = ~np.isnan(x)
+    csum = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(np.where(valid, x, 0.0), axis=0)])
+    ccount = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(valid, axis=0)])
+    result = np.full(x.shape, np.nan)
+    if window <= len(x):
+        total = csum[window:] - csum[:-window]
+        count = ccount[window:] - ccount[:-window]
+        result[window - 1:] = np.where(count == window, total / window, np.nan)
+    return _restore_shape(result, values)
+
+def rolling_std(values, window: int) -> np.ndarray:
+    """滑动窗口总体标准差（累计平方和实现）"""
+    x = _as_panel(values)
+    mean = _as_panel(sma(x, window))
+    mean_sq = _as_panel(sma(x * x, window))
+    return _restore_shape(np.sqrt(np.maximum(mean_sq - mean * mean, 0.0)), values)
+
+def _recursive_smooth(values, alpha: float, state=None) -> np.ndarray:
+    """递推平滑 y[t] = alpha*x[t] + (1-alpha)*y[t-1]，每列从第一个有效值开始，NaN处沿用上一值"""
+    x = _as_panel(values)
+    result = np.empty(x.shape)
+    previous = np.full(x.shape[1], np.nan) if state is None else np.asarray(state, dtype=float).reshape(-1).copy()
+    for t in range(len(x)):
+        row = x[t]
+        previous = np.where(np.isnan(previous), row, np.where(np.isnan(row), previous, alpha * row + (1 - alpha) * previous))
+        result[t] = previous
+    return _restore_shape(result, values)
+
+def ema(values, span: int, state=None) -> np.ndarray:
+    """指数移动平均，state为上次结果的最后一行（增量更新时传入）"""
+    return _recursive_smooth(values, 2.0 / (span + 1), state)
+
+def macd(close, fast: int = 12, slow: int = 26, signal: int = 9, state: dict = None) -> dict:
+    """MACD：DIF = EMA快 - EMA慢，DEA = DIF的EMA，MACD柱 = 2*(DIF-DEA)"""
+    state = state or {}
+    ema_fast = _as_panel(ema(close, fast, state.get('ema_fast')))
+    ema_slow = _as_panel(ema(close, slow, state.get('ema_slow')))
+    dif = ema_fast - ema_slow
+    dea = _as_panel(ema(dif, signal, state.get('dea')))
     return {
-        'has_alert': has_alert,
-        'alert_type': alert_name,
-        'latest_data': latest_data,
-        'df': df
+        'dif': _restore_shape(dif, close),
+        'dea': _restore_shape(dea, close),
+        'macd': _restore_shape(2 * (dif - dea), close),
+        'state': {'ema_fast': ema_fast[-1], 'ema_slow': ema_slow[-1], 'dea': dea[-1]} if len(dif) else state
     }
 
-# ===================== 绘制预警图表 =====================
-def plot_alert_chart(df: pd.DataFrame, stock_config: dict, has_alert: bool):
-    """绘制预警图表"""
-    if df.empty:
-        return None
+def rsi(close, period: int = 14, state: dict = None) -> dict:
+    """RSI（Wilder平滑）：每列从自己的第一个有效收盘价起，前period个涨跌幅的均值作为初始平均涨跌幅，
+    之后按1/period递推，第period个涨跌幅之前为NaN；state包含上一根收盘价、平均涨跌幅和已计入的涨跌幅个数"""
+    x = _as_panel(close)
+    columns = x.shape[1]
+    if state:
+        prev = np.asarray(state['close'], dtype=float).reshape(-1).copy()
+        avg_gain = np.asarray(state['avg_gain'], dtype=float).reshape(-1).copy()
+        avg_loss = np.asarray(state['avg_loss'], dtype=float).reshape(-1).copy()
+        count = np.asarray(state.get('count', period)).reshape(-1) * np.ones(columns, dtype=int)
+    else:
+        prev = np.full(columns, np.nan)
+        avg_gain, avg_loss = np.zeros(columns), np.zeros(columns)
+        count = np.zeros(columns, dtype=int)
+    value = np.full(x.shape, np.nan)
+    for t in range(len(x)):
+        row = x[t]
+        change = row - prev  # 尚无上一根有效收盘价或当根缺失时为NaN
+        valid = ~np.isnan(change)
+        gain = np.where(valid, np.maximum(change, 0.0), 0.0)
+        loss = np.where(valid, np.maximum(-change, 0.0), 0.0)
+        count = count + valid
+        seeding = valid & (count <= period)
+        # 前period个涨跌幅累加均值，之后 avg = avg + (当根 - avg) / period
+        avg_gain = np.where(seeding, avg_gain + gain / period, np.where(valid, avg_gain + (gain - avg_gain) / period, avg_gain))
+        avg_loss = np.where(seeding, avg_loss + loss / period, np.where(valid, avg_loss + (loss - avg_loss) / period, avg_loss))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            current = np.where(avg_loss == 0, 100.0, 100.0 - 100.0 / (1.0 + avg_gain / avg_loss))
+        value[t] = np.where((count >= period) & ~np.isnan(row), current, np.nan)
+        prev = np.where(np.isnan(row), prev, row)
+    return {
+        'rsi': _restore_shape(value, close),
+        'state': {'close': prev, 'avg_gain': avg_gain, 'avg_loss': avg_loss, 'count': count}
+    }
+
+def bollinger(close, window: int = 20, width: float = 2.0, state: dict = None) -> dict:
+    """布林带：中轨为window期均线，上下轨为中轨±width倍标准差；state保存最后window-1根收盘价"""
+    x = _as_panel(close)
+    history = None if not state else np.asarray(state['tail'], dtype=float).reshape(-1, x.shape[1])
+    full = x if history is None else np.vstack([history, x])
+    mid = _as_panel(sma(full, window))[len(full) - len(x):]
+    std = _as_panel(rolling_std(full, window))[len(full) - len(x):]
+    return {
+        'mid': _restore_shape(mid, close),
+        'upper': _restore_shape(mid + width * std, close),
+        'lower': _restore_shape(mid - width * std, close),
+        'state': {'tail': full[-(window - 1):] if window > 1 else full[:0]}
+    }
+
+def atr(high, low, close, period: int = 14, state: dict = None) -> dict:
+    """平均真实波幅（Wilder平滑），state包含上一根收盘价和上一期ATR"""
+    state = state or {}
+    h, l, c = _as_panel(high), _as_panel(low), _as_panel(close)
+    prev_close = np.vstack([
+        np.full((1, c.shape[1]), np.nan) if state.get('close') is None else np.asarray(state['close'], dtype=float).reshape(1, -1),
+        c[:-1]
+    ])
+    true_range = np.fmax(h - l, np.fmax(np.abs(h - prev_close), np.abs(l - prev_close)))
+    value = _as_panel(_recursive_smooth(true_range, 1.0 / period, state.get('atr')))
+    return {
+        'atr': _restore_shape(value, close),
+        'state': {'close': c[-1], 'atr': value[-1]} if len(c) else state
+    }
+
+# 区间位置类指标：滑动最高/最低价用分块前后缀极值（van Herk/Gil-Werman）在整个面板上一次求出，
+# 窗口内分位数用有序窗口（二分插入/删除）逐根更新；RollingExtreme/RollingPercentile为逐根增量版本。
+def _valid_window(x: np.ndarray, window: int) -> np.ndarray:
+    """窗口内数据是否完整（没有NaN）"""
+    ccount = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(~np.isnan(x), axis=0)])
+    complete = np.zeros(x.shape, dtype=bool)
+    if window <= len(x):
+        complete[window - 1:] = (ccount[window:] - ccount[:-window]) == window
+    return complete
+
+def _rolling_extreme(values, window: int, func) -> np.ndarray:
+    """滑动窗口极值：按窗口长度分块，窗口极值 = 起点所在块的后缀极值与终点所在块的前缀极值之较"""
+    x = _as_panel(values)
+    length, columns = x.shape
+    result = np.full(x.shape, np.nan)
+    if window > length:
+        return _restore_shape(result, values)
+    pad = (-length) % window
+    blocks = np.vstack([x, np.full((pad, columns), np.nan)]).reshape(-1, window, columns)
+    prefix = func.accumulate(blocks, axis=1).reshape(-1, columns)
+    suffix = func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1, columns)
+    result[window - 1:] = func(suffix[:length - window + 1], prefix[window - 1:length])
+    result[~_valid_window(x, window)] = np.nan
+    return _restore_shape(result, values)
+
+def rolling_max(values, window: int) -> np.ndarray:
+    """滑动窗口最大值，窗口内有NaN时结果为NaN"""
+    return _rolling_extreme(values, window, np.fmax)
+
+def rolling_min(values, window: int) -> np.ndarray:
+    """滑动窗口最小值，窗口内有NaN时结果为NaN"""
+    return _rolling_extreme(values, window, np.fmin)
+
+def drawdown(close, window: int) -> np.ndarray:
+    """相对window根内最高收盘价的回撤（负数，-0.2即回撤20%）"""
+    x = _as_panel(close)
+    return _restore_shape(x / _as_panel(rolling_max(x, window)) - 1.0, close)
+
+def range_position(close, window: int) -> np.ndarray:
+    """收盘价在window根最高最低区间中的位置（0为最低，1为最高）"""
+    x = _as_panel(close)
+    high = _as_panel(rolling_max(x, window))
+    low = _as_panel(rolling_min(x, window))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        position = np.where(high > low, (x - low) / (high - low), 0.5)
+    position[np.isnan(high) | np.isnan(low)] = np.nan
+    return _restore_shape(position, close)
+
+class RollingExtreme:
+    """单调队列维护滑动窗口最大/最小值，每根新K线均摊O(1)更新"""
     
-    stock_name = stock_config['name']
-    alert_type = stock_config['alert_type']
+    def __init__(self, window: int, mode: str = 'max'):
+        self.window = window
+        self.sign = 1 if mode == 'max' else -1
+        self.items = deque()  # (序号, 值)，值按单调顺序排列
+        self.count = 0
     
-    # 确保在主线程中使用matplotlib
-    if threading.current_thread().name != 'MainThread':
-        print(f"  ⚠️  图表绘制需要在主线程中执行，跳过绘制")
+    def update(self, value: float) -> float:
+        """加入一根新K线，返回当前窗口极值（窗口未满为NaN）"""
+        key = self.sign * value
+        while self.items and self.sign * self.items[-1][1] <= key:
+            self.items.pop()
+        self.items.append((self.count, value))
+        self.count += 1
+        while self.items[0][0] <= self.count - 1 - self.window:
+            self.items.popleft()
+        return self.items[0][1] if self.count >= self.window else np.nan
+
+class RollingPercentile:
+    """有序窗口维护滑动窗口分位：新值二分插入、过期值二分删除，分位按平均名次计算"""
+    
+    def __init__(self, window: int):
+        self.window = window
+        self.values = deque()
+        self.ordered = []
+    
+    def update(self, value: float) -> float:
+        """加入一根新K线，返回其在窗口内的分位（0~1，窗口未满为NaN）"""
+        self.values.append(value)
+        bisect.insort(self.ordered, value)
+        if len(self.values) > self.window:
+            expired = self.values.popleft()
+            del self.ordered[bisect.bisect_left(self.ordered, expired)]
+        if len(self.values) < self.window:
+            return np.nan
+        less = bisect.bisect_left(self.ordered, value)
+        equal = bisect.bisect_right(self.ordered, value) - less
+        return (less + (equal + 1) / 2) / self.window
+
+def rolling_percentile(values, window: int) -> np.ndarray:
+    """每根K线收盘价在最近window根中的分位（与pandas rolling rank(pct=True)一致），窗口内有NaN为NaN"""
+    x = _as_panel(values)
+    result = np.full(x.shape, np.nan)
+    for j in range(x.shape[1]):
+        tracker = RollingPercentile(window)
+        # NaN替换为+inf参与排序（不会计入小于等于当前价的数量），最后按窗口完整性屏蔽
+        column = np.where(np.isnan(x[:, j]), np.inf, x[:, j])
+        result[:, j] = [tracker.update(value) for value in column.tolist()]
+    result[~_valid_window(x, window)] = np.nan
+    return _restore_shape(result, values)
+
+def latest_percentile(values, window: int, lookback: int = 1) -> np.ndarray:
+    """只计算最后lookback根K线的窗口分位，在股票方向向量化（全市场扫描时使用）"""
+    x = _as_panel(values)
+    result = np.full((lookback, x.shape[1]), np.nan)
+    for k in range(lookback):
+        end = len(x) - lookback + k + 1
+        if end < window:
+            continue
+        current = x[end - 1]
+        block = x[end - window:end]
+        less = (block < current).sum(axis=0)
+        equal = (block == current).sum(axis=0)
+        value = (less + (equal + 1) / 2) / window
+        value[np.isnan(block).any(axis=0)] = np.nan
+        result[k] = value
+    return _restore_shape(result, values)
+
+# 序列判定核：连续N根、连续段起点、上穿/下穿及K根内发生过上穿，输入为布尔或数值面板（一维序列亦可）。
+# 连续根数用游程计数一次求出，不同N的规则只需比较同一个结果，无需为每个N做一次滑动窗口。
+def streak_length(mask) -> np.ndarray:
+    """截至每根K线条件连续成立的根数（游程计数），条件不成立处为0"""
+    m = np.asarray(mask, dtype=bool)
+    index = np.arange(len(m)).reshape((-1,) + (1,) * (m.ndim - 1))
+    last_break = np.maximum.accumulate(np.where(m, -1, index), axis=0)
+    return index - last_break
+
+def bars_since(mask) -> np.ndarray:
+    """距离上一次条件成立经过的根数，当根成立为0，此前从未成立为-1"""
+    m = np.asarray(mask, dtype=bool)
+    index = np.arange(len(m)).reshape((-1,) + (1,) * (m.ndim - 1))
+    last_hit = np.maximum.accumulate(np.where(m, index, -1), axis=0)
+    return np.where(last_hit >= 0, index - last_hit, -1)
+
+def streak_start(mask, n: int) -> np.ndarray:
+    """连续段第一次达到n根的那根K线（即连续N根的首次触发）"""
+    return streak_length(mask) == n
+
+def crosses_above(a, b) -> np.ndarray:
+    """a上穿b：前一根a-b<=0且当根a-b>0，b可以是数值"""
+    diff = np.asarray(a, dtype=float) - np.asarray(b, dtype=float)
+    prev = np.roll(diff, 1, axis=0)
+    prev[:1] = np.nan
+    with np.errstate(invalid='ignore'):
+        return (prev <= 0) & (diff > 0)
+
+def crosses_below(a, b) -> np.ndarray:
+    """a下穿b：前一根a-b>=0且当根a-b<0"""
+    diff = np.asarray(a, dtype=float) - np.asarray(b, dtype=float)
+    return crosses_above(-diff, 0.0)
+
+def within_bars(mask, k: int) -> np.ndarray:
+    """最近k根K线内（含当根）条件成立过"""
+    since = bars_since(mask)
+    return (since >= 0) & (since < k)
+
+def evaluate_streak_rules(close, variants: list) -> dict:
+    """一次计算多组(均线周期, 连续根数)规则在所有股票上的首次触发信号
+
+    close为日期×股票的收盘价面板，variants为[(ma_line, consecutive_bars), ...]；
+    同一均线周期只计算一次均线和游程，返回{(ma_line, consecutive_bars): 布尔面板}。
+    """
+    x = _as_panel(close)
+    streaks = {}
+    signals = {}
+    for ma_line, n in variants:
+        if ma_line not in streaks:
+            with np.errstate(invalid='ignore'):
+                streaks[ma_line] = streak_length(x > _as_panel(sma(x, ma_line)))
+        signals[(ma_line, n)] = _restore_shape(streaks[ma_line] == n, close)
+    return signals
+
+_CHINESE_COUNTS = '零一二三四五六七八九十'
+
+def count_label(n: int) -> str:
+    """根数的中文写法，用于预警名称（10以上用数字）"""
+    return _CHINESE_COUNTS[n] if 0 <= n <= 10 else str(n)
+
+# ===================== 规则表达式 =====================
+# 预警类型 'expression' 用表达式描述条件，例如：
+#   ma(close,10) crosses_above ma(close,20) and close > ma(close,60) for 3 bars
+# 表达式解析为元组形式的语法树并做规范化（'<'改写为'>'、可交换运算的操作数排序、dea/macd展开为ema/dif），
+# 写法不同但含义相同的子表达式得到同一个元组。求值时以节点为键缓存结果，同一份数据或同一个
+# 日期×股票面板上，所有规则引用的同一个均线、比较或连续条件都只计算一次。
+EXPRESSION_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'amount')
+# 函数名 -> (整数参数个数, 计算函数)，第一个参数为序列，其余为整数常量
+EXPRESSION_FUNCTIONS = {
+    'ma': (1, lambda x, n: sma(x, n)),
+    'ema': (1, lambda x, n: ema(x, n)),
+    'std': (1, lambda x, n: rolling_std(x, n)),
+    'highest': (1, lambda x, n: rolling_max(x, n)),
+    'lowest': (1, lambda x, n: rolling_min(x, n)),
+    'percentile': (1, lambda x, n: rolling_percentile(x, n)),
+    'drawdown': (1, lambda x, n: drawdown(x, n)),
+    'rsi': (1, lambda x, n: rsi(x, n)['rsi']),
+    'ref': (1, lambda x, n: _shift(x, n)),
+    'roc': (1, lambda x, n: x / _shift(x, n) - 1.0),
+    'dif': (2, lambda x, fast, slow: ema(x, fast) - ema(x, slow)),
+    'abs': (0, np.abs),
+}
+EXPRESSION_ALIASES = {'sma': 'ma', 'max': 'highest', 'min': 'lowest', 'shift': 'ref'}
+# 与价格同一量纲的函数，图表中叠加在价格图上
+PRICE_SCALE_FUNCTIONS = {'ma', 'ema', 'highest', 'lowest', 'ref'}
+EXPRESSION_KEYWORDS = {'and', 'or', 'not', 'for', 'within', 'bar', 'bars', 'crosses_above', 'crosses_below'}
+COMMUTATIVE_OPS = {'+', '*', '==', '!=', 'and', 'or'}
+_EXPRESSION_TOKEN = re.compile(r"\s*(?:(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?%?)|([A-Za-z_][A-Za-z_0-9]*)|(>=|<=|==|!=|[-+*/(),<>]))")
+_parsed_expressions = {}  # 表达式文本 -> 语法树
+
+def _shift(values, n: int) -> np.ndarray:
+    """n根之前的值，前n根为NaN"""
+    x = np.asarray(values, dtype=float)
+    result = np.full(x.shape, np.nan)
+    if 0 <= n < len(x):
+        result[n:] = x[:len(x) - n]
+    return result
+
+def _tokenize(text: str) -> list:
+    """拆分为(类型, 值, 位置)列表，类型为 num/name/op"""
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _EXPRESSION_TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f"表达式第{pos + 1}个字符附近无法识别：{text[pos:pos + 10]!r}")
+        number, name, op = match.groups()
+        start = match.start(match.lastindex)
+        if number is not None:
+            value = float(number.rstrip('%')) / (100 if number.endswith('%') else 1)
+            tokens.append(('num', value, start))
+        elif name is not None:
+            tokens.append(('name', name.lower(), start))
+        else:
+            tokens.append(('op', op, start))
+        pos = match.end()
+    tokens.append(('end', None, len(text)))
+    return tokens
+
+def expression_kind(node: tuple) -> str:
+    """节点类型：'bool'为条件，'num'为数值序列"""
+    if node[0] in ('not', 'for', 'within'):
+        return 'bool'
+    if node[0] == 'op' and node[1] not in ('+', '-', '*', '/'):
+        return 'bool'
+    return 'num'
+
+def _binary(op: str, left: tuple, right: tuple) -> tuple:
+    """构造二元运算节点并规范化：小于改写为大于，可交换运算按操作数排序，常量直接折叠"""
+    if op in ('<', '<='):
+        op, left, right = {'<': '>', '<=': '>='}[op], right, left
+    if left[0] == 'num' and right[0] == 'num' and op in ('+', '-', '*', '/'):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ('num', float({'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}[op](left[1], right[1])))
+    if op in COMMUTATIVE_OPS and repr(right) < repr(left):
+        left, right = right, left
+    return ('op', op, left, right)
+
+class ExpressionParser:
+    """递归下降解析，优先级从低到高：or、and、not、for/within、比较/穿越、加减、乘除、负号"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def parse(self) -> tuple:
+        node = self._or()
+        if self._peek()[0] != 'end':
+            self._error("多余的内容")
+        return self._require(node, 'bool', "表达式的结果必须是条件（比较、穿越或其组合）")
+
+    def _peek(self):
+        return self.tokens[self.pos]
+
+    def _next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _accept(self, kind: str, value: str) -> bool:
+        if self._peek()[:2] == (kind, value):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, kind: str, value: str):
+        if not self._accept(kind, value):
+            self._error(f"此处应为 {value!r}")
+
+    def _error(self, message: str):
+        _, value, pos = self._peek()
+        found = '结尾' if value is None else repr(value)
+        raise ValueError(f"表达式第{pos + 1}个字符（{found}）附近：{message}")
+
+    def _require(self, node: tuple, kind: str, message: str) -> tuple:
+        if expression_kind(node) != kind:
+            raise ValueError(f"表达式 {expression_text(node)!r}：{message}")
+        return node
+
+    def _integer(self) -> int:
+        kind, value, _ = self._peek()
+        if kind != 'num' or value != int(value) or value < 1:
+            self._error("此处应为正整数")
+        self.pos += 1
+        return int(value)
+
+    def _or(self) -> tuple:
+        node = self._and()
+        while self._accept('name', 'or'):
+            node = _binary('or', self._require(node, 'bool', "or两侧必须是条件"), self._require(self._and(), 'bool', "or两侧必须是条件"))
+        return node
+
+    def _and(self) -> tuple:
+        node = self._not()
+        while self._accept('name', 'and'):
+            node = _binary('and', self._require(node, 'bool', "and两侧必须是条件"), self._require(self._not(), 'bool', "and两侧必须是条件"))
+        return node
+
+    def _not(self) -> tuple:
+        if self._accept('name', 'not'):
+            return ('not', self._require(self._not(), 'bool', "not之后必须是条件"))
+        return self._temporal()
+
+    def _temporal(self) -> tuple:
+        node = self._comparison()
+        while self._peek()[:2] in (('name', 'for'), ('name', 'within')):
+            keyword = self._next()[1]
+            self._require(node, 'bool', f"{keyword}之前必须是条件")
+            count = self._integer()
+            if not (self._accept('name', 'bars') or self._accept('name', 'bar')):
+                self._error("此处应为 'bars'")
+            node = (keyword, node, count)
+        return node
+
+    def _comparison(self) -> tuple:
+        node = self._additive()
+        kind, value, _ = self._peek()
+        if (kind == 'op' and value in ('>', '<', '>=', '<=', '==', '!=')) or (kind == 'name' and value in ('crosses_above', 'crosses_below')):
+            self.pos += 1
+            right = self._additive()
+            self._require(node, 'num', f"{value}两侧必须是数值")
+            self._require(right, 'num', f"{value}两侧必须是数值")
+            node = _binary(value, node, right)
+        return node
+
+    def _additive(self) -> tuple:
+        node = self._term()
+        while self._peek()[0] == 'op' and self._peek()[1] in ('+', '-'):
+            op = self._next()[1]
+            node = _binary(op, node, self._term())
+        return node
+
+    def _term(self) -> tuple:
+        node = self._unary()
+        while self._peek()[0] == 'op' and self._peek()[1] in ('*', '/'):
+            op = self._next()[1]
+            node = _binary(op, node, self._unary())
+        return node
+
+    def _unary(self) -> tuple:
+        if self._accept('op', '-'):
+            node = self._require(self._unary(), 'num', "负号之后必须是数值")
+            return ('num', -node[1]) if node[0] == 'num' else ('neg', node)
+        return self._primary()
+
+    def _primary(self) -> tuple:
+        kind, value, _ = self._peek()
+        if kind == 'num':
+            self.pos += 1
+            return ('num', value)
+        if self._accept('op', '('):
+            node = self._or()
+            self._expect('op', ')')
+            return node
+        if kind != 'name' or value in EXPRESSION_KEYWORDS:
+            self._error("此处应为数值、字段或函数")
+        self.pos += 1
+        if value in EXPRESSION_FIELDS:
+            return ('field', value)
+        name = EXPRESSION_ALIASES.get(value, value)
+        if name not in EXPRESSION_FUNCTIONS and name not in ('dea', 'macd'):
+            raise ValueError(f"未知的字段或函数 {value!r}，字段：{', '.join(EXPRESSION_FIELDS)}；"
+                             f"函数：{', '.join([*EXPRESSION_FUNCTIONS, 'dea', 'macd'])}")
+        self._expect('op', '(')
+        series = self._require(self._additive(), 'num', f"{name}的第一个参数必须是数值序列")
+        params = []
+        while self._accept('op', ','):
+            params.append(self._integer())
+        self._expect('op', ')')
+        # dea/macd展开为ema和dif的组合，与单独写出的dif、ema共用计算结果
+        if name in ('dea', 'macd'):
+            if len(params) > 3:
+                self._error("参数过多")
+            fast, slow, signal = params + [12, 26, 9][len(params):]
+            dif = ('call', 'dif', series, fast, slow)
+            dea = ('call', 'ema', dif, signal)
+            return dea if name == 'dea' else _binary('*', ('num', 2.0), _binary('-', dif, dea))
+        if name == 'dif' and not params:
+            params = [12, 26]
+        if len(params) != EXPRESSION_FUNCTIONS[name][0]:
+            raise ValueError(f"函数 {name} 需要 {EXPRESSION_FUNCTIONS[name][0] + 1} 个参数")
+        return ('call', name, series, *params)
+
+def parse_expression(text: str) -> tuple:
+    """解析规则表达式为语法树（同一文本只解析一次），语法错误时抛出ValueError"""
+    node = _parsed_expressions.get(text)
+    if node is None:
+        node = _parsed_expressions[text] = ExpressionParser(text).parse()
+    return node
+
+def expression_text(node: tuple) -> str:
+    """语法树的规范文本，用作指标列名和说明"""
+    kind = node[0]
+    if kind == 'num':
+        return f"{node[1]:g}"
+    if kind == 'field':
+        return node[1]
+    if kind == 'call':
+        return f"{node[1]}({','.join(expression_text(arg) if isinstance(arg, tuple) else str(arg) for arg in node[2:])})"
+    if kind == 'neg':
+        return f"-{expression_text(node[1])}"
+    if kind == 'not':
+        return f"not ({expression_text(node[1])})"
+    if kind in ('for', 'within'):
+        return f"{expression_text(node[1])} {kind} {node[2]} bars"
+    return f"({expression_text(node[2])} {node[1]} {expression_text(node[3])})"
+
+def expression_nodes(node: tuple) -> list:
+    """语法树的全部子节点（含自身，子节点在前）"""
+    nodes = []
+    for child in node[1:]:
+        if isinstance(child, tuple):
+            nodes.extend(expression_nodes(child))
+    nodes.append(node)
+    return nodes
+
+def expression_fields(node: tuple) -> set:
+    """表达式引用的K线字段"""
+    return {item[1] for item in expression_nodes(node) if item[0] == 'field'}
+
+class ExpressionEvaluator:
+    """在日期×股票面板（或单只股票的序列）上对语法树求值，每个节点的结果按节点缓存只计算一次"""
+
+    def __init__(self, fields: dict, cache: dict = None):
+        self.fields = fields                          # 字段名 -> 数组
+        self.cache = {} if cache is None else cache   # 节点 -> 结果，可在多条规则间共用
+        self.evaluations = 0
+
+    def evaluate(self, node: tuple) -> np.ndarray:
+        if node in self.cache:
+            return self.cache[node]
+        kind = node[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if kind == 'num':
+                value = node[1]
+            elif kind == 'field':
+                value = np.asarray(self.fields[node[1]], dtype=float)
+            elif kind == 'call':
+                value = EXPRESSION_FUNCTIONS[node[1]][1](self.evaluate(node[2]), *node[3:])
+            elif kind == 'neg':
+                value = -self.evaluate(node[1])
+            elif kind == 'not':
+                value = ~self.evaluate(node[1])
+            elif kind == 'for':
+                value = streak_length(self.evaluate(node[1])) >= node[2]
+            elif kind == 'within':
+                value = within_bars(self.evaluate(node[1]), node[2])
+            else:
+                value = self._operate(node[1], self.evaluate(node[2]), self.evaluate(node[3]))
+        self.cache[node] = value
+        self.evaluations += 1
+        return value
+
+    def _operate(self, op: str, left, right):
+        if op == 'crosses_above':
+            return crosses_above(left, right)
+        if op == 'crosses_below':
+            return crosses_below(left, right)
+        if op in ('and', 'or'):
+            return (left & right) if op == 'and' else (left | right)
+        return {
+            '+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide,
+            '>': np.greater, '>=': np.greater_equal, '==': np.equal, '!=': np.not_equal
+        }[op](left, right)
+
+def expression_indicators(node: tuple) -> list:
+    """表达式中需要输出和绘图的指标节点（函数调用），按出现顺序去重"""
+    seen = []
+    for item in expression_nodes(node):
+        if item[0] == 'call' and item not in seen:
+            seen.append(item)
+    return seen
+
+EXPRESSION_PANEL_BATCH = int(os.environ.get('EXPRESSION_PANEL_BATCH', '32'))  # 表达式规则每次面板求值的组数
+
+def panel_expression_configs(stock_configs: list) -> list:
+    """可以在面板上求值的表达式规则（日线；周线/月线先按各自周期聚合，仍逐组计算）"""
+    return [stock_config for stock_config in stock_configs
+            if stock_config['alert_type'] == 'expression' and stock_config.get('timeframe', 'daily') == 'daily']
+
+def evaluate_expression_panel(frames: dict, stock_configs: list) -> tuple:
+    """在多只股票的K线×股票面板上一次求出全部表达式规则的节点
+
+    frames为{标识: K线}，各股票按自身的K线轴右对齐堆叠（见stack_bars），停牌日不会留下NaN；
+    所有规则的表达式共用一个节点缓存，不同股票、不同规则中相同的子表达式在整个面板上只计算一次。
+    返回({标识: 该股票的节点缓存}, 求值节点数)，节点缓存的序列与该股票的K线逐行对应。
+    """
+    trees = list(dict.fromkeys(parse_expression(stock_config['expr']) for stock_config in stock_configs))
+    fields = set().union(*(expression_fields(tree) for tree in trees)) if trees else set()
+    keys, panels = [], {}
+    for field in sorted(fields) or ['close']:
+        keys, panels[field] = stack_bars(frames, field)
+    evaluator = ExpressionEvaluator(panels)
+    for tree in trees:
+        evaluator.evaluate(tree)
+    caches = {key: {} for key in keys}
+    for node, value in evaluator.cache.items():
+        for j, key in enumerate(keys):
+            # 面板各列前面是补齐的NaN，取最后len行即该股票自身的序列
+            caches[key][node] = value[len(value) - len(frames[key]):, j] if np.ndim(value) == 2 else value
+    return caches, evaluator.evaluations
+
+def prefill_expression_indicators(batch: list) -> int:
+    """batch为[(同组配置, K线, 该组的指标缓存)]，把这批组的日线表达式节点一次求出并写入各组的指标缓存
+
+    之后逐条判断时表达式直接命中缓存，不再逐只股票重复计算；面板求值失败时各组照常逐只计算。返回求值节点数。
+    """
+    frames = {i: df for i, (stock_configs, df, _) in enumerate(batch) if panel_expression_configs(stock_configs)}
+    if len(frames) < 2:
+        return 0
+    configs = [stock_config for i in frames for stock_config in panel_expression_configs(batch[i][0])]
+    try:
+        caches, evaluations = evaluate_expression_panel(frames, configs)
+    except Exception as e:
+        print(f"⚠️  表达式面板求值失败，改为逐只计算：{e}")
+        return 0
+    for i, cache in caches.items():
+        batch[i][2].setdefault(('daily', None, 'expression'), {}).update(cache)
+    return evaluations
+
+# ===================== 红利股息率 =====================
+# 分红记录按股票缓存在本地，只在历年分红公告日前后或有尚未实施的分红预案时才重新下载，
+# 其余时间沿用缓存，因此每次运行不需要逐只下载分红数据。
+DIVIDEND_DIR = os.path.join(DATA_CACHE_DIR, 'dividends')
+DIVIDEND_WINDOW_DAYS = 15           # 历年公告日前后多少天内视为公告期
+DIVIDEND_SEASON_REFRESH_DAYS = 7    # 公告期内的刷新间隔
+DIVIDEND_PENDING_REFRESH_DAYS = 2   # 有未实施预案时的刷新间隔
+DIVIDEND_MAX_AGE_DAYS = 90          # 其他时间的最长刷新间隔
+DIVIDEND_EMPTY_REFRESH_DAYS = 1     # 没有分红记录时的刷新间隔（避免把一次获取失败当作“从不分红”长期沿用）
+DIVIDEND_COLUMNS = ['announce_date', 'ex_date', 'cash', 'bonus_ratio', 'progress']
+DIVIDEND_LIGHTS = {1: '绿灯', 0: '黄灯', -1: '红灯'}
+
+def fetch_dividend_history(stock_code: str) -> pd.DataFrame:
+    """从新浪获取分红记录，换算为每股派息（元）和每股送转股比例；获取失败时返回None"""
+    raw = safe_get_data(ak.stock_history_dividend_detail, symbol=stock_code, indicator='分红')
+    if raw is None:
         return None
+    history = pd.DataFrame({
+        'announce_date': pd.to_datetime(raw['公告日期'], errors='coerce'),
+        'ex_date': pd.to_datetime(raw['除权除息日'], errors='coerce'),
+        # 新浪的送股、转增、派息均为每10股的数量
+        'cash': pd.to_numeric(raw['派息'], errors='coerce').fillna(0.0) / 10,
+        'bonus_ratio': (pd.to_numeric(raw['送股'], errors='coerce').fillna(0.0) + pd.to_numeric(raw['转增'], errors='coerce').fillna(0.0)) / 10,
+        'progress': raw['进度'].astype(str)
+    })
+    history = history[(history['cash'] > 0) | (history['bonus_ratio'] > 0)]
+    return history.dropna(subset=['announce_date']).sort_values('announce_date').reset_index(drop=True)
+
+def dividend_refresh_due(history: pd.DataFrame, fetched_at: datetime, now: datetime = None) -> bool:
+    """判断分红缓存是否需要刷新：有未实施预案、处在历年公告日前后或缓存过旧时刷新"""
+    now = now or datetime.now()
+    age = (now - fetched_at).days
+    if age >= DIVIDEND_MAX_AGE_DAYS:
+        return True
+    if history.empty:
+        return age >= DIVIDEND_EMPTY_REFRESH_DAYS
+    # 已公告但还没到除权除息日的预案，实施公告随时可能发布
+    today = pd.Timestamp(now.date())
+    pending = history['ex_date'].isna() | (history['ex_date'] >= today)
+    if pending.any() and age >= DIVIDEND_PENDING_REFRESH_DAYS:
+        return True
+    # 历年公告日（按月日）前后DIVIDEND_WINDOW_DAYS天内为公告期
+    announced = history['announce_date']
+    offset = (today.dayofyear - announced.dt.dayofyear).abs()
+    near = np.minimum(offset, 365 - offset) <= DIVIDEND_WINDOW_DAYS
+    return bool(near.any()) and age >= DIVIDEND_SEASON_REFRESH_DAYS
+
+def get_dividend_history(stock_code: str) -> pd.DataFrame:
+    """获取分红记录：优先使用本地缓存，按公告期规则刷新，下载失败时沿用旧缓存"""
+    dividend_file = os.path.join(DIVIDEND_DIR, f'{stock_code}.csv')
+    cached = None
+    if os.path.exists(dividend_file):
+        cached = pd.read_csv(dividend_file, parse_dates=['announce_date', 'ex_date'])
+        if not dividend_refresh_due(cached, datetime.fromtimestamp(os.path.getmtime(dividend_file))):
+            return cached
+
+    history = fetch_dividend_history(stock_code)
+    if history is None:
+        # 获取失败时不写缓存，下次运行重新获取
+        if cached is not None:
+            print(f"  ⚠️  {stock_code}分红记录更新失败，沿用本地缓存")
+            return cached
+        print(f"  ⚠️  {stock_code}分红记录获取失败")
+        return pd.DataFrame(columns=DIVIDEND_COLUMNS)
+
+    if not os.path.exists(DIVIDEND_DIR):
+        os.makedirs(DIVIDEND_DIR)
+    history.to_csv(dividend_file + '.tmp', index=False)
+    os.replace(dividend_file + '.tmp', dividend_file)
+    return history
+
+def dividend_yields(dates, closes, history: pd.DataFrame) -> dict:
+    """按未复权收盘价序列计算每根K线的滚动股息率和前瞻股息率（向量化）
+
+    滚动股息率：除权除息日在最近一年内的派息合计 / 收盘价；
+    前瞻股息率：公告日在最近一年内的派息合计（包含尚未实施的预案）/ 收盘价。
+    送转股会摊薄每股派息，所以派息先折算为最初每股的金额，再按当时的累计送转比例换算回当前每股。
+    """
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    closes = np.asarray(closes, dtype=float)
+    if history.empty:
+        zeros = np.zeros(len(dates))
+        return {'dividend_ttm': zeros, 'ttm_yield': zeros.copy(), 'forward_yield': zeros.copy()}
+
+    # 累计送转股倍数：shares(t) = 除权日不晚于t的所有(1+送转比例)之积
+    bonus = history[history['bonus_ratio'] > 0].dropna(subset=['ex_date']).sort_values('ex_date')
+    bonus_dates = bonus['ex_date'].to_numpy(dtype='datetime64[D]')
+    multiplier = np.concatenate([[1.0], np.cumprod(1.0 + bonus['bonus_ratio'].to_numpy(dtype=float))])
+
+    def shares(at, side='right'):
+        return multiplier[np.searchsorted(bonus_dates, at, side=side)]
+
+    def trailing_sum(event_dates, amounts):
+        """每根K线最近一年内（event_date属于(t-365, t]）的金额合计"""
+        order = np.argsort(event_dates)
+        event_dates, amounts = event_dates[order], amounts[order]
+        cumulative = np.concatenate([[0.0], np.cumsum(amounts)])
+        upper = np.searchsorted(event_dates, dates, side='right')
+        lower = np.searchsorted(event_dates, dates - np.timedelta64(365, 'D'), side='right')
+        return cumulative[upper] - cumulative[lower]
+
+    cash = history[history['cash'] > 0]
+    # 派息按除权除息日前一天的股本发放（同一天的送转不影响本次派息）
+    paid = cash.dropna(subset=['ex_date'])
+    paid_dates = paid['ex_date'].to_numpy(dtype='datetime64[D]')
+    paid_amounts = paid['cash'].to_numpy(dtype=float) * shares(paid_dates, side='left')
+    declared_dates = cash['announce_date'].to_numpy(dtype='datetime64[D]')
+    declared_amounts = cash['cash'].to_numpy(dtype=float) * shares(declared_dates)
+
+    current_shares = shares(dates)
+    dividend_ttm = trailing_sum(paid_dates, paid_amounts) / current_shares
+    declared = trailing_sum(declared_dates, declared_amounts) / current_shares
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'dividend_ttm': dividend_ttm,
+            'ttm_yield': dividend_ttm / closes,
+            'forward_yield': declared / closes
+        }
+
+def dividend_light(ttm_yield, percentile, stock_config: dict) -> np.ndarray:
+    """红绿灯状态：股息率水平和历史分位各投一票，1为绿灯、0为黄灯、-1为红灯"""
+    green_yield = stock_config.get('green_yield', 0.05)
+    red_yield = stock_config.get('red_yield', 0.03)
+    green_percentile = stock_config.get('green_percentile', 0.8)
+    red_percentile = stock_config.get('red_percentile', 0.2)
+    ttm_yield = np.asarray(ttm_yield, dtype=float)
+    percentile = np.asarray(percentile, dtype=float)
+    with np.errstate(invalid='ignore'):
+        score = (ttm_yield >= green_yield).astype(int) - (ttm_yield <= red_yield) \
+            + (percentile >= green_percentile) - (percentile <= red_percentile)
+    return np.sign(score)
+
+# ===================== 基准指数与相对强弱 =====================
+# 基准指数每个进程只下载一次；收盘后写入的本地缓存供分片和同一天后续运行复用，
+# 盘中运行需要当天未完成的指数K线与个股对齐，总是重新下载（本地缓存只保存已完成的K线）；
+# 相对强弱 = 个股收盘价 / 对齐到同一日期的基准收盘价，在日期×股票面板上一次相除得到。
+BENCHMARK_DIR = os.path.join(DATA_CACHE_DIR, 'benchmarks')
+BENCHMARK_ALIASES = {
+    '沪深300': 'sh000300',
+    '中证红利': 'sh000922',
+    '上证指数': 'sh000001',
+    '上证50': 'sh000016',
+    '中证500': 'sh000905',
+    '深证成指': 'sz399001',
+    '创业板指': 'sz399006'
+}
+# 配置了'benchmark'时改用相对强弱代替收盘价判断的预警类型
+BENCHMARK_RULES = {'golden_cross', 'three_above_ma', 'macd_cross', 'percentile_low', 'drawdown'}
+
+def benchmark_symbol(benchmark: str) -> str:
+    """基准名称或代码转换为带市场前缀的指数代码（399开头为深证指数，其余按上证/中证指数处理）"""
+    if benchmark in BENCHMARK_ALIASES:
+        return BENCHMARK_ALIASES[benchmark]
+    if benchmark[:2] in ('sh', 'sz'):
+        return benchmark
+    return f"{'sz' if benchmark.startswith('399') else 'sh'}{benchmark}"
+
+def fetch_benchmark(symbol: str) -> pd.DataFrame:
+    """下载指数日线收盘价（新浪，失败时改用东方财富），盘中包含当天未完成的K线"""
+    for func in (ak.stock_zh_index_daily, ak.stock_zh_index_daily_em):
+        bench = safe_get_data(func, symbol=symbol)
+        if bench is not None:
+            bench = bench[['date', 'close']].copy()
+            bench['date'] = pd.to_datetime(bench['date'])
+            bench['close'] = pd.to_numeric(bench['close'], errors='coerce')
+            return bench.dropna().sort_values('date').reset_index(drop=True)
+    return pd.DataFrame(columns=['date', 'close'])
+
+def _benchmark_cache_fresh(path: str) -> bool:
+    """本地缓存是今天收盘后写入的（已包含今天的完整K线）"""
+    modified = datetime.fromtimestamp(os.path.getmtime(path))
+    return modified.date() == datetime.now().date() and modified.strftime('%H:%M') >= MARKET_CLOSE_TIME
+
+_benchmarks = {}
+_benchmarks_lock = threading.Lock()
+
+def get_benchmark(benchmark: str) -> pd.DataFrame:
+    """获取基准指数收盘价（date、close），同一进程内只下载一次，下载失败时沿用旧缓存"""
+    symbol = benchmark_symbol(benchmark)
+    with _benchmarks_lock:
+        if symbol in _benchmarks:
+            return _benchmarks[symbol]
+        
+        benchmark_file = os.path.join(BENCHMARK_DIR, f'{symbol}.csv')
+        if os.path.exists(benchmark_file) and _benchmark_cache_fresh(benchmark_file):
+            bench = pd.read_csv(benchmark_file, parse_dates=['date'])
+        else:
+            bench = fetch_benchmark(symbol)
+            if bench.empty and os.path.exists(benchmark_file):
+                print(f"  ⚠️  基准{benchmark}更新失败，沿用本地缓存（缺少今天的指数K线时最新一根的相对强弱为空）")
+                bench = pd.read_csv(benchmark_file, parse_dates=['date'])
+            elif not bench.empty:
+                if not os.path.exists(BENCHMARK_DIR):
+                    os.makedirs(BENCHMARK_DIR)
+                _complete_bars(bench).to_csv(benchmark_file + '.tmp', index=False)
+                os.replace(benchmark_file + '.tmp', benchmark_file)
+        
+        _benchmarks[symbol] = bench
+        return bench
+
+def clear_benchmark_memo():
+    """清空进程内的基准指数缓存，下次使用时重新获取（长时间运行的查询服务定期调用）"""
+    with _benchmarks_lock:
+        _benchmarks.clear()
+
+def align_benchmark(dates, bench: pd.DataFrame) -> np.ndarray:
+    """把基准收盘价对齐到给定日期：取不晚于该日的最近收盘价，基准最后日期之后为NaN"""
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    aligned = np.full(len(dates), np.nan)
+    if bench.empty:
+        return aligned
+    bench_dates = bench['date'].to_numpy(dtype='datetime64[ns]')
+    position = np.searchsorted(bench_dates, dates, side='right') - 1
+    valid = (position >= 0) & (dates <= bench_dates[-1])
+    aligned[valid] = bench['close'].to_numpy(dtype=float)[position[valid]]
+    return aligned
+
+def relative_strength_panel(dates, panel, bench: pd.DataFrame) -> np.ndarray:
+    """日期×股票收盘价面板除以对齐后的基准收盘价，每列以第一个有效值归一为1"""
+    x = _as_panel(panel)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = x / align_benchmark(dates, bench)[:, None]
+    if len(ratio):
+        first = np.argmax(~np.isnan(ratio), axis=0)
+        ratio = ratio / ratio[first, np.arange(ratio.shape[1])]
+    return _restore_shape(ratio, panel)
+
+def excess_return(relative, period: int) -> np.ndarray:
+    """最近period根K线相对基准的超额收益：(1+个股涨幅)/(1+基准涨幅)-1 = 相对强弱的period根涨幅"""
+    x = _as_panel(relative)
+    result = np.full(x.shape, np.nan)
+    if period < len(x):
+        result[period:] = x[period:] / x[:-period] - 1.0
+    return _restore_shape(result, relative)
+
+def relative_to_benchmark(df: pd.DataFrame, benchmark: str) -> pd.DataFrame:
+    """用相对强弱代替收盘价（原收盘价保存在price列），供均线、MACD、分位等规则直接使用"""
+    df = df.copy()
+    bench = get_benchmark(benchmark)
+    df['price'] = df['close']
+    df['benchmark_close'] = align_benchmark(df['date'].to_numpy(), bench)
+    df['close'] = relative_strength_panel(df['date'].to_numpy(), df['close'].to_numpy(dtype=float), bench)
+    return df
+
+# ===================== 板块/篮子宽度 =====================
+# 篮子可以是自定义成分（'members'）、东方财富行业板块（'board'）或指数成分股（'index'）。
+# 成分股K线并发获取后对齐为面板，站上均线比例、当日上穿数量等宽度指标对整个面板做一次归约得到；
+# 同一次运行中多个篮子共用的成分股只获取一次。
+BASKET_DIR = os.path.join(DATA_CACHE_DIR, 'baskets')
+BASKET_RULES = {'basket_breadth', 'three_carriers_above_ma'}
+BASKET_DETAIL_LIMIT = 30  # 成分股不超过此数量时在邮件中列出明细
+
+def basket_config(stock_config: dict) -> dict:
+    """篮子规则的完整参数；旧的三大运营商配置换算为“全部成分站上均线”的篮子规则，
+    并保持原来的触发方式：全部站上均线期间每次运行都预警（而不是只在首次站上时预警）"""
+    if stock_config['alert_type'] == 'three_carriers_above_ma':
+        return {**stock_config, 'members': stock_config['carriers'], 'metric': 'pct_above_ma',
+                'threshold': 1.0, 'min_coverage': 1.0, 'trigger': 'level'}
+    return stock_config
+
+def _fetch_basket_members(stock_config: dict) -> pd.DataFrame:
+    """下载行业板块或指数的成分股列表（code、name）"""
+    if stock_config.get('board'):
+        members = safe_get_data(ak.stock_board_industry_cons_em, symbol=stock_config['board'])
+        columns = {'代码': 'code', '名称': 'name'}
+    else:
+        members = safe_get_data(ak.index_stock_cons_csindex, symbol=stock_config['index'])
+        columns = {'成分券代码': 'code', '成分券名称': 'name'}
+    if members is None:
+        return pd.DataFrame(columns=['code', 'name'])
+    members = members.rename(columns=columns)[['code', 'name']]
+    members['code'] = members['code'].astype(str).str.zfill(6)
+    return members.drop_duplicates('code').reset_index(drop=True)
+
+def get_basket_members(stock_config: dict) -> list:
+    """篮子成分股列表[{'name', 'code'}]：板块和指数成分按天缓存，下载失败时沿用旧缓存"""
+    stock_config = basket_config(stock_config)
+    if stock_config.get('members'):
+        return [{'name': member['name'], 'code': str(member['code'])} for member in stock_config['members']]
+
+    key = f"board_{stock_config['board']}" if stock_config.get('board') else f"index_{stock_config['index']}"
+    member_file = os.path.join(BASKET_DIR, f'{key}.csv')
+    cached = pd.DataFrame(columns=['code', 'name'])
+    if os.path.exists(member_file):
+        cached = pd.read_csv(member_file, dtype={'code': str})
+        if datetime.fromtimestamp(os.path.getmtime(member_file)).strftime('%Y%m%d') == TODAY_DATE:
+            return cached.to_dict('records')
+
+    members = _fetch_basket_members(stock_config)
+    if members.empty:
+        if not cached.empty:
+            print(f"  ⚠️  {stock_config['name']}成分股更新失败，沿用本地缓存")
+        return cached.to_dict('records')
+
+    if not os.path.exists(BASKET_DIR):
+        os.makedirs(BASKET_DIR)
+    members.to_csv(member_file + '.tmp', index=False)
+    os.replace(member_file + '.tmp', member_file)
+    return members.to_dict('records')
+
+_member_frames = {}
+_member_frames_lock = threading.Lock()
+
+def get_member_data(stock_code: str, stock_name: str) -> pd.DataFrame:
+    """获取成分股K线，同一进程内多个篮子共用的成分股只获取一次"""
+    with _member_frames_lock:
+        event = _member_frames.get(stock_code)
+        owner = event is None
+        if owner:
+            event = _member_frames[stock_code] = {'ready': threading.Event(), 'df': pd.DataFrame()}
+    if owner:
+        try:
+            event['df'] = get_stock_data(stock_code, stock_name)
+        finally:
+            event['ready'].set()
+    event['ready'].wait()
+    return event['df']
+
+def clear_member_frames():
+    """清空进程内的成分股K线缓存（正在获取的成分股不受影响，等待方仍持有原结果）"""
+    with _member_frames_lock:
+        _member_frames.clear()
+
+def fetch_basket_frames(members: list) -> dict:
+    """并发获取全部成分股K线，获取失败的成分股跳过"""
+    frames = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS)) as pool:
+        futures = {pool.submit(get_member_data, member['code'], member['name']): member for member in members}
+        for future in concurrent.futures.as_completed(futures):
+            member = futures[future]
+            try:
+                df = future.result()
+            except Exception as e:
+                print(f"  ❌ {member['name']}({member['code']})获取失败：{e}")
+                continue
+            if df is None or df.empty:
+                print(f"  ❌ 未获取到{member['name']}({member['code']})数据")
+                continue
+            frames[member['code']] = df
+    return frames
+
+def _ffill_panel(panel: np.ndarray) -> np.ndarray:
+    """面板按列向前填充（停牌日沿用最近收盘价），上市前保持NaN"""
+    index = np.where(np.isnan(panel), 0, np.arange(len(panel))[:, None])
+    index = np.maximum.accumulate(index, axis=0)
+    return np.take_along_axis(panel, index, axis=0)
+
+def basket_breadth(frames: dict, ma_line: int) -> tuple:
+    """成分股面板上的宽度指标，返回(宽度序列DataFrame, 最后一根的成分明细)
+
+    宽度序列包含：等权篮子指数close、有效成分数、站上均线数量和比例、当日上穿/跌破均线数量。
+    """
+    dates, codes, close = build_panel(frames, 'close')
+    close = _ffill_panel(close)
+    ma = _as_panel(sma(close, ma_line))
+    valid = ~np.isnan(ma)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        above = (close > ma) & valid
+        member_count = valid.sum(axis=1)
+        above_count = above.sum(axis=1)
+        # 等权篮子指数：各成分当日涨跌幅的平均值累乘
+        returns = np.vstack([np.full((1, close.shape[1]), np.nan), close[1:] / close[:-1] - 1])
+        traded = ~np.isnan(returns)
+        mean_return = np.where(traded.any(axis=1), np.nansum(returns, axis=1) / np.maximum(traded.sum(axis=1), 1), 0.0)
+        breadth = pd.DataFrame({
+            'date': pd.to_datetime(dates),
+            'close': np.cumprod(1 + mean_return),
+            'member_count': member_count,
+            'above_count': above_count,
+            'pct_above': np.where(member_count > 0, above_count / np.maximum(member_count, 1), np.nan),
+            'new_crosses': crosses_above(close, ma).sum(axis=1),
+            'new_breakdowns': crosses_below(close, ma).sum(axis=1)
+        })
+    details = [
+        {'name': frames[code]['name'].iloc[-1] if 'name' in frames[code].columns else code, 'code': code,
+         'close': close[-1, j], f'ma{ma_line}': ma[-1, j], 'above_ma': bool(above[-1, j])}
+        for j, code in enumerate(codes)
+    ] if len(dates) else []
+    return breadth, details
+
+def get_basket_data(stock_config: dict) -> pd.DataFrame:
+    """获取篮子宽度序列（作为篮子规则的“K线”进入流水线），成分明细保存在attrs中"""
+    stock_config = basket_config(stock_config)
+    members = get_basket_members(stock_config)
+    if not members:
+        print(f"❌ {stock_config['name']}没有成分股")
+        return pd.DataFrame()
+    names = {member['code']: member['name'] for member in members}
+    frames = fetch_basket_frames(members)
+    for code, df in frames.items():
+        frames[code] = df.assign(name=names[code])
+    breadth, details = basket_breadth(frames, stock_config.get('ma_line', 20))
+    breadth.attrs['members'] = details
+    breadth.attrs['configured_members'] = len(members)
+    return breadth
+
+# 按历史日期判断（--as-of）：只使用该日期及之前的数据，None为使用最新数据
+AS_OF_DATE = None
+
+# 长窗口规则需要的历史K线数超过DATA_START_DATE能提供的数量时，数据起始日期按窗口向前推
+HISTORY_WINDOW_RULES = {'percentile_low', 'dividend_yield'}
+TIMEFRAME_DAILY_BARS = {'daily': 1, 'weekly': 5, 'monthly': 21}  # 每根K线对应的交易日数
+TRADING_DAYS_PER_YEAR = 240
+
+def rule_history_bars(stock_config: dict) -> int:
+    """规则需要的日线数量（只计算长窗口规则，其余规则DATA_START_DATE起的数据已足够）"""
+    if stock_config['alert_type'] not in HISTORY_WINDOW_RULES:
+        return 0
+    return stock_config.get('window', 750) * TIMEFRAME_DAILY_BARS.get(stock_config.get('timeframe', 'daily'), 1)
+
+def history_start_date(stock_configs: list) -> str:
+    """一组共用数据的配置需要的数据起始日期：DATA_START_DATE与最长窗口向前推算日期中较早者"""
+    bars = max((rule_history_bars(stock_config) for stock_config in stock_configs), default=0)
+    if not bars:
+        return DATA_START_DATE
+    # 按每年约240个交易日换算为自然日，多留一个月余量
+    end = AS_OF_DATE if AS_OF_DATE is not None else pd.Timestamp(datetime.now().date())
+    start = (end - pd.Timedelta(days=int(bars * 365 / TRADING_DAYS_PER_YEAR) + 30)).strftime('%Y%m%d')
+    return min(start, DATA_START_DATE)
+
+def get_rule_data(stock_config: dict, stock_configs: list = None) -> pd.DataFrame:
+    """获取预警规则所需的数据：个股规则为K线，篮子规则为成分股宽度序列
+
+    stock_configs为共用这份数据的全部配置，历史长度按其中窗口最长的规则确定。
+    """
+    if stock_config['alert_type'] in BASKET_RULES:
+        df = get_basket_data(stock_config)
+    else:
+        start_date = history_start_date(stock_configs or [stock_config])
+        df = get_stock_data(stock_config['code'], stock_config['name'], config_adjust(stock_config), start_date)
+    if AS_OF_DATE is not None and not df.empty:
+        df = df[df['date'] <= AS_OF_DATE].reset_index(drop=True)
+    return df
+
+# ===================== 均线计算和预警判断 =====================
+def warn_short_history(stock_config: dict, bars: int, window: int):
+    """K线数量不足窗口长度时提示（上市时间较短或历史数据获取不完整），此时分位为空，规则不会触发"""
+    if bars < window:
+        print(f"  ⚠️  {stock_config['name']}({stock_config['code']})只有{bars}根K线，不足窗口{window}根，分位无法计算")
+
+def calculate_ma_and_check_alert(df: pd.DataFrame, stock_config: dict, indicators: dict = None) -> dict:
+    """计算均线并检查预警信号，indicators为同一份数据上多条规则共用的指标缓存"""
+    if df.empty:
+        return {
+            'has_alert': False,
+            'alert_type': None,
+            'latest_data': None,
+            'df': pd.DataFrame()
+        }
+    
+    df = df.copy()
+    alert_type = stock_config['alert_type']
+    timeframe = stock_config.get('timeframe', 'daily')
+    unit = timeframe_unit(stock_config)
+    
+    # 周线/月线规则：由日线聚合得到对应周期的K线（篮子规则的宽度序列只支持日线）
+    if timeframe != 'daily' and alert_type not in BASKET_RULES:
+        df = get_timeframe_bars(stock_config['code'], df, timeframe).copy()
+    
+    # 相对基准规则：用个股与基准指数的相对强弱代替收盘价判断
+    benchmark = stock_config.get('benchmark') if alert_type in BENCHMARK_RULES else None
+    if benchmark:
+        df = relative_to_benchmark(df, benchmark)
+    
+    def shared(spec, compute):
+        """共用的指标只计算一次，键包含周期和基准，不同口径的序列不会混用"""
+        if indicators is None:
+            return compute()
+        key = (timeframe, benchmark) + spec
+        if key not in indicators:
+            indicators[key] = compute()
+        return indicators[key]
     
     if alert_type == 'golden_cross':
-        # 金叉预警图表
+        # 金叉预警逻辑
         ma_short = stock_config['ma_short']
         ma_long = stock_config['ma_long']
         
-        # 过滤掉均线数据不足的行
-        plot_df = df.dropna(subset=[f'ma{ma_short}', f'ma{ma_long}']).copy()
-        
-        if plot_df.empty:
-            return None
-        
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
-        
-        # 图1：股价和均线
-        ax1.plot(plot_df["date"], plot_df["close"], 
-                 color="#2ca02c", linewidth=1.5, label="收盘价")
-        ax1.plot(plot_df["date"], plot_df[f'ma{ma_short}'], 
-                 color="#ff7f0e", linewidth=1.5, label=f"{ma_short}日均线")
-        ax1.plot(plot_df["date"], plot_df[f'ma{ma_long}'], 
-                 color="#d62728", linewidth=1.5, label=f"{ma_long}日均线")
+        # 计算均线
+        df[f'ma{ma_short}'] = shared(('sma', ma_short), lambda: sma(df['close'].to_numpy(dtype=float), ma_short))
+        df[f'ma{ma_long}'] = shared(('sma', ma_long), lambda: sma(df['close'].to_numpy(dtype=float), ma_long))
         
-        # 标记金叉点
-        golden_crosses = plot_df[plot_df['golden_cross']]
-        if not golden_crosses.empty:
-            # 只添加一次图例
-            ax1.scatter(golden_crosses.iloc[0]['date'], golden_crosses.iloc[0][f'ma{ma_short}'], 
-                       color='gold', s=200, marker='^', zorder=5, label='金叉')
-            ax1.annotate('金叉', xy=(golden_crosses.iloc[0]['date'], golden_crosses.iloc[0][f'ma{ma_short}']), 
-                        xytext=(10, 10), textcoords='offset points',
-                        fontsize=10, color='gold', fontweight='bold')
-            # 绘制其他点但不添加图例
-            if len(golden_crosses) > 1:
-                for _, row in golden_crosses.iloc[1:].iterrows():
-                    ax1.scatter(row['date'], row[f'ma{ma_short}'], 
-                               color='gold', s=200, marker='^', zorder=5)
-                    ax1.annotate('金叉', xy=(row['date'], row[f'ma{ma_short}']), 
-                                xytext=(10, 10), textcoords='offset points',
-                                fontsize=10, color='gold', fontweight='bold')
+        # 计算均线差值
+        df['ma_diff'] = df[f'ma{ma_short}'] - df[f'ma{ma_long}']
         
-        ax1.set_ylabel("价格", fontsize=12)
-        ax1.set_title(f"{stock_name} - {ma_short}日均线 vs {ma_long}日均线", 
-                      fontsize=14, fontweight="bold")
-        ax1.grid(True, alpha=0.3)
-        ax1.legend(loc="upper left", fontsize=10)
+        # 检查上穿信号（金叉）
+        # 条件：昨天 ma_short <= ma_long，今天 ma_short > ma_long
+        df['golden_cross'] = crosses_above(df['ma_diff'].to_numpy(dtype=float), 0.0)
         
-        # 图2：均线差值
-        ax2.plot(plot_df["date"], plot_df['ma_diff'], 
-                 color="#9467bd", linewidth=1.5, label="均线差值")
-        ax2.axhline(y=0, color="#2ca02c", linestyle="--", linewidth=1, alpha=0.7)
+        # 获取最新数据
+        latest_row = df.iloc[-1]
         
-        # 标记金叉点
-        for _, row in golden_crosses.iterrows():
-            ax2.scatter(row['date'], row['ma_diff'], 
-                       color='gold', s=200, marker='^', zorder=5)
-            ax2.annotate('金叉', xy=(row['date'], row['ma_diff']), 
-                        xytext=(10, 10), textcoords='offset points',
-                        fontsize=10, color='gold', fontweight='bold')
+        # 检查是否有预警信号（within_bars > 1 时最近几根内出现过金叉也提醒）
+        within = stock_config.get('within_bars', 1)
+        has_alert = latest_row['golden_cross'] if within <= 1 else bool(within_bars(df['golden_cross'].to_numpy(), within)[-1])
+        alert_name = f'{timeframe_label(stock_config)}金叉预警' if has_alert else None
         
-        ax2.set_ylabel("均线差值", fontsize=12)
-        ax2.set_xlabel("日期", fontsize=12)
-        ax2.set_title(f"{stock_name} - 均线差值（正数表示{ma_short}日均线在{ma_long}日均线之上）", 
-                      fontsize=12, fontweight="bold")
-        ax2.grid(True, alpha=0.3)
-        ax2.legend(loc="upper left", fontsize=10)
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            f'ma{ma_short}': latest_row[f'ma{ma_short}'],
+            f'ma{ma_long}': latest_row[f'ma{ma_long}'],
+            'ma_diff': latest_row['ma_diff']
+        }
         
     elif alert_type == 'three_above_ma':
-        # 连续三根k线站上20日均线预警图表
+        # 连续N根k线站上均线预警逻辑（N默认为3）
         ma_line = stock_config['ma_line']
+        bars = stock_config.get('consecutive_bars', 3)
         
-        # 过滤掉均线数据不足的行
-        plot_df = df.dropna(subset=[f'ma{ma_line}']).copy()
+        # 计算均线
+        df[f'ma{ma_line}'] = shared(('sma', ma_line), lambda: sma(df['close'].to_numpy(dtype=float), ma_line))
         
-        if plot_df.empty:
-            return None
+        # 检查收盘价是否站在均线上方
+        df['above_ma'] = df['close'] > df[f'ma{ma_line}']
         
-        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
+        # 连续站上均线的根数（游程计数）
+        df['consecutive_above_ma'] = streak_length(df['above_ma'].to_numpy())
         
-        # 图1：股价和均线
-        ax1.plot(plot_df["date"], plot_df["close"], 
-                 color="#2ca02c", linewidth=1.5, label="收盘价")
-        ax1.plot(plot_df["date"], plot_df[f'ma{ma_line}'], 
-                 color="#d62728", linewidth=2, label=f"{ma_line}日均线")
+        # 连续N根都站在均线上方
+        df['three_above_ma'] = df['consecutive_above_ma'] >= bars
         
-        # 标记站上均线的点
-        above_ma_points = plot_df[plot_df['above_ma']]
-        if not above_ma_points.empty:
-            # 只添加一次图例
-            ax1.scatter(above_ma_points.iloc[0]['date'], above_ma_points.iloc[0]['close'], 
-                       color='green', s=50, marker='o', zorder=5, label='站在均线上方')
-            # 绘制其他点但不添加图例
-            if len(above_ma_points) > 1:
-                for _, row in above_ma_points.iloc[1:].iterrows():
-                    ax1.scatter(row['date'], row['close'], 
-                               color='green', s=50, marker='o', zorder=5)
+        # 第一次出现连续N根（连续根数恰好达到N）
+        df['first_three_above_ma'] = df['consecutive_above_ma'] == bars
         
-        # 标记第一次出现连续三根站上均线的点
-        if 'first_three_above_ma' in plot_df.columns:
-            three_above_ma_points = plot_df[plot_df['first_three_above_ma']]
-        else:
-            three_above_ma_points = plot_df[plot_df['three_above_ma']]
+        # 获取最新数据
+        latest_row = df.iloc[-1]
         
-        if not three_above_ma_points.empty:
-            # 只添加一次图例
-            ax1.scatter(three_above_ma_points.iloc[0]['date'], three_above_ma_points.iloc[0]['close'], 
-                       color='gold', s=200, marker='^', zorder=6, label='连续三根站上均线')
-            ax1.annotate('连续三根', xy=(three_above_ma_points.iloc[0]['date'], three_above_ma_points.iloc[0]['close']), 
-                        xytext=(10, 10), textcoords='offset points',
-                        fontsize=10, color='gold', fontweight='bold')
-            # 绘制其他点但不添加图例
-            if len(three_above_ma_points) > 1:
-                for _, row in three_above_ma_points.iloc[1:].iterrows():
-                    ax1.scatter(row['date'], row['close'], 
-                               color='gold', s=200, marker='^', zorder=6)
-                    ax1.annotate('连续三根', xy=(row['date'], row['close']), 
-                                xytext=(10, 10), textcoords='offset points',
-                                fontsize=10, color='gold', fontweight='bold')
+        # 检查是否有预警信号（只在第一次出现连续N根时触发）
+        has_alert = latest_row['first_three_above_ma']
+        alert_name = f'连续{count_label(bars)}根{timeframe_label(stock_config) or "k线"}站上{ma_line}{unit}均线预警' if has_alert else None
         
-        ax1.set_ylabel("价格", fontsize=12)
-        ax1.set_title(f"{stock_name} - 收盘价 vs {ma_line}日均线", 
-                      fontsize=14, fontweight="bold")
-        ax1.grid(True, alpha=0.3)
-        ax1.legend(loc="upper left", fontsize=10)
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            f'ma{ma_line}': latest_row[f'ma{ma_line}'],
+            'consecutive_above_ma': int(latest_row['consecutive_above_ma'])
+        }
+    
+    elif alert_type == 'macd_cross':
+        # MACD金叉预警逻辑：DIF上穿DEA
+        fast = stock_config.get('fast', 12)
+        slow = stock_config.get('slow', 26)
+        signal = stock_config.get('signal', 9)
         
-        # 图2：连续站上均线天数
-        ax2.plot(plot_df["date"], plot_df['consecutive_above_ma'], 
-                 color="#9467bd", linewidth=1.5, label="连续站上均线天数")
-        ax2.axhline(y=3, color="#d62728", linestyle="--", linewidth=1, alpha=0.7, label="预警阈值（3天）")
+        result = shared(('macd', fast, slow, signal), lambda: macd(df['close'].to_numpy(dtype=float), fast, slow, signal))
+        df['dif'] = result['dif']
+        df['dea'] = result['dea']
+        df['macd'] = result['macd']
+        df['macd_cross'] = crosses_above(result['dif'], result['dea'])
         
-        # 标记第一次出现连续三根站上均线的点
-        for _, row in three_above_ma_points.iterrows():
-            ax2.scatter(row['date'], row['consecutive_above_ma'], 
-                       color='gold', s=200, marker='^', zorder=5)
-            ax2.annotate('预警', xy=(row['date'], row['consecutive_above_ma']), 
-                        xytext=(10, 10), textcoords='offset points',
-                        fontsize=10, color='gold', fontweight='bold')
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['macd_cross']
+        alert_name = f'{timeframe_label(stock_config)}MACD金叉预警' if has_alert else None
         
-        ax2.set_ylabel("连续站上均线天数", fontsize=12)
-        ax2.set_xlabel("日期", fontsize=12)
-        ax2.set_title(f"{stock_name} - 连续站上{ma_line}日均线天数", 
-                      fontsize=12, fontweight="bold")
-        ax2.grid(True, alpha=0.3)
-        ax2.legend(loc="upper left", fontsize=10)
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'dif': latest_row['dif'],
+            'dea': latest_row['dea'],
+            'macd': latest_row['macd']
+        }
     
-    elif alert_type == 'three_carriers_above_ma':
-        # 三个运营商都站在20日均线上方预警图表
-        ma_line = stock_config['ma_line']
-        carriers = stock_config['carriers']
-        
-        # 创建一个简单的表格图表
-        fig, ax = plt.subplots(figsize=(12, 8))
-        ax.axis('tight')
-        ax.axis('off')
-        
-        # 构建表格数据
-        table_data = []
-        for carrier in carriers:
-            carrier_name = carrier['name']
-            carrier_code = carrier['code']
-            
-            # 获取运营商股票数据
-            carrier_df = get_stock_data(carrier_code, carrier_name)
-            
-            if carrier_df.empty:
-                table_data.append([carrier_name, carrier_code, 'N/A', 'N/A', 'N/A'])
-            else:
-                # 计算20日均线
-                carrier_df[f'ma{ma_line}'] = carrier_df['close'].rolling(window=ma_line).mean()
-                
-                # 获取最新数据
-                latest_carrier_row = carrier_df.iloc[-1]
-                latest_close = latest_carrier_row['close']
-                latest_ma = latest_carrier_row[f'ma{ma_line}']
-                above_ma = latest_close > latest_ma
-                status = '✓ 站在上方' if above_ma else '✗ 站在下方'
-                status_color = 'green' if above_ma else 'red'
-                
-                table_data.append([carrier_name, carrier_code, f'{latest_close:.2f}', f'{latest_ma:.2f}', status])
-        
-        # 创建表格
-        table = ax.table(cellText=table_data, 
-                       colLabels=['运营商名称', '股票代码', '最新收盘价', f'{ma_line}日均线', '状态'],
-                       colWidths=[0.2, 0.15, 0.15, 0.15, 0.35],
-                       cellLoc='center',
-                       loc='center')
-        
-        # 设置表格样式
-        table.auto_set_font_size(False)
-        table.set_fontsize(10)
-        table.scale(1, 1.5)
-        
-        # 设置标题
-        ax.set_title(f"三大运营商 - 20日均线状态检查", 
-                     fontsize=14, fontweight="bold", pad=20)
-        
-        # 添加说明文字
-        plt.figtext(0.5, 0.1, f"检查时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n预警条件：三个运营商都站在20日均线上方",
-                    ha="center", fontsize=10, color="gray")
+    elif alert_type == 'percentile_low':
+        # 低分位预警逻辑：收盘价进入最近window根的低位区间（默认3年底部10%）
+        window = stock_config.get('window', 750)
+        threshold = stock_config.get('threshold', 0.10)
+        closes = df['close'].to_numpy(dtype=float)
+        warn_short_history(stock_config, len(df), window)
+        
+        method = stock_config.get('method', 'rank')
+        df['percentile'] = shared(('percentile', window, method), lambda: range_position(closes, window) if method == 'range' else rolling_percentile(closes, window))
+        df['window_high'] = shared(('rolling_max', window), lambda: rolling_max(closes, window))
+        df['window_low'] = shared(('rolling_min', window), lambda: rolling_min(closes, window))
+        # 只在第一次进入低位区间时触发
+        df['percentile_low'] = streak_start(df['percentile'].to_numpy() <= threshold, 1)
+        
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['percentile_low']
+        alert_name = f'{timeframe_label(stock_config)}低分位预警' if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'percentile': latest_row['percentile'],
+            'window_high': latest_row['window_high'],
+            'window_low': latest_row['window_low']
+        }
     
-    # 格式化日期
-    if alert_type != 'three_carriers_above_ma':
-        for ax in [ax1, ax2]:
-            fig.autofmt_xdate()
+    elif alert_type == 'drawdown':
+        # 回撤预警逻辑：收盘价相对window根内最高收盘价回撤超过threshold
+        window = stock_config.get('window', 250)
+        threshold = stock_config.get('threshold', 0.20)
+        closes = df['close'].to_numpy(dtype=float)
+        
+        df['window_high'] = shared(('rolling_max', window), lambda: rolling_max(closes, window))
+        df['drawdown'] = closes / df['window_high'].to_numpy() - 1.0
+        # 只在回撤第一次超过阈值时触发
+        df['drawdown_alert'] = streak_start(df['drawdown'].to_numpy() <= -threshold, 1)
+        
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['drawdown_alert']
+        alert_name = f'{timeframe_label(stock_config)}回撤预警' if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'window_high': latest_row['window_high'],
+            'drawdown': latest_row['drawdown']
+        }
     
-    try:
-        plt.tight_layout()
-    except Exception as e:
-        print(f"  ⚠️  图表布局警告：{e}")
+    elif alert_type == 'dividend_yield':
+        # 股息率红绿灯预警逻辑：使用未复权价格和本地缓存的分红记录
+        window = stock_config.get('window', 750)
+        alert_states = [state for state, light in DIVIDEND_LIGHTS.items() if light in stock_config.get('alert_lights', ['绿灯'])]
+        warn_short_history(stock_config, len(df), window)
+        
+        yields = dividend_yields(df['date'].to_numpy(), df['close'].to_numpy(dtype=float), get_dividend_history(stock_config['code']))
+        df['dividend_ttm'] = yields['dividend_ttm']
+        df['ttm_yield'] = yields['ttm_yield']
+        df['forward_yield'] = yields['forward_yield']
+        # 股息率越高分位越高，高分位代表价格相对分红处于历史低位
+        df['yield_percentile'] = rolling_percentile(df['ttm_yield'].to_numpy(), window)
+        df['dividend_light'] = dividend_light(df['ttm_yield'], df['yield_percentile'], stock_config)
+        # 只在红绿灯第一次切换到关注的颜色时触发
+        df['dividend_alert'] = streak_start(np.isin(df['dividend_light'].to_numpy(), alert_states), 1)
+        
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['dividend_alert']
+        light = DIVIDEND_LIGHTS[int(latest_row['dividend_light'])]
+        alert_name = f'股息率{light}预警' if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'dividend_ttm': latest_row['dividend_ttm'],
+            'ttm_yield': latest_row['ttm_yield'],
+            'forward_yield': latest_row['forward_yield'],
+            'yield_percentile': latest_row['yield_percentile'],
+            'light': light
+        }
     
-    # 保存图片
-    latest_date = df.iloc[-1]["date"].strftime("%Y%m%d")
-    alert_status = "预警" if has_alert else "正常"
-    save_path = os.path.join(PICTURE_DIR, f"{stock_name}_均线预警_{latest_date}_{alert_status}.png")
+    elif alert_type == 'relative_strength':
+        # 跑赢基准预警逻辑：最近period根K线相对基准的超额收益超过threshold
+        period = stock_config.get('period', 20)
+        threshold = stock_config.get('threshold', 0.0)
+        bench = get_benchmark(stock_config.get('benchmark', '沪深300'))
+        
+        df['benchmark_close'] = align_benchmark(df['date'].to_numpy(), bench)
+        df['relative_strength'] = relative_strength_panel(df['date'].to_numpy(), df['close'].to_numpy(dtype=float), bench)
+        df['excess_return'] = excess_return(df['relative_strength'].to_numpy(), period)
+        df['stock_return'] = df['close'] / df['close'].shift(period) - 1
+        df['benchmark_return'] = df['benchmark_close'] / df['benchmark_close'].shift(period) - 1
+        # 只在第一次跑赢时触发
+        df['outperform'] = streak_start(df['excess_return'].to_numpy() > threshold, 1)
+        
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['outperform']
+        alert_name = f"跑赢{stock_config.get('benchmark', '沪深300')}预警" if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'benchmark_close': latest_row['benchmark_close'],
+            'stock_return': latest_row['stock_return'],
+            'benchmark_return': latest_row['benchmark_return'],
+            'excess_return': latest_row['excess_return']
+        }
     
-    try:
-        plt.savefig(save_path, bbox_inches='tight', pad_inches=0.1)
-        plt.close()
+    elif alert_type == 'expression':
+        # 表达式预警逻辑：条件由成立变为成立的那根K线触发（for N bars 即连续N根首次成立）
+        tree = parse_expression(stock_config['expr'])
+        cache = indicators.setdefault((timeframe, benchmark, 'expression'), {}) if indicators is not None else {}
+        evaluator = ExpressionEvaluator({field: df[field].to_numpy(dtype=float) for field in expression_fields(tree)}, cache)
+        condition = np.broadcast_to(evaluator.evaluate(tree), (len(df),))
+        df['condition'] = condition.astype(float)
+        df['expression_alert'] = streak_start(condition, 1)
+        for node in expression_indicators(tree):
+            df[expression_text(node)] = evaluator.evaluate(node)
         
-        print(f"  ✅ {stock_name}预警图表已保存：{save_path}")
-        return save_path
-    except Exception as e:
-        print(f"  ❌ 图表保存失败：{e}")
-        plt.close()
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['expression_alert']
+        alert_name = f"{timeframe_label(stock_config)}{stock_config.get('title', '表达式')}预警" if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            **{expression_text(node): latest_row[expression_text(node)] for node in expression_indicators(tree)}
+        }
+    
+    elif alert_type in BASKET_RULES:
+        # 篮子宽度预警逻辑：df为成分股宽度序列（站上均线比例或当日上穿均线数量）
+        config = basket_config(stock_config)
+        ma_line = config.get('ma_line', 20)
+        metric = config.get('metric', 'pct_above_ma')
+        threshold = config.get('threshold', 0.8 if metric == 'pct_above_ma' else 1)
+        members = df.attrs.get('members', [])
+        configured = df.attrs.get('configured_members', len(members)) or 1
+        
+        # 有效成分占比不足时不判断（例如部分成分股获取失败）
+        covered = df['member_count'].to_numpy() >= config.get('min_coverage', 0.9) * configured
+        if metric == 'new_crosses':
+            df['breadth_alert'] = covered & (df['new_crosses'].to_numpy() >= threshold)
+        else:
+            if config.get('direction', 'above') == 'below':
+                condition = covered & (df['pct_above'].to_numpy() <= threshold)
+            else:
+                condition = covered & (df['pct_above'].to_numpy() >= threshold)
+            # first：宽度条件首次成立的那根K线触发；level：条件成立期间每根K线都触发
+            df['breadth_alert'] = condition if config.get('trigger', 'first') == 'level' else streak_start(condition, 1)
+        
+        latest_row = df.iloc[-1]
+        has_alert = latest_row['breadth_alert']
+        alert_name = f"{config['name']}宽度预警" if has_alert else None
+        
+        latest_data = {
+            'date': latest_row['date'].strftime('%Y-%m-%d'),
+            'close': latest_row['close'],
+            'member_count': int(latest_row['member_count']),
+            'above_count': int(latest_row['above_count']),
+            'pct_above': latest_row['pct_above'],
+            'new_crosses': int(latest_row['new_crosses']),
+            'new_breakdowns': int(latest_row['new_breakdowns']),
+            'ma_line': ma_line,
+            'members': members if len(members) <= BASKET_DETAIL_LIMIT else []
+        }
+    
+    if benchmark:
+        latest_data['price'] = df.iloc[-1]['price']
+        alert_name = f'相对{benchmark}{alert_name}' if alert_name else None
+    
+    return {
+        'has_alert': has_alert,
+        'alert_type': alert_name,
+        'latest_data': latest_data,
+        'df': df
+    }
+
+# 新增预警类型的图表和说明配置：图表由通用绘图逻辑按此绘制，说明用于邮件、日志和配置列表
+# overlays画在价格图上，panel画在下方副图，signal为标记预警点的布尔列，hlines为副图参考线
+RULE_CHART_SPECS = {
+    'macd_cross': lambda c: {
+        'overlays': [],
+        'panel': [('dif', 'DIF'), ('dea', 'DEA')],
+        'bars': ('macd', 'MACD柱'),
+        'signal': 'macd_cross',
+        'panel_title': f"MACD({c.get('fast', 12)},{c.get('slow', 26)},{c.get('signal', 9)})",
+        'hlines': [0]
+    },
+    'percentile_low': lambda c: {
+        'overlays': [('window_high', f"{c.get('window', 750)}{timeframe_unit(c)}最高"), ('window_low', f"{c.get('window', 750)}{timeframe_unit(c)}最低")],
+        'panel': [('percentile', '区间分位')],
+        'signal': 'percentile_low',
+        'panel_title': f"收盘价在最近{c.get('window', 750)}{timeframe_bar_unit(c)}中的分位",
+        'hlines': [c.get('threshold', 0.10)]
+    },
+    'dividend_yield': lambda c: {
+        'overlays': [],
+        'panel': [('ttm_yield', '滚动股息率'), ('forward_yield', '前瞻股息率')],
+        'signal': 'dividend_alert',
+        'panel_title': f"股息率（绿灯≥{c.get('green_yield', 0.05):.1%}，红灯≤{c.get('red_yield', 0.03):.1%}）",
+        'hlines': [c.get('red_yield', 0.03), c.get('green_yield', 0.05)]
+    },
+    'relative_strength': lambda c: {
+        'overlays': [],
+        'panel': [('excess_return', f"{c.get('period', 20)}{timeframe_unit(c)}超额收益")],
+        'signal': 'outperform',
+        'panel_title': f"相对{c.get('benchmark', '沪深300')}的{c.get('period', 20)}{timeframe_unit(c)}超额收益",
+        'hlines': [c.get('threshold', 0.0)]
+    },
+    'basket_breadth': lambda c: {
+        'price_label': '等权篮子指数',
+        'overlays': [],
+        'panel': [('new_crosses', '当日上穿均线数')] if c.get('metric') == 'new_crosses' else [('pct_above', f"站上{c.get('ma_line', 20)}{timeframe_unit(c)}均线比例")],
+        'signal': 'breadth_alert',
+        'panel_title': f"{c['name']} - 成分股宽度",
+        'hlines': [c.get('threshold', 1 if c.get('metric') == 'new_crosses' else 0.8)]
+    },
+    'expression': lambda c: expression_chart_spec(c),
+    'drawdown': lambda c: {
+        'overlays': [('window_high', f"{c.get('window', 250)}{timeframe_unit(c)}最高")],
+        'panel': [('drawdown', '回撤')],
+        'signal': 'drawdown_alert',
+        'panel_title': f"相对{c.get('window', 250)}{timeframe_unit(c)}最高收盘价的回撤",
+        'hlines': [-c.get('threshold', 0.20)]
+    },
+}
+
+def expression_chart_spec(stock_config: dict) -> dict:
+    """表达式规则的图表：价格量纲的指标叠加在价格图上，其余指标画在副图，没有时副图显示条件是否成立"""
+    tree = parse_expression(stock_config['expr'])
+    overlays, panel = [], []
+    for node in expression_indicators(tree):
+        column = expression_text(node)
+        price_scale = node[1] in PRICE_SCALE_FUNCTIONS and expression_fields(node) <= {'open', 'high', 'low', 'close'}
+        (overlays if price_scale else panel).append((column, column))
+    return {
+        'overlays': overlays[:4],
+        'panel': panel[:4] or [('condition', '条件成立')],
+        'signal': 'expression_alert',
+        'panel_title': stock_config.get('title', '表达式指标') if panel else '条件成立（1）/不成立（0）',
+        'hlines': []
+    }
+
+RULE_DESCRIPTIONS = {
+    'macd_cross': lambda c: f"MACD({c.get('fast', 12)},{c.get('slow', 26)},{c.get('signal', 9)})的DIF上穿DEA（{timeframe_label(c) or '日线'}）",
+    'percentile_low': lambda c: f"收盘价进入最近{c.get('window', 750)}{timeframe_bar_unit(c)}{'价格区间' if c.get('method', 'rank') == 'range' else '收盘价分布'}的底部{c.get('threshold', 0.10):.0%}",
+    'dividend_yield': lambda c: f"股息率红绿灯切换为{'/'.join(c.get('alert_lights', ['绿灯']))}（绿灯：股息率≥{c.get('green_yield', 0.05):.1%}或处于近{c.get('window', 750)}{timeframe_bar_unit(c)}{c.get('green_percentile', 0.8):.0%}分位以上）",
+    'relative_strength': lambda c: f"最近{c.get('period', 20)}{timeframe_bar_unit(c)}跑赢{c.get('benchmark', '沪深300')}超过{c.get('threshold', 0.0):.0%}",
+    'basket_breadth': lambda c: (
+        f"当日上穿{c.get('ma_line', 20)}{timeframe_unit(c)}均线的成分股达到{c.get('threshold', 1)}只" if c.get('metric') == 'new_crosses'
+        else f"站上{c.get('ma_line', 20)}{timeframe_unit(c)}均线的成分股比例{'降至' if c.get('direction') == 'below' else '达到'}{c.get('threshold', 0.8):.0%}"
+    ),
+    'drawdown': lambda c: f"收盘价相对{c.get('window', 250)}{timeframe_unit(c)}最高收盘价回撤超过{c.get('threshold', 0.20):.0%}",
+    'expression': lambda c: f"{c.get('title', '表达式')}：{c['expr']}（{timeframe_label(c) or '日线'}）",
+}
+
+# 通用输出中指标的中文名称，以及按百分比显示的比率类指标
+INDICATOR_LABELS = {
+    'date': '日期', 'close': '收盘价', 'dif': 'DIF', 'dea': 'DEA', 'macd': 'MACD柱',
+    'percentile': '区间分位', 'window_high': '区间最高', 'window_low': '区间最低', 'drawdown': '回撤',
+    'dividend_ttm': '近一年每股派息', 'ttm_yield': '滚动股息率', 'forward_yield': '前瞻股息率',
+    'yield_percentile': '股息率分位', 'light': '红绿灯', 'price': '股价', 'benchmark_close': '基准收盘',
+    'stock_return': '个股涨幅', 'benchmark_return': '基准涨幅', 'excess_return': '超额收益',
+    'member_count': '有效成分数', 'above_count': '站上均线数', 'pct_above': '站上均线比例',
+    'new_crosses': '当日上穿数', 'new_breakdowns': '当日跌破数', 'ma_line': '均线周期'
+}
+PERCENT_INDICATORS = {'percentile', 'drawdown', 'ttm_yield', 'forward_yield', 'yield_percentile',
+                      'stock_return', 'benchmark_return', 'excess_return', 'pct_above'}
+
+def format_indicator(key: str, value) -> str:
+    """指标值的显示格式：比率类显示为百分比，其余数值保留两位小数"""
+    if isinstance(value, float):
+        return f"{value:.2%}" if key in PERCENT_INDICATORS else f"{value:.2f}"
+    return str(value)
+
+def describe_rule(stock_config: dict) -> str:
+    """预警条件的文字说明"""
+    if stock_config['alert_type'] in BASKET_RULES:
+        stock_config = {**basket_config(stock_config), 'alert_type': 'basket_breadth'}
+    describe = RULE_DESCRIPTIONS.get(stock_config['alert_type'])
+    text = describe(stock_config) if describe else stock_config['alert_type']
+    if stock_config.get('benchmark') and stock_config['alert_type'] in BENCHMARK_RULES:
+        text = f"{text}（按相对{stock_config['benchmark']}的强弱计算）"
+    return text
+
+# ===================== 盘前触发价预计算 =====================
+# 金叉和连续站上均线两类预警，今天的判断只依赖今天的收盘价，其余N-1根K线在开盘前已知，
+# 因此可以在盘前直接解出"今天收盘价达到多少会触发预警"，盘中只需把实时价格和触发价比较。
+THRESHOLD_DIR = os.path.join(DATA_CACHE_DIR, 'thresholds')
+INTRADAY_CHECK_INTERVAL = int(os.environ.get('INTRADAY_CHECK_INTERVAL', '5'))  # 盘中检查间隔（秒）
+INTRADAY_END_TIME = os.environ.get('INTRADAY_END_TIME', '15:00')              # 盘中监控结束时间
+INTRADAY_SESSIONS = (('09:30', '11:30'), ('13:00', '15:00'))  # 连续竞价时段，开盘前和午间休市时不拉取行情
+INTRADAY_IDLE_POLL = 60  # 休市等待期间检查监控清单变化的间隔（秒）
+
+def _tail_sum(values: np.ndarray, count: int) -> float:
+    """最后count个值之和，count为0时返回0"""
+    return float(values[-count:].sum()) if count > 0 else 0.0
+
+# 可以在盘前求出触发价的预警类型
+THRESHOLD_RULES = {'golden_cross', 'three_above_ma', 'macd_cross', 'drawdown', 'percentile_low'}
+
+def compute_trigger_threshold(df: pd.DataFrame, stock_config: dict) -> dict:
+    """根据截至昨日的K线，求解今天触发预警所需的收盘价
+
+    返回的direction为1表示价格高于threshold时触发，为-1表示价格低于threshold时触发；
+    threshold为NaN表示今天无论收盘价多少都不会触发。
+    """
+    alert_type = stock_config['alert_type']
+    timeframe = stock_config.get('timeframe', 'daily')
+    if stock_config.get('benchmark') and alert_type in BENCHMARK_RULES:
+        # 相对基准的规则还取决于基准盘中价格，无法只用个股价格给出触发价
+        alert_type = None
+    if timeframe != 'daily' and not df.empty:
+        # 今天所在周期的收盘价就是今天的收盘价，只保留已结束的周期
+        df = resample_bars(df, timeframe)
+        if df['period'].iloc[-1] == period_keys([np.datetime64(datetime.now().date())], timeframe)[0]:
+            df = df.iloc[:-1]
+    closes = df['close'].to_numpy(dtype=float)
+    threshold = np.nan
+    direction = 1
+
+    if alert_type == 'golden_cross':
+        ma_short = stock_config['ma_short']
+        ma_long = stock_config['ma_long']
+        coef = 1.0 / ma_short - 1.0 / ma_long
+        if len(closes) >= max(ma_short, ma_long) and coef != 0:
+            # 昨天的均线差值必须 <= 0，今天才可能形成金叉
+            prev_diff = closes[-ma_short:].mean() - closes[-ma_long:].mean()
+            within = stock_config.get('within_bars', 1)
+            if within > 1:
+                # 最近几根内已经出现过金叉，今天无论收盘价多少都会提醒
+                with np.errstate(invalid='ignore'):
+                    diff = sma(closes, ma_short) - sma(closes, ma_long)
+                if within_bars(crosses_above(diff, 0.0), within - 1)[-1]:
+                    threshold = -np.inf
+            if prev_diff <= 0 and np.isnan(threshold):
+                # 今天的均线差值 = S短/短 - S长/长 + p*(1/短 - 1/长) > 0
+                known = _tail_sum(closes, ma_short - 1) / ma_short - _tail_sum(closes, ma_long - 1) / ma_long
+                threshold = -known / coef
+                direction = 1 if coef > 0 else -1
+
+    elif alert_type == 'three_above_ma':
+        ma_line = stock_config['ma_line']
+        bars = stock_config.get('consecutive_bars', 3)
+        if ma_line > 1 and len(closes) >= ma_line:
+            with np.errstate(invalid='ignore'):
+                above = closes > sma(closes, ma_line)
+            # 此前恰好连续N-1根站上均线，今天站上即为第一次连续N根
+            if streak_length(above)[-1] == bars - 1:
+                # p > (S + p) / N  等价于  p > S / (N - 1)
+                threshold = _tail_sum(closes, ma_line - 1) / (ma_line - 1)
+
+    elif alert_type == 'macd_cross':
+        fast = stock_config.get('fast', 12)
+        slow = stock_config.get('slow', 26)
+        signal = stock_config.get('signal', 9)
+        alpha_fast, alpha_slow = 2.0 / (fast + 1), 2.0 / (slow + 1)
+        if len(closes) >= 2 and alpha_fast != alpha_slow:
+            state = macd(closes, fast, slow, signal)['state']
+            ema_fast, ema_slow, dea = (float(state[key][0]) for key in ('ema_fast', 'ema_slow', 'dea'))
+            # 昨天DIF <= DEA，今天才可能形成金叉
+            if ema_fast - ema_slow <= dea:
+                # 今天DIF - DEA = (1-α信号)(DIF今 - DEA昨)，DIF今对收盘价p是线性的
+                threshold = (dea - (1 - alpha_fast) * ema_fast + (1 - alpha_slow) * ema_slow) / (alpha_fast - alpha_slow)
+                direction = 1 if alpha_fast > alpha_slow else -1
+
+    elif alert_type == 'drawdown':
+        window = stock_config.get('window', 250)
+        cutoff = -stock_config.get('threshold', 0.20)
+        if window > 1 and len(closes) >= window - 1:
+            previous = drawdown(closes, window)[-1] if len(closes) >= window else np.nan
+            # 昨天回撤未超过阈值，今天 p / max(H, p) - 1 <= -阈值 等价于 p <= (1-阈值) * H
+            if not previous <= cutoff:
+                threshold = (1 + cutoff) * closes[-(window - 1):].max()
+                direction = -1
+
+    elif alert_type == 'percentile_low':
+        window = stock_config.get('window', 750)
+        cutoff = stock_config.get('threshold', 0.10)
+        if window > 1 and len(closes) >= window - 1:
+            if stock_config.get('method', 'rank') == 'range':
+                previous = range_position(closes, window)[-1] if len(closes) >= window else np.nan
+            else:
+                previous = latest_percentile(closes, window)[-1] if len(closes) >= window else np.nan
+            if not previous <= cutoff:
+                history = np.sort(closes[-(window - 1):])
+                direction = -1
+                if stock_config.get('method', 'rank') == 'range':
+                    # (p - L) / (H - L) <= 阈值  等价于  p <= L + 阈值 * (H - L)
+                    threshold = history[0] + cutoff * (history[-1] - history[0])
+                else:
+                    # 今天的分位为 (低于p的根数 + 1) / window，低于p的根数不超过rank时触发
+                    rank = int(np.floor(cutoff * window - 1 + 1e-9))
+                    if rank >= len(history):
+                        threshold = np.inf
+                    elif rank >= 0:
+                        threshold = history[rank]
+
+    return {
+        'code': stock_config['code'],
+        'name': stock_config['name'],
+        'alert_type': stock_config['alert_type'],
+        'basis_date': df.iloc[-1]['date'].strftime('%Y-%m-%d') if not df.empty else None,
+        'last_close': closes[-1] if len(closes) else np.nan,
+        'threshold': threshold,
+        'direction': direction
+    }
+
+THRESHOLD_COLUMNS = ['key', 'code', 'name', 'alert_type', 'basis_date', 'last_close', 'threshold', 'direction']
+
+def compute_trigger_thresholds(stock_configs: list) -> list:
+    """计算一批配置今天的触发价，共用同一份数据的配置只获取一次数据"""
+    today = pd.Timestamp(datetime.now().date())
+    groups = ExecutionPlan([c for c in stock_configs if c['alert_type'] in THRESHOLD_RULES]).groups()
+
+    def _compute(group):
+        df = get_rule_data(group[0], group)
+        if df.empty:
+            return []
+        # 只使用今天之前的K线，避免盘中数据源返回的当日未完成K线参与计算
+        df = df[df['date'] < today]
+        return [{'key': config_key(stock_config), **compute_trigger_threshold(df, stock_config)} for stock_config in group]
+
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(groups), 16))) as executor:
+        for group_rows in executor.map(_compute, groups):
+            rows.extend(group_rows)
+    return rows
+
+def save_trigger_thresholds(thresholds: pd.DataFrame) -> str:
+    """保存今天的触发价表"""
+    if not os.path.exists(THRESHOLD_DIR):
+        os.makedirs(THRESHOLD_DIR)
+    threshold_file = os.path.join(THRESHOLD_DIR, f'trigger_thresholds_{TODAY_DATE}.csv')
+    thresholds.to_csv(threshold_file, index=False, encoding='utf-8')
+    return threshold_file
+
+def precompute_trigger_thresholds(stock_configs: list) -> str:
+    """盘前阶段：计算并保存每个(股票, 预警规则)今天的触发价"""
+    rows = compute_trigger_thresholds(stock_configs)
+    threshold_file = save_trigger_thresholds(pd.DataFrame(rows, columns=THRESHOLD_COLUMNS))
+
+    armed = sum(1 for row in rows if not np.isnan(row['threshold']))
+    print(f"✅ 盘前触发价已保存: {threshold_file}（共{len(rows)}条，今日可能触发{armed}条）")
+    return threshold_file
+
+def load_trigger_thresholds(date: str = None) -> pd.DataFrame:
+    """读取指定日期（默认今天）的盘前触发价表"""
+    threshold_file = os.path.join(THRESHOLD_DIR, f'trigger_thresholds_{date or TODAY_DATE}.csv')
+    if not os.path.exists(threshold_file):
+        return pd.DataFrame()
+    return pd.read_csv(threshold_file, dtype={'code': str}, encoding='utf-8')
+
+def get_spot_prices() -> pd.Series:
+    """获取全市场实时行情快照，返回以股票代码为索引的最新价"""
+    spot_df = safe_get_data(ak.stock_zh_a_spot_em)
+    if spot_df is None:
+        return pd.Series(dtype=float)
+    return pd.Series(pd.to_numeric(spot_df['最新价'], errors='coerce').to_numpy(),
+                     index=spot_df['代码'].astype(str).to_numpy())
+
+def check_trigger_thresholds(thresholds: pd.DataFrame, spot_prices: pd.Series) -> pd.DataFrame:
+    """用一次向量化比较判断实时价格是否越过触发价"""
+    if thresholds.empty:
+        return thresholds
+    prices = spot_prices.reindex(thresholds['code']).to_numpy(dtype=float)
+    # NaN（无触发价或无行情）参与比较结果均为False
+    hit = thresholds['direction'].to_numpy() * (prices - thresholds['threshold'].to_numpy(dtype=float)) > 0
+    result = thresholds.loc[hit].copy()
+    result['price'] = prices[hit]
+    return result
+
+def send_intraday_trigger_email(hits: pd.DataFrame):
+    """发送盘中触发价提醒邮件"""
+    rows = "".join(
+        f"<tr><td><b>{row.name}</b></td><td>{row.code}</td><td>{row.alert_type}</td>"
+        f"<td>{row.threshold:.2f}</td><td><b style=\"color: green;\">{row.price:.2f}</b></td></tr>"
+        for row in hits.itertuples()
+    )
+    html_content = f"""
+    <html>
+      <body>
+        <h2>⚡ 盘中触发价提醒（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}）</h2>
+        <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
+          <tr style="background-color: #f0f0f0;">
+            <th>股票名称</th>
+            <th>股票代码</th>
+            <th>预警类型</th>
+            <th>触发价</th>
+            <th>最新价</th>
+          </tr>
+          {rows}
+        </table>
+        <p>实时价格已越过盘前计算的触发价，若收盘时仍保持在该价位之上/之下，将形成预警信号。</p>
+        <p>⚠️ 本预警仅供参考，不构成投资建议</p>
+      </body>
+    </html>
+    """
+    msg = MIMEMultipart('related')
+    msg['From'] = EMAIL_CONFIG['sender']
+    msg['To'] = EMAIL_CONFIG['receiver']
+    msg['Subject'] = Header(f"盘中触发价提醒_{datetime.now().strftime('%Y%m%d_%H%M')}", 'utf-8')
+    msg.attach(MIMEText(html_content, 'html', 'utf-8'))
+    deliver_email(msg)
+
+def seconds_until_session(now: datetime = None) -> float:
+    """距离下一个交易时段开始的秒数：交易时段内为0，当天的交易时段都已结束时为None"""
+    now = now or datetime.now()
+    clock = now.strftime('%H:%M')
+    for start, end in INTRADAY_SESSIONS:
+        if clock < start:
+            opens = datetime.combine(now.date(), datetime.strptime(start, '%H:%M').time())
+            return (opens - now).total_seconds()
+        if clock < end:
+            return 0.0
+    return None
+
+def run_intraday_monitor(interval: int = INTRADAY_CHECK_INTERVAL, end_time: str = INTRADAY_END_TIME, stock_configs: list = None):
+    """盘中监控：每隔interval秒用实时快照比较盘前触发价，新越过触发价的股票发送提醒
+
+    监控清单文件被修改时自动重新加载，只为新增或修改的配置计算触发价，删除的配置不再检查。
+    全市场快照只在交易时段内拉取，开盘前和午间休市时等待到下一个交易时段。
+    """
+    watcher = WatchlistWatcher(stock_configs)
+    table = load_trigger_thresholds()
+    if table.empty or 'key' not in table.columns:
+        print("⚠️ 未找到今日盘前触发价，先执行盘前计算")
+        precompute_trigger_thresholds(list(watcher.plan.rules.values()))
+        table = load_trigger_thresholds()
+
+    thresholds = table[table['threshold'].notna()].reset_index(drop=True)
+    print(f"⚡ 盘中监控启动，共{len(thresholds)}条触发价，检查间隔{interval}秒，结束时间{end_time}")
+
+    notified = set()
+    idle = False
+    # 有监控清单文件时即使暂无触发价也继续运行，等待清单更新
+    while (not thresholds.empty or watcher.path) and datetime.now().strftime('%H:%M') < end_time:
+        change = watcher.poll()
+        if change:
+            _, added, removed = change
+            table = table[~table['key'].isin(removed)]
+            # 删除或修改过的配置重新开始提醒（修改后的配置以新的触发价重新加入）
+            notified.difference_update(removed)
+            if added:
+                rows = compute_trigger_thresholds([watcher.plan.rules[key] for key in added])
+                table = pd.concat([table, pd.DataFrame(rows, columns=THRESHOLD_COLUMNS)], ignore_index=True)
+            save_trigger_thresholds(table)
+            thresholds = table[table['threshold'].notna()].reset_index(drop=True)
+        if thresholds.empty:
+            time.sleep(interval)
+            continue
+        wait = seconds_until_session()
+        if wait is None:
+            break
+        if wait > 0:
+            # 休市期间行情不变，不拉取全市场快照；分段等待以便及时响应监控清单的修改
+            if not idle:
+                print(f"💤 当前休市，约{wait / 60:.0f}分钟后开始检查")
+                idle = True
+            time.sleep(min(wait, INTRADAY_IDLE_POLL))
+            continue
+        idle = False
+
+        hits = check_trigger_thresholds(thresholds, get_spot_prices())
+        if not hits.empty:
+            # 按配置标识去重：同一股票上参数不同的同类规则分别提醒
+            new_hits = hits[~hits['key'].isin(notified)]
+            if not new_hits.empty:
+                for row in new_hits.itertuples():
+                    print(f"🚨 {row.name}({row.code}) {row.alert_type} 最新价{row.price:.2f} 已越过触发价{row.threshold:.2f}")
+                send_intraday_trigger_email(new_hits)
+                notified.update(new_hits['key'])
+        time.sleep(interval)
+
+    print(f"⏹️ 盘中监控结束，共{len(notified)}条触发提醒")
+
+# ===================== 图表输出配置 =====================
+# 图表只栅格化一次，再由同一张图缩放出邮件用图和HTML报告缩略图。用环境变量 CHART_PROFILE 或
+# 命令行 --chart-profile 选择：format为主图格式（png/webp/svg），dpi为主图分辨率，colors>0时PNG量化为
+# 该数量的调色板颜色，email_dpi为邮件内嵌图分辨率（0表示直接使用主图），thumbnail为缩略图宽度（0表示不生成）。
+CHART_PROFILES = {
+    'full':     {'format': 'png',  'dpi': 100, 'colors': 0,   'email_dpi': 0,  'thumbnail': 0},    # 与旧版相同
+    'standard': {'format': 'png',  'dpi': 100, 'colors': 256, 'email_dpi': 72, 'thumbnail': 480},
+    'compact':  {'format': 'webp', 'dpi': 80,  'colors': 128, 'email_dpi': 60, 'thumbnail': 360},
+    'vector':   {'format': 'svg',  'dpi': 100, 'colors': 256, 'email_dpi': 72, 'thumbnail': 480},
+}
+CHART_PROFILE = os.environ.get('CHART_PROFILE', 'standard')
+CHART_EMAIL_DIR = os.path.join(PICTURE_DIR, 'email')
+CHART_THUMBNAIL_DIR = os.path.join(PICTURE_DIR, 'thumbs')
+
+def chart_profile() -> dict:
+    """当前生效的图表输出配置；没有Pillow时只能输出原样PNG，不支持WebP时改用PNG"""
+    profile = dict(CHART_PROFILES.get(CHART_PROFILE, CHART_PROFILES['standard']))
+    if Image is None:
+        return {**profile, 'format': 'svg' if profile['format'] == 'svg' else 'png', 'colors': 0, 'email_dpi': 0, 'thumbnail': 0}
+    if profile['format'] == 'webp' and not WEBP_SUPPORTED:
+        profile['format'] = 'png'
+    return profile
+
+def chart_variant_path(chart_path: str, variant: str) -> str:
+    """主图对应的邮件用图（'email'）或缩略图（'thumbnail'）路径，按当前配置推算，不检查文件是否存在
+
+    配置不生成该版本时：邮件用图即主图（SVG主图无法内嵌时为None），缩略图为None。
+    """
+    if not chart_path:
         return None
+    profile = chart_profile()
+    stem = os.path.splitext(os.path.basename(chart_path))[0]
+    if variant == 'email':
+        if profile['email_dpi']:
+            return os.path.join(CHART_EMAIL_DIR, f'{stem}.png')
+        return None if chart_path.endswith('.svg') else chart_path
+    if profile['thumbnail']:
+        thumbnail_format = 'png' if profile['format'] == 'svg' else profile['format']
+        return os.path.join(CHART_THUMBNAIL_DIR, f'{stem}.{thumbnail_format}')
+    return None
 
-# ===================== 邮件发送函数 =====================
-def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
-    """发送预警邮件"""
-    if not alert_info['has_alert']:
-        print("ℹ️  无预警信号，不发送邮件")
+def image_subtype(path: str) -> str:
+    """图片文件的MIME子类型"""
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    return {'jpg': 'jpeg', 'svg': 'svg+xml'}.get(extension, extension)
+
+def _save_raster(image, path: str, image_format: str, colors: int):
+    """保存栅格图：PNG按调色板量化并优化压缩，WebP使用有损压缩"""
+    if image_format == 'webp':
+        image.convert('RGB').save(path, 'WEBP', quality=80, method=6)
         return
+    image = image.convert('RGB')
+    if colors:
+        image = image.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+    image.save(path, 'PNG', optimize=True)
+
+def save_chart(fig, base_path: str) -> str:
+    """按图表输出配置保存主图、邮件用图和缩略图，base_path不含扩展名，返回主图路径"""
+    profile = chart_profile()
+    chart_path = f"{base_path}.{profile['format']}"
+    if profile['format'] == 'svg':
+        fig.savefig(chart_path, format='svg', bbox_inches='tight', pad_inches=0.1)
+    if Image is None or (not profile['colors'] and profile['format'] == 'png' and not profile['email_dpi'] and not profile['thumbnail']):
+        if profile['format'] != 'svg':
+            fig.savefig(chart_path, dpi=profile['dpi'], bbox_inches='tight', pad_inches=0.1)
+        return chart_path
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=profile['dpi'], bbox_inches='tight', pad_inches=0.1)
+    buffer.seek(0)
+    raster = Image.open(buffer)
+    raster.load()
+    if profile['format'] != 'svg':
+        _save_raster(raster, chart_path, profile['format'], profile['colors'])
+    if profile['email_dpi']:
+        os.makedirs(CHART_EMAIL_DIR, exist_ok=True)
+        scale = profile['email_dpi'] / profile['dpi']
+        email_image = raster.resize((max(1, round(raster.width * scale)), max(1, round(raster.height * scale))), Image.LANCZOS)
+        _save_raster(email_image, chart_variant_path(chart_path, 'email'), 'png', profile['colors'])
+    if profile['thumbnail']:
+        os.makedirs(CHART_THUMBNAIL_DIR, exist_ok=True)
+        thumbnail_path = chart_variant_path(chart_path, 'thumbnail')
+        height = max(1, round(raster.height * profile['thumbnail'] / raster.width))
+        thumbnail = raster.resize((profile['thumbnail'], height), Image.LANCZOS)
+        _save_raster(thumbnail, thumbnail_path, os.path.splitext(thumbnail_path)[1].lstrip('.'), profile['colors'])
+    return chart_path
+
+# ===================== 绘制预警图表 =====================
+def _plot_rule_panels(df: pd.DataFrame, stock_config: dict, spec: dict):
+    """通用图表：上图为收盘价和叠加指标并标记预警点，下图为副图指标"""
+    stock_name = stock_config['name']
+    columns = [col for col, _ in spec['overlays'] + spec['panel']]
+    plot_df = df.dropna(subset=columns, how='all').copy() if columns else df.copy()
+    if plot_df.empty:
+        return None
+    
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
+    signals = plot_df[plot_df[spec['signal']].astype(bool)] if spec.get('signal') in plot_df.columns else plot_df.iloc[:0]
+    
+    # 图1：收盘价和叠加指标
+    ax1.plot(plot_df["date"], plot_df["close"], color="#2ca02c", linewidth=1.5, label=spec.get('price_label', "收盘价"))
+    for (col, label), color in zip(spec['overlays'], ["#ff7f0e", "#d62728", "#1f77b4", "#8c564b"]):
+        ax1.plot(plot_df["date"], plot_df[col], color=color, linewidth=1.5, label=label)
+    if not signals.empty:
+        ax1.scatter(signals['date'], signals['close'], color='gold', s=200, marker='^', zorder=5, label='预警')
+    ax1.set_ylabel("价格", fontsize=12)
+    ax1.set_title(f"{stock_name} - {describe_rule(stock_config)}", fontsize=14, fontweight="bold")
+    ax1.grid(True, alpha=0.3)
+    ax1.legend(loc="upper left", fontsize=10)
+    
+    # 图2：副图指标
+    if spec.get('bars'):
+        col, label = spec['bars']
+        ax2.bar(plot_df["date"], plot_df[col], color=np.where(plot_df[col] >= 0, "#d62728", "#2ca02c"), alpha=0.5, label=label)
+    for (col, label), color in zip(spec['panel'], ["#9467bd", "#ff7f0e", "#1f77b4", "#8c564b"]):
+        ax2.plot(plot_df["date"], plot_df[col], color=color, linewidth=1.5, label=label)
+    for level in spec.get('hlines', []):
+        ax2.axhline(y=level, color="#7f7f7f", linestyle="--", linewidth=1, alpha=0.7)
+    if not signals.empty and spec['panel']:
+        ax2.scatter(signals['date'], signals[spec['panel'][0][0]], color='gold', s=200, marker='^', zorder=5)
+    ax2.set_xlabel("日期", fontsize=12)
+    ax2.set_title(f"{stock_name} - {spec['panel_title']}", fontsize=12, fontweight="bold")
+    ax2.grid(True, alpha=0.3)
+    ax2.legend(loc="upper left", fontsize=10)
+    return fig, ax1, ax2
+
+def plot_alert_chart(df: pd.DataFrame, stock_config: dict, has_alert: bool):
+    """绘制预警图表"""
+    if df.empty:
+        return None
     
     stock_name = stock_config['name']
-    stock_code = stock_config['code']
     alert_type = stock_config['alert_type']
-    latest_data = alert_info['latest_data']
+    unit = timeframe_unit(stock_config)
     
-    # 构建邮件主体
-    msg = MIMEMultipart('related')
-    msg['From'] = EMAIL_CONFIG['sender']
-    msg['To'] = EMAIL_CONFIG['receiver']
-    msg['Subject'] = Header(f"股票预警_{stock_name}_{datetime.now().strftime('%Y%m%d')}", 'utf-8')
+    # 确保在主线程中使用matplotlib
+    if threading.current_thread().name != 'MainThread':
+        print(f"  ⚠️  图表绘制需要在主线程中执行，跳过绘制")
+        return None
     
     if alert_type == 'golden_cross':
-        # 金叉预警邮件内容
+        # 金叉预警图表
         ma_short = stock_config['ma_short']
         ma_long = stock_config['ma_long']
         
-        # 构建HTML内容
-        html_content = f"""
-        <html>
-          <body>
-            <h2>🚨 股票预警提醒（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}）</h2>
-            
-            <h3>📊 预警信息：</h3>
-            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
-              <tr style="background-color: #f0f0f0;">
-                <th>股票名称</th>
-                <th>股票代码</th>
-                <th>预警类型</th>
-                <th>预警时间</th>
-              </tr>
-              <tr>
-                <td><b>{stock_name}</b></td>
-                <td>{stock_code}</td>
-                <td><b style="color: gold;">{alert_info['alert_type']}</b></td>
-                <td>{latest_data['date']}</td>
-              </tr>
-            </table>
-            <br>
-            
-            <h3>📈 最新数据：</h3>
-            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
-              <tr style="background-color: #f0f0f0;">
-                <th>收盘价</th>
-                <th>{ma_short}日均线</th>
-                <th>{ma_long}日均线</th>
-                <th>均线差值</th>
-              </tr>
-              <tr>
-                <td><b>{latest_data['close']:.2f}</b></td>
-                <td>{latest_data[f'ma{ma_short}']:.2f}</td>
-                <td>{latest_data[f'ma{ma_long}']:.2f}</td>
-                <td><b style="color: {'green' if latest_data['ma_diff'] > 0 else 'red'};">{latest_data['ma_diff']:.2f}</b></td>
-              </tr>
-            </table>
-            <br>
-            
-            <h3>💡 预警说明：</h3>
-            <p><b>{ma_short}日均线</b>刚刚上穿<b>{ma_long}日均线</b>，形成<b>金叉</b>信号。</p>
-            <p>这通常被视为<b>买入信号</b>，表明短期趋势转强。</p>
-            <br>
-            
-            <h3>📊 预警图表：</h3>
-            <img src="cid:alert_chart" style="border: none; max-width: 100%; display: block;" /><br>
-            
+        # 过滤掉均线数据不足的行
+        plot_df = df.dropna(subset=[f'ma{ma_short}', f'ma{ma_long}']).copy()
+        
+        if plot_df.empty:
+            return None
+        
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
+        
+        # 图1：股价和均线
+        ax1.plot(plot_df["date"], plot_df["close"], 
+                 color="#2ca02c", linewidth=1.5, label="收盘价")
+        ax1.plot(plot_df["date"], plot_df[f'ma{ma_short}'], 
+                 color="#ff7f0e", linewidth=1.5, label=f"{ma_short}{unit}均线")
+        ax1.plot(plot_df["date"], plot_df[f'ma{ma_long}'], 
+                 color="#d62728", linewidth=1.5, label=f"{ma_long}{unit}均线")
+        
+        # 标记金叉点
+        golden_crosses = plot_df[plot_df['golden_cross']]
+        if not golden_crosses.empty:
+            # 只添加一次图例
+            ax1.scatter(golden_crosses.iloc[0]['date'], golden_crosses.iloc[0][f'ma{ma_short}'], 
+                       color='gold', s=200, marker='^', zorder=5, label='金叉')
+            ax1.annotate('金叉', xy=(golden_crosses.iloc[0]['date'], golden_crosses.iloc[0][f'ma{ma_short}']), 
+                        xytext=(10, 10), textcoords='offset points',
+                        fontsize=10, color='gold', fontweight='bold')
+            # 绘制其他点但不添加图例
+            if len(golden_crosses) > 1:
+                for _, row in golden_crosses.iloc[1:].iterrows():
+                    ax1.scatter(row['date'], row[f'ma{ma_short}'], 
+                               color='gold', s=200, marker='^', zorder=5)
+                    ax1.annotate('金叉', xy=(row['date'], row[f'ma{ma_short}']), 
+                                xytext=(10, 10), textcoords='offset points',
+                                fontsize=10, color='gold', fontweight='bold')
+        
+        ax1.set_ylabel("价格", fontsize=12)
+        ax1.set_title(f"{stock_name} - {ma_short}{unit}均线 vs {ma_long}{unit}均线", 
+                      fontsize=14, fontweight="bold")
+        ax1.grid(True, alpha=0.3)
+        ax1.legend(loc="upper left", fontsize=10)
+        
+        # 图2：均线差值
+        ax2.plot(plot_df["date"], plot_df['ma_diff'], 
+                 color="#9467bd", linewidth=1.5, label="均线差值")
+        ax2.axhline(y=0, color="#2ca02c", linestyle="--", linewidth=1, alpha=0.7)
+        
+        # 标记金叉点
+        for _, row in golden_crosses.iterrows():
+            ax2.scatter(row['date'], row['ma_diff'], 
+                       color='gold', s=200, marker='^', zorder=5)
+            ax2.annotate('金叉', xy=(row['date'], row['ma_diff']), 
+                        xytext=(10, 10), textcoords='offset points',
+                        fontsize=10, color='gold', fontweight='bold')
+        
+        ax2.set_ylabel("均线差值", fontsize=12)
+        ax2.set_xlabel("日期", fontsize=12)
+        ax2.set_title(f"{stock_name} - 均线差值（正数表示{ma_short}{unit}均线在{ma_long}{unit}均线之上）", 
+                      fontsize=12, fontweight="bold")
+        ax2.grid(True, alpha=0.3)
+        ax2.legend(loc="upper left", fontsize=10)
+        
+    elif alert_type == 'three_above_ma':
+        # 连续N根k线站上均线预警图表
+        ma_line = stock_config['ma_line']
+        bars = stock_config.get('consecutive_bars', 3)
+        
+        # 过滤掉均线数据不足的行
+        plot_df = df.dropna(subset=[f'ma{ma_line}']).copy()
+        
+        if plot_df.empty:
+            return None
+        
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
+        
+        # 图1：股价和均线
+        ax1.plot(plot_df["date"], plot_df["close"], 
+                 color="#2ca02c", linewidth=1.5, label="收盘价")
+        ax1.plot(plot_df["date"], plot_df[f'ma{ma_line}'], 
+                 color="#d62728", linewidth=2, label=f"{ma_line}{unit}均线")
+        
+        # 标记站上均线的点
+        above_ma_points = plot_df[plot_df['above_ma']]
+        if not above_ma_points.empty:
+            # 只添加一次图例
+            ax1.scatter(above_ma_points.iloc[0]['date'], above_ma_points.iloc[0]['close'], 
+                       color='green', s=50, marker='o', zorder=5, label='站在均线上方')
+            # 绘制其他点但不添加图例
+            if len(above_ma_points) > 1:
+                for _, row in above_ma_points.iloc[1:].iterrows():
+                    ax1.scatter(row['date'], row['close'], 
+                               color='green', s=50, marker='o', zorder=5)
+        
+        # 标记第一次出现连续三根站上均线的点
+        if 'first_three_above_ma' in plot_df.columns:
+            three_above_ma_points = plot_df[plot_df['first_three_above_ma']]
+        else:
+            three_above_ma_points = plot_df[plot_df['three_above_ma']]
+        
+        if not three_above_ma_points.empty:
+            # 只添加一次图例
+            ax1.scatter(three_above_ma_points.iloc[0]['date'], three_above_ma_points.iloc[0]['close'], 
+                       color='gold', s=200, marker='^', zorder=6, label=f'连续{count_label(bars)}根站上均线')
+            ax1.annotate(f'连续{count_label(bars)}根', xy=(three_above_ma_points.iloc[0]['date'], three_above_ma_points.iloc[0]['close']), 
+                        xytext=(10, 10), textcoords='offset points',
+                        fontsize=10, color='gold', fontweight='bold')
+            # 绘制其他点但不添加图例
+            if len(three_above_ma_points) > 1:
+                for _, row in three_above_ma_points.iloc[1:].iterrows():
+                    ax1.scatter(row['date'], row['close'], 
+                               color='gold', s=200, marker='^', zorder=6)
+                    ax1.annotate(f'连续{count_label(bars)}根', xy=(row['date'], row['close']), 
+                                xytext=(10, 10), textcoords='offset points',
+                                fontsize=10, color='gold', fontweight='bold')
+        
+        ax1.set_ylabel("价格", fontsize=12)
+        ax1.set_title(f"{stock_name} - 收盘价 vs {ma_line}{unit}均线", 
+                      fontsize=14, fontweight="bold")
+        ax1.grid(True, alpha=0.3)
+        ax1.legend(loc="upper left", fontsize=10)
+        
+        # 图2：连续站上均线天数
+        ax2.plot(plot_df["date"], plot_df['consecutive_above_ma'], 
+                 color="#9467bd", linewidth=1.5, label="连续站上均线天数")
+        ax2.axhline(y=bars, color="#d62728", linestyle="--", linewidth=1, alpha=0.7, label=f"预警阈值（{bars}{timeframe_bar_unit(stock_config)}）")
+        
+        # 标记第一次出现连续三根站上均线的点
+        for _, row in three_above_ma_points.iterrows():
+            ax2.scatter(row['date'], row['consecutive_above_ma'], 
+                       color='gold', s=200, marker='^', zorder=5)
+            ax2.annotate('预警', xy=(row['date'], row['consecutive_above_ma']), 
+                        xytext=(10, 10), textcoords='offset points',
+                        fontsize=10, color='gold', fontweight='bold')
+        
+        ax2.set_ylabel("连续站上均线天数", fontsize=12)
+        ax2.set_xlabel("日期", fontsize=12)
+        ax2.set_title(f"{stock_name} - 连续站上{ma_line}{unit}均线天数", 
+                      fontsize=12, fontweight="bold")
+        ax2.grid(True, alpha=0.3)
+        ax2.legend(loc="upper left", fontsize=10)
+    
+    elif alert_type in RULE_CHART_SPECS or alert_type in BASKET_RULES:
+        # 其他预警类型：按图表配置通用绘制
+        if alert_type in BASKET_RULES:
+            stock_config = basket_config(stock_config)
+            alert_type = 'basket_breadth'
+        figure = _plot_rule_panels(df, stock_config, RULE_CHART_SPECS[alert_type](stock_config))
+        if figure is None:
+            return None
+        fig, ax1, ax2 = figure
+    
+    else:
+        return None
+    
+    # 格式化日期
+    for ax in [ax1, ax2]:
+        fig.autofmt_xdate()
+    
+    try:
+        plt.tight_layout()
+    except Exception as e:
+        print(f"  ⚠️  图表布局警告：{e}")
+    
+    # 保存图片
+    latest_date = df.iloc[-1]["date"].strftime("%Y%m%d")
+    alert_status = "预警" if has_alert else "正常"
+    # 文件名包含规则和参数摘要：同一股票的多条规则并行绘图时各自输出，不会互相覆盖
+    rule_stem = config_key(stock_config).split(':', 1)[1].replace(':', '_')
+    save_path = os.path.join(PICTURE_DIR, f"{stock_name}_{rule_stem}_{latest_date}_{alert_status}")
+    
+    try:
+        save_path = save_chart(fig, save_path)
+        plt.close()
+        
+        print(f"  ✅ {stock_name}预警图表已保存：{save_path}")
+        return save_path
+    except Exception as e:
+        print(f"  ❌ 图表保存失败：{e}")
+        plt.close()
+        return None
+
+# ===================== 邮件发送函数 =====================
+# 演练模式（--dry-run）：照常检查、绘图和生成报告，但不发送邮件，也不记为已通知
+DRY_RUN = os.environ.get('DRY_RUN', '0') == '1'
+
+def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
+    """发送预警邮件"""
+    if not alert_info['has_alert']:
+        print("ℹ️  无预警信号，不发送邮件")
+        return False
+    
+    stock_name = stock_config['name']
+    stock_code = stock_config['code']
+    alert_type = stock_config['alert_type']
+    unit = timeframe_unit(stock_config)
+    latest_data = alert_info['latest_data']
+    
+    # 构建邮件主体
+    msg = MIMEMultipart('related')
+    msg['From'] = EMAIL_CONFIG['sender']
+    msg['To'] = EMAIL_CONFIG['receiver']
+    msg['Subject'] = Header(f"股票预警_{stock_name}_{datetime.now().strftime('%Y%m%d')}", 'utf-8')
+    
+    if alert_type == 'golden_cross':
+        # 金叉预警邮件内容
+        ma_short = stock_config['ma_short']
+        ma_long = stock_config['ma_long']
+        
+        # 构建HTML内容
+        html_content = f"""
+        <html>
+          <body>
+            <h2>🚨 股票预警提醒（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}）</h2>
+            
+            <h3>📊 预警信息：</h3>
+            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
+              <tr style="background-color: #f0f0f0;">
+                <th>股票名称</th>
+                <th>股票代码</th>
+                <th>预警类型</th>
+                <th>预警时间</th>
+              </tr>
+              <tr>
+                <td><b>{stock_name}</b></td>
+                <td>{stock_code}</td>
+                <td><b style="color: gold;">{alert_info['alert_type']}</b></td>
+                <td>{latest_data['date']}</td>
+              </tr>
+            </table>
+            <br>
+            
+            <h3>📈 最新数据：</h3>
+            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
+              <tr style="background-color: #f0f0f0;">
+                <th>收盘价</th>
+                <th>{ma_short}{unit}均线</th>
+                <th>{ma_long}{unit}均线</th>
+                <th>均线差值</th>
+              </tr>
+              <tr>
+                <td><b>{latest_data['close']:.2f}</b></td>
+                <td>{latest_data[f'ma{ma_short}']:.2f}</td>
+                <td>{latest_data[f'ma{ma_long}']:.2f}</td>
+                <td><b style="color: {'green' if latest_data['ma_diff'] > 0 else 'red'};">{latest_data['ma_diff']:.2f}</b></td>
+              </tr>
+            </table>
+            <br>
+            
+            <h3>💡 预警说明：</h3>
+            <p><b>{ma_short}{unit}均线</b>刚刚上穿<b>{ma_long}{unit}均线</b>，形成<b>金叉</b>信号。</p>
+            <p>这通常被视为<b>买入信号</b>，表明短期趋势转强。</p>
+            <br>
+            
+            <h3>📊 预警图表：</h3>
+            <img src="cid:alert_chart" style="border: none; max-width: 100%; display: block;" /><br>
+            
             <br>
             <p>⚠️ 本预警仅供参考，不构成投资建议</p>
             <p>⏰ 预警时间：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
@@ -782,7 +3228,7 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
         """
     
     elif alert_type == 'three_above_ma':
-        # 连续三根k线站上20日均线预警邮件内容
+        # 连续N根k线站上均线预警邮件内容
         ma_line = stock_config['ma_line']
         
         # 构建HTML内容
@@ -812,7 +3258,7 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
             <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
               <tr style="background-color: #f0f0f0;">
                 <th>收盘价</th>
-                <th>{ma_line}日均线</th>
+                <th>{ma_line}{unit}均线</th>
                 <th>连续站上均线天数</th>
                 <th>状态</th>
               </tr>
@@ -826,7 +3272,7 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
             <br>
             
             <h3>💡 预警说明：</h3>
-            <p><b>{stock_name}</b>连续<b>3</b>个交易日收盘价站在<b>{ma_line}日均线</b>上方。</p>
+            <p><b>{stock_name}</b>连续<b>{stock_config.get('consecutive_bars', 3)}</b>{timeframe_bar_unit(stock_config)}收盘价站在<b>{ma_line}{unit}均线</b>上方。</p>
             <p>这通常被视为<b>强势信号</b>，表明股价可能继续上涨。</p>
             <br>
             
@@ -840,12 +3286,34 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
         </html>
         """
     
-    elif alert_type == 'three_carriers_above_ma':
-        # 三个运营商都站在20日均线上方预警邮件内容
-        ma_line = stock_config['ma_line']
-        carriers_data = latest_data['carriers']
-        
-        # 构建HTML内容
+    else:
+        # 其他预警类型：按最新指标数据生成通用内容
+        rows = "".join(
+            f"<tr><td>{INDICATOR_LABELS.get(key, key)}</td><td>{format_indicator(key, value)}</td></tr>"
+            for key, value in latest_data.items() if key != 'date' and not isinstance(value, (list, dict))
+        )
+        # 篮子规则附上成分股明细
+        member_rows = ""
+        for member in latest_data.get('members', []):
+            ma_value = member[f"ma{latest_data['ma_line']}"]
+            status = '✓ 站在上方' if member['above_ma'] else '✗ 站在下方'
+            status_color = 'green' if member['above_ma'] else 'red'
+            member_rows += f"<tr><td><b>{member['name']}</b></td><td>{member['code']}</td><td>{member['close']:.2f}</td><td>{ma_value:.2f}</td><td><b style=\"color: {status_color};\">{status}</b></td></tr>"
+        if member_rows:
+            member_rows = f"""
+            <h3>📈 成分股明细：</h3>
+            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
+              <tr style="background-color: #f0f0f0;">
+                <th>名称</th>
+                <th>代码</th>
+                <th>最新收盘价</th>
+                <th>{latest_data['ma_line']}{unit}均线</th>
+                <th>状态</th>
+              </tr>
+              {member_rows}
+            </table>
+            <br>
+            """
         html_content = f"""
         <html>
           <body>
@@ -854,52 +3322,29 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
             <h3>📊 预警信息：</h3>
             <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
               <tr style="background-color: #f0f0f0;">
-                <th>组合名称</th>
+                <th>股票名称</th>
+                <th>股票代码</th>
                 <th>预警类型</th>
                 <th>预警时间</th>
-                <th>操作建议</th>
               </tr>
               <tr>
                 <td><b>{stock_name}</b></td>
+                <td>{stock_code}</td>
                 <td><b style="color: gold;">{alert_info['alert_type']}</b></td>
                 <td>{latest_data['date']}</td>
-                <td><b style="color: green;">建议买入</b></td>
               </tr>
             </table>
             <br>
             
-            <h3>📈 运营商数据详情：</h3>
+            <h3>📈 指标数据：</h3>
             <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">
-              <tr style="background-color: #f0f0f0;">
-                <th>运营商名称</th>
-                <th>股票代码</th>
-                <th>最新收盘价</th>
-                <th>{ma_line}日均线</th>
-                <th>状态</th>
-              </tr>
-            """
-        
-        # 添加运营商数据行
-        for carrier in carriers_data:
-            carrier_name = carrier['name']
-            carrier_code = carrier['code']
-            close = carrier['close']
-            ma_value = carrier[f'ma{ma_line}']
-            above_ma = carrier['above_ma']
-            status = '✓ 站在上方' if above_ma else '✗ 站在下方'
-            status_color = 'green' if above_ma else 'red'
-            
-            html_content += f"<tr><td><b>{carrier_name}</b></td><td>{carrier_code}</td><td>{close:.2f}</td><td>{ma_value:.2f}</td><td><b style=\"color: {status_color};\">{status}</b></td></tr>"
-        
-        # 完成HTML内容
-        html_content += f"""
+              {rows}
             </table>
             <br>
+            {member_rows}
             
             <h3>💡 预警说明：</h3>
-            <p>三大运营商（中国移动、中国联通、中国电信）<b>全部</b>站在<b>{ma_line}日均线</b>上方。</p>
-            <p>这通常被视为<b>行业强势信号</b>，表明通信运营板块整体向好。</p>
-            <p><b>操作建议：</b>可以考虑买入相关股票，分散投资于三大运营商。</p>
+            <p><b>{stock_name}</b>：{describe_rule(stock_config)}。</p>
             <br>
             
             <h3>📊 预警图表：</h3>
@@ -914,18 +3359,25 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
     
     msg.attach(MIMEText(html_content, 'html', 'utf-8'))
     
-    # 嵌入图片
-    if chart_path:
+    # 嵌入图片（使用按图表输出配置缩小的邮件用图）
+    email_chart = chart_variant_path(chart_path, 'email')
+    if email_chart:
         try:
-            with open(chart_path, 'rb') as f:
+            with open(email_chart, 'rb') as f:
                 img_data = f.read()
-                img = MIMEImage(img_data, _subtype='png')
+                img = MIMEImage(img_data, _subtype=image_subtype(email_chart))
                 img.add_header('Content-ID', '<alert_chart>')
                 msg.attach(img)
         except Exception as e:
             print(f"⚠️ 图表嵌入失败：{e}")
-    
-    # 发送邮件
+
+    return deliver_email(msg)
+
+def deliver_email(msg):
+    """通过SMTP发送已构建好的邮件；演练模式下只打印邮件标题，不发送"""
+    if DRY_RUN:
+        print(f"\n🧪 演练模式，未发送邮件：{make_header(decode_header(msg['Subject']))}（收件人：{EMAIL_CONFIG['receiver']}）")
+        return False
     try:
         server = smtplib.SMTP_SSL(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'], timeout=30)
         server.login(EMAIL_CONFIG['sender'], EMAIL_CONFIG['auth_code'])
@@ -936,12 +3388,14 @@ def send_alert_email(alert_info: dict, chart_path: str, stock_config: dict):
         )
         server.quit()
         print(f"\n✅ 预警邮件发送成功！已发送至：{EMAIL_CONFIG['receiver']}")
+        return True
     except smtplib.SMTPAuthenticationError:
         print("❌ 邮件发送失败：授权码错误/邮箱未开启SMTP服务")
     except smtplib.SMTPRecipientsRefused:
         print("❌ 邮件发送失败：收件人邮箱地址错误")
     except Exception as e:
         print(f"❌ 邮件发送失败：{str(e)}")
+    return False
 
 # ===================== 判断是否为交易日 =====================
 def is_trading_day():
@@ -973,423 +3427,2287 @@ def is_trading_day():
             
         return is_trade_day
 
-# ===================== 输出预警配置到txt文件 =====================
-def output_alert_configs():
-    """输出当前正在执行的预警配置到txt文件"""
-    output_dir = os.path.join(os.getcwd(), 'config')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    output_file = os.path.join(output_dir, '预警配置列表.txt')
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(f"股票预警系统配置列表\n")
-        f.write(f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write("="*80 + "\n")
-        
-        for i, stock_config in enumerate(STOCK_CONFIGS, 1):
-            f.write(f"[{i}] 股票名称: {stock_config['name']}\n")
-            f.write(f"   股票代码: {stock_config['code']}\n")
-            f.write(f"   预警类型: {stock_config['alert_type']}\n")
-            
-            if stock_config['alert_type'] == 'golden_cross':
-                f.write(f"   短期均线: {stock_config['ma_short']}日\n")
-                f.write(f"   长期均线: {stock_config['ma_long']}日\n")
-                f.write(f"   预警条件: {stock_config['ma_short']}日均线上穿{stock_config['ma_long']}日均线\n")
-            elif stock_config['alert_type'] == 'three_above_ma':
-                f.write(f"   均线参数: {stock_config['ma_line']}日\n")
-                f.write(f"   预警条件: 连续3个交易日收盘价站在{stock_config['ma_line']}日均线上方\n")
-            elif stock_config['alert_type'] == 'three_carriers_above_ma':
-                f.write(f"   均线参数: {stock_config['ma_line']}日\n")
-                f.write(f"   预警条件: 三大运营商都站在{stock_config['ma_line']}日均线上方\n")
-                f.write(f"   包含股票: {', '.join([carrier['name'] for carrier in stock_config['carriers']])}\n")
-            
-            f.write("-"*80 + "\n")
-        
-        f.write("\n执行时间安排:\n")
-        f.write("- 每个工作日 10:00\n")
-        f.write("- 每个工作日 14:00\n")
-        f.write("- 每个工作日 16:30\n")
-        f.write("- 非交易日自动跳过\n")
-        
-        f.write("\n管理说明:\n")
-        f.write("- 新增预警: 在STOCK_CONFIGS列表中添加新的配置字典\n")
-        f.write("- 删除预警: 从STOCK_CONFIGS列表中移除对应的配置字典\n")
-        f.write("- 修改预警: 编辑STOCK_CONFIGS列表中对应的配置字典\n")
-    
-    print(f"✅ 预警配置列表已输出到: {output_file}")
-    return output_file
+# ===================== 输出预警配置到txt文件 =====================
+def output_alert_configs(stock_configs: list = None):
+    """输出当前正在执行的预警配置到txt文件，配置没有变化时不重写"""
+    stock_configs = STOCK_CONFIGS if stock_configs is None else stock_configs
+    output_dir = os.path.join(os.getcwd(), 'config')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    output_file = os.path.join(output_dir, '预警配置列表.txt')
+    fingerprint = f"{zlib.crc32(json.dumps(stock_configs, sort_keys=True, ensure_ascii=False).encode('utf-8')):08x}"
+    if os.path.exists(output_file):
+        with open(output_file, 'r', encoding='utf-8') as f:
+            if f"配置指纹: {fingerprint}\n" in f.read():
+                print(f"ℹ️  预警配置未变化，沿用: {output_file}")
+                return output_file
+    
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(f"股票预警系统配置列表\n")
+        f.write(f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.write(f"配置指纹: {fingerprint}\n")
+        f.write("="*80 + "\n")
+        
+        for i, stock_config in enumerate(stock_configs, 1):
+            f.write(f"[{i}] 股票名称: {stock_config['name']}\n")
+            f.write(f"   股票代码: {stock_config['code']}\n")
+            f.write(f"   预警类型: {stock_config['alert_type']}\n")
+            if stock_config.get('timeframe', 'daily') != 'daily':
+                f.write(f"   K线周期: {timeframe_label(stock_config)}\n")
+            
+            if stock_config['alert_type'] == 'golden_cross':
+                f.write(f"   短期均线: {stock_config['ma_short']}{timeframe_unit(stock_config)}\n")
+                f.write(f"   长期均线: {stock_config['ma_long']}{timeframe_unit(stock_config)}\n")
+                f.write(f"   预警条件: {stock_config['ma_short']}{timeframe_unit(stock_config)}均线上穿{stock_config['ma_long']}{timeframe_unit(stock_config)}均线\n")
+                if stock_config.get('within_bars', 1) > 1:
+                    f.write(f"   提醒范围: 最近{stock_config['within_bars']}{timeframe_bar_unit(stock_config)}内出现金叉\n")
+            elif stock_config['alert_type'] == 'three_above_ma':
+                f.write(f"   均线参数: {stock_config['ma_line']}{timeframe_unit(stock_config)}\n")
+                f.write(f"   预警条件: 连续{stock_config.get('consecutive_bars', 3)}{timeframe_bar_unit(stock_config)}收盘价站在{stock_config['ma_line']}{timeframe_unit(stock_config)}均线上方\n")
+            elif stock_config['alert_type'] in BASKET_RULES:
+                config = basket_config(stock_config)
+                f.write(f"   预警条件: {describe_rule(stock_config)}\n")
+                if config.get('members'):
+                    f.write(f"   包含股票: {', '.join([member['name'] for member in config['members']])}\n")
+                else:
+                    f.write(f"   成分来源: {'行业板块 ' + config['board'] if config.get('board') else '指数成分 ' + config['index']}\n")
+            else:
+                f.write(f"   预警条件: {describe_rule(stock_config)}\n")
+            
+            f.write("-"*80 + "\n")
+        
+        f.write("\n执行时间安排:\n")
+        f.write("- 每个工作日 10:00\n")
+        f.write("- 每个工作日 14:00\n")
+        f.write("- 每个工作日 16:30\n")
+        f.write("- 非交易日自动跳过\n")
+        
+        f.write("\n管理说明:\n")
+        f.write("- 新增预警: 在监控清单文件（config/watchlist.toml 等）的stocks中添加配置，没有清单文件时编辑STOCK_CONFIGS列表\n")
+        f.write("- 删除预警: 从监控清单文件或STOCK_CONFIGS列表中移除对应的配置\n")
+        f.write("- 修改预警: 编辑对应的配置，盘中监控会自动重新加载监控清单文件\n")
+    
+    print(f"✅ 预警配置列表已输出到: {output_file}")
+    return output_file
+
+# ===================== 生成HTML输出函数 =====================
+# 每天一个报告页面，每次运行作为一个新区块插入到页尾之前：结果逐行写入磁盘，图表路径直接取自运行结果。
+# alert_output/summary.json 记录每天的汇总，每次运行只更新当天的条目；归档索引按固定条数分页，
+# 只重写当天所在的那一页（新开一页时顺带更新上一页的翻页链接），历史越长也不需要全部重新生成。
+REPORT_INDEX_PAGE_SIZE = int(os.environ.get('REPORT_INDEX_PAGE_SIZE', '60'))  # 归档索引每页天数
+REPORT_SUMMARY_FILE = os.path.join(ALERT_OUTPUT_DIR, 'summary.json')
+
+REPORT_STYLE = """
+        body { font-family: Arial, sans-serif; background-color: #f5f5f5; margin: 0; padding: 20px; }
+        .container { max-width: 1200px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 0 10px rgba(0, 0, 0, 0.1); }
+        h1 { color: #333; text-align: center; margin-bottom: 30px; }
+        h2 { color: #555; margin-top: 30px; margin-bottom: 20px; border-bottom: 2px solid #f0f0f0; padding-bottom: 10px; }
+        .summary { background-color: #f9f9f9; padding: 20px; border-radius: 5px; margin-bottom: 30px; }
+        .summary p { margin: 10px 0; font-size: 16px; }
+        .summary strong { color: #333; }
+        .stock-table { width: 100%; border-collapse: collapse; margin-bottom: 30px; }
+        .stock-table th, .stock-table td { padding: 12px; text-align: left; border-bottom: 1px solid #f0f0f0; }
+        .stock-table th { background-color: #f5f5f5; font-weight: bold; color: #333; }
+        .stock-table tr:hover { background-color: #f9f9f9; }
+        .alert-row { background-color: #fff3cd; font-weight: bold; }
+        .alert-row td:first-child { color: #856404; }
+        .footer { text-align: center; margin-top: 50px; padding-top: 20px; border-top: 2px solid #f0f0f0; color: #666; font-size: 14px; }
+        .timestamp { text-align: right; color: #999; font-size: 14px; margin-bottom: 20px; }
+        .run { margin-bottom: 40px; }
+        .chart-container { margin: 30px 0; padding: 20px; border: 1px solid #e0e0e0; border-radius: 5px; background-color: #f9f9f9; }
+        .chart-container h3 { margin-top: 0; color: #555; margin-bottom: 15px; }
+        .chart-image { max-width: 100%; height: auto; border-radius: 3px; box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1); display: block; margin: 0 auto 20px; }
+        .pager { display: flex; justify-content: space-between; margin: 20px 0; }
+"""
+
+REPORT_HEADER = Template("""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>股票预警结果 - $date</title>
+    <style>$style</style>
+</head>
+<body>
+    <div class="container">
+        <h1>股票预警结果 - $date</h1>
+        <div class="timestamp"><a href="$index">返回归档索引</a></div>
+""")
+
+REPORT_SECTION_HEAD = Template("""
+        <div class="run" id="run-$run_id">
+            <h2>第${run_number}次运行（$run_time）</h2>
+            <div class="summary">
+                <p><strong>总计配置数:</strong> ${total}条</p>
+                <p><strong>处理配置数:</strong> ${processed}条</p>
+                <p><strong>预警配置数:</strong> ${alerts}条</p>
+            </div>
+            <table class="stock-table">
+                <tr><th>股票名称</th><th>股票代码</th><th>预警类型</th><th>预警状态</th><th>上次预警</th></tr>
+""")
+
+REPORT_ROW = Template("""                <tr class="$row_class"><td>$name</td><td>$code</td><td>$alert_type</td><td>$status</td><td>$last_alert</td></tr>
+""")
+
+REPORT_CHARTS_HEAD = """            </table>
+            <div class="chart-container">
+"""
+
+REPORT_CHART = Template("""                <h3>$name</h3>
+                <a href="$href"><img src="$src" alt="${name}图表" class="chart-image" loading="lazy"></a>
+""")
+
+REPORT_SECTION_TAIL = """            </div>
+        </div>
+"""
+
+REPORT_FOOTER = Template("""
+        <div class="footer">
+            <p>© $year 股票预警系统 | 本预警仅供参考，不构成投资建议</p>
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+INDEX_PAGE = Template("""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>股票预警归档 - 第${page}页</title>
+    <style>$style</style>
+</head>
+<body>
+    <div class="container">
+        <h1>股票预警归档</h1>
+        <div class="timestamp">第${page}页 · 更新时间: $updated</div>
+        <div class="pager"><span>$newer</span><span>$older</span></div>
+        <table class="stock-table">
+            <tr><th>日期</th><th>运行次数</th><th>处理配置数</th><th>预警数</th><th>预警股票</th></tr>
+$rows        </table>
+        <div class="pager"><span>$newer</span><span>$older</span></div>
+    </div>
+</body>
+</html>
+""")
+
+INDEX_ROW = Template("""            <tr class="$row_class"><td><a href="$report">$date</a></td><td>$runs</td><td>$processed</td><td>$alerts</td><td>$names</td></tr>
+""")
+
+def _report_footer(date: str) -> bytes:
+    return REPORT_FOOTER.substitute(year=date[:4]).encode('utf-8')
+
+@contextmanager
+def report_section_writer(html_file: str, date: str):
+    """打开当天报告并定位到页尾之前，返回逐段写入的函数；退出时补回页尾"""
+    footer = _report_footer(date)
+    complete = False
+    if os.path.exists(html_file):
+        with open(html_file, 'rb') as f:
+            f.seek(max(0, os.path.getsize(html_file) - len(footer)))
+            complete = f.read() == footer
+        if not complete:
+            print(f"⚠️  {html_file}不是可追加的报告格式，重新创建")
+    if not complete:
+        with open(html_file, 'wb') as f:
+            f.write(REPORT_HEADER.substitute(date=date, style=REPORT_STYLE,
+                                             index=os.path.relpath(os.path.join(ALERT_OUTPUT_DIR, 'index.html'), os.path.dirname(html_file))).encode('utf-8'))
+            f.write(footer)
+    with open(html_file, 'r+b') as f:
+        f.seek(-len(footer), os.SEEK_END)
+        f.truncate()
+        try:
+            yield lambda text: f.write(text.encode('utf-8'))
+        finally:
+            f.write(footer)
+
+def load_report_summary() -> dict:
+    """读取归档汇总：{'days': {日期: 当天汇总}}"""
+    if not os.path.exists(REPORT_SUMMARY_FILE):
+        return {'days': {}}
+    with open(REPORT_SUMMARY_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json(path: str, data):
+    """原子地写出JSON文件"""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(path + '.tmp', path)
+
+def _index_page_file(page: int) -> str:
+    return os.path.join(ALERT_OUTPUT_DIR, f'index_{page}.html')
+
+def write_index_page(days: list, page: int, page_count: int):
+    """写出一页归档索引（页内最新日期在前），最后一页同时写为index.html"""
+    entries = days[(page - 1) * REPORT_INDEX_PAGE_SIZE:page * REPORT_INDEX_PAGE_SIZE]
+    rows = ''.join(INDEX_ROW.substitute(
+        row_class='alert-row' if day['alerts'] else '', report=day['report'], date=day['date'], runs=day['runs'],
+        processed=day['processed'], alerts=day['alerts'], names=html.escape('、'.join(day['alert_names'][:10]))
+    ) for day in reversed(entries))
+    content = INDEX_PAGE.substitute(
+        page=page, style=REPORT_STYLE, updated=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), rows=rows,
+        newer=f'<a href="index_{page + 1}.html">← 较新</a>' if page < page_count else '',
+        older=f'<a href="index_{page - 1}.html">较旧 →</a>' if page > 1 else ''
+    )
+    targets = [_index_page_file(page)] + ([os.path.join(ALERT_OUTPUT_DIR, 'index.html')] if page == page_count else [])
+    for target in targets:
+        with open(target + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(target + '.tmp', target)
+
+def update_report_archive(date: str, html_file: str, run: dict):
+    """把本次运行并入当天汇总，只重写当天所在的索引页"""
+    summary = load_report_summary()
+    day = summary['days'].setdefault(date, {
+        'date': date, 'report': os.path.relpath(html_file, ALERT_OUTPUT_DIR).replace(os.sep, '/'),
+        'runs': 0, 'processed': 0, 'alerts': 0, 'alert_names': []
+    })
+    day['runs'] += 1
+    day['processed'] = run['processed']
+    day['alerts'] = len(run['alert_names'])
+    day['alert_names'] = run['alert_names']
+    day['last_run'] = run['time']
+    _write_json(REPORT_SUMMARY_FILE, summary)
+
+    # 当天每次运行的明细汇总
+    day_file = os.path.join(os.path.dirname(html_file), 'summary.json')
+    runs = []
+    if os.path.exists(day_file):
+        with open(day_file, 'r', encoding='utf-8') as f:
+            runs = json.load(f)
+    _write_json(day_file, runs + [run])
+
+    days = [summary['days'][key] for key in sorted(summary['days'])]
+    position = sorted(summary['days']).index(date)
+    page = position // REPORT_INDEX_PAGE_SIZE + 1
+    page_count = (len(days) - 1) // REPORT_INDEX_PAGE_SIZE + 1
+    # 通常只重写当天所在的页；补写较早日期时其后各页的内容都会后移，需要一并重写
+    last_page = page_count if day['runs'] == 1 and position < len(days) - 1 else page
+    for number in range(page, last_page + 1):
+        write_index_page(days, number, page_count)
+    if position == (page - 1) * REPORT_INDEX_PAGE_SIZE and page > 1 and day['runs'] == 1:
+        write_index_page(days, page - 1, page_count)  # 新开一页：上一页需要加上“较新”链接
+
+def generate_html_output(results, stock_configs: list = None):
+    """把本次运行的结果作为新区块追加到当天的HTML报告，并更新归档汇总和索引"""
+    stock_configs = STOCK_CONFIGS if stock_configs is None else stock_configs
+    report_date, report_dir = TODAY_DATE, TODAY_DIR
+    if AS_OF_DATE is not None:
+        # 按历史日期判断的结果单独成报告，不追加到当天报告，也不进入归档索引
+        report_date = AS_OF_DATE.strftime('%Y%m%d')
+        report_dir = os.path.join(ALERT_OUTPUT_DIR, 'as_of', report_date)
+        if not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+    html_file = os.path.join(report_dir, f'预警结果_{report_date}.html')
+    now = datetime.now()
+    run = {'time': now.strftime('%Y-%m-%d %H:%M:%S'), 'total': len(stock_configs), 'processed': len(results),
+           'alert_names': [result['stock_name'] for result in results if result['has_alert']]}
+    run_number = 1
+    day_file = os.path.join(report_dir, 'summary.json')
+    if os.path.exists(day_file):
+        with open(day_file, 'r', encoding='utf-8') as f:
+            run_number = len(json.load(f)) + 1
+
+    with report_section_writer(html_file, report_date) as write:
+        write(REPORT_SECTION_HEAD.substitute(
+            run_id=now.strftime('%H%M%S'), run_number=run_number, run_time=now.strftime('%H:%M:%S'),
+            total=run['total'], processed=run['processed'], alerts=len(run['alert_names'])
+        ))
+        # 结果逐行写入，预警在前；“上次预警”取自信号历史中本根K线之前的最近一次预警
+        history = get_signal_history()
+        for result in sorted(results, key=lambda r: not r['has_alert']):
+            last_alert = None
+            if history is not None and result.get('stock_config'):
+                last_alert = history.last_alert(result['stock_config'], (result['latest_data'] or {}).get('date'))
+            write(REPORT_ROW.substitute(
+                row_class='alert-row' if result['has_alert'] else '',
+                name=html.escape(result['stock_name']), code=html.escape(str(result['stock_code'])),
+                alert_type=html.escape(str(result['alert_type'] or result.get('rule') or '')),
+                status='🚨 预警触发' if result['has_alert'] else '✅ 无预警信号', last_alert=last_alert or '-'
+            ))
+        write(REPORT_CHARTS_HEAD)
+        for result in sorted(results, key=lambda r: not r['has_alert']):
+            if result.get('chart_path'):
+                # 报告中显示缩略图，点击打开原图
+                full = os.path.relpath(result['chart_path'], report_dir).replace(os.sep, '/')
+                thumbnail = chart_variant_path(result['chart_path'], 'thumbnail')
+                write(REPORT_CHART.substitute(
+                    name=html.escape(result['stock_name']), href=html.escape(full),
+                    src=html.escape(os.path.relpath(thumbnail, report_dir).replace(os.sep, '/')) if thumbnail else html.escape(full)
+                ))
+        write(REPORT_SECTION_TAIL)
+
+    if AS_OF_DATE is None:
+        update_report_archive(TODAY_DATE, html_file, run)
+    else:
+        runs = []
+        if os.path.exists(day_file):
+            with open(day_file, 'r', encoding='utf-8') as f:
+                runs = json.load(f)
+        _write_json(day_file, runs + [run])
+    print(f"✅ HTML输出已生成: {html_file}（第{run_number}次运行）")
+    return html_file
+
+# ===================== 单个股票预警检查函数 =====================
+def check_stock_alert(stock_config, df=None, indicators=None):
+    """检查单个股票的预警信号，df为空时自行获取数据；indicators为同一份数据上各规则共用的指标缓存"""
+    stock_name = stock_config['name']
+    stock_code = stock_config['code']
+    alert_type = stock_config['alert_type']
+    unit = timeframe_unit(stock_config)
+    
+    print(f"\n🔍 开始检查：{stock_name}({stock_code}) - {alert_type}")
+    print("-"*80)
+    
+    try:
+        # 1. 获取股票数据（流水线中由获取阶段提前传入）
+        if df is None:
+            df = get_rule_data(stock_config)
+        
+        if df.empty:
+            print(f"❌ 未获取到{stock_name}数据，跳过该股票")
+            return None
+        
+        # 2. 计算均线并检查预警
+        alert_info = calculate_ma_and_check_alert(df, stock_config, indicators)
+        
+        # 3. 输出预警结果
+        print("\n" + "="*80)
+        print(f"股票预警检查结果（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print("="*80)
+        
+        latest_data = alert_info['latest_data']
+        print(f"📊 {stock_name}({stock_code})")
+        close_label = f"相对{stock_config['benchmark']}强弱" if stock_config.get('benchmark') and alert_type in BENCHMARK_RULES else '收盘价'
+        
+        if alert_type == 'golden_cross':
+            # 金叉预警类型输出
+            print(f"   {close_label}: {latest_data['close']:.2f}")
+            ma_short = stock_config['ma_short']
+            ma_long = stock_config['ma_long']
+            print(f"   {ma_short}{unit}均线: {latest_data[f'ma{ma_short}']:.2f}")
+            print(f"   {ma_long}{unit}均线: {latest_data[f'ma{ma_long}']:.2f}")
+            print(f"   均线差值: {latest_data['ma_diff']:.2f}")
+            
+            if alert_info['has_alert']:
+                print(f"\n🚨 预警触发！{alert_info['alert_type']}")
+                print(f"   {ma_short}{unit}均线刚刚上穿{ma_long}{unit}均线")
+            else:
+                print(f"\n✅ 无预警信号")
+        
+        elif alert_type == 'three_above_ma':
+            # 连续站上均线预警类型输出
+            print(f"   {close_label}: {latest_data['close']:.2f}")
+            ma_line = stock_config['ma_line']
+            print(f"   {ma_line}{unit}均线: {latest_data[f'ma{ma_line}']:.2f}")
+            print(f"   连续站上均线天数: {latest_data['consecutive_above_ma']}")
+            
+            if alert_info['has_alert']:
+                print(f"\n🚨 预警触发！{alert_info['alert_type']}")
+                print(f"   连续{stock_config.get('consecutive_bars', 3)}{timeframe_bar_unit(stock_config)}收盘价站在{ma_line}{unit}均线上方")
+            else:
+                print(f"\n✅ 无预警信号")
+        
+        else:
+            # 其他预警类型：输出最新指标数据
+            for key, value in latest_data.items():
+                if key == 'date' or isinstance(value, (list, dict)):
+                    continue
+                print(f"   {INDICATOR_LABELS.get(key, key)}: {format_indicator(key, value)}")
+            
+            if alert_info['has_alert']:
+                print(f"\n🚨 预警触发！{alert_info['alert_type']}")
+                print(f"   {describe_rule(stock_config)}")
+            else:
+                print(f"\n✅ 无预警信号")
+        
+        print("="*80)
+        
+        # 4. 返回结果（包含数据以便后续绘制图表，latest_data供邮件直接使用）
+        return {
+            'stock_name': stock_name,
+            'stock_code': stock_code,
+            'has_alert': alert_info['has_alert'],
+            'alert_type': alert_info['alert_type'],
+            'latest_data': alert_info['latest_data'],
+            'df': alert_info['df'],
+            'stock_config': stock_config
+        }
+        
+    except Exception as e:
+        print(f"\n❌ {stock_name}检查失败：{str(e)}")
+        traceback.print_exc()
+        return None
+
+# ===================== 运行日志（断点续跑） =====================
+# 工作流有30分钟的超时限制。运行过程中逐条记录已完成的检查结果（含图表路径）和已发送的通知，
+# 超时后重跑时从日志恢复，只处理未完成的部分。日志条目超过JOURNAL_RESUME_MINUTES即视为过期，
+# 因此同一天后续的定时运行（间隔数小时）仍会基于最新行情重新检查。
+JOURNAL_DIR = os.path.join(DATA_CACHE_DIR, 'journal', TODAY_DATE)
+JOURNAL_RESUME_MINUTES = int(os.environ.get('JOURNAL_RESUME_MINUTES', '60'))
+
+def config_key(stock_config: dict) -> str:
+    """配置的唯一标识：代码+规则+参数摘要，参数变化后不会误用旧结果"""
+    digest = zlib.crc32(json.dumps(stock_config, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return f"{stock_config['code']}:{stock_config['alert_type']}:{digest:08x}"
+
+class RunJournal:
+    """追加写入的运行日志，每条记录单独落盘，进程被强制终止时最多丢失正在写的一行"""
+
+    def __init__(self, name: str = 'run_journal', resume_minutes: int = JOURNAL_RESUME_MINUTES):
+        if not os.path.exists(JOURNAL_DIR):
+            os.makedirs(JOURNAL_DIR)
+        self.path = os.path.join(JOURNAL_DIR, f'{name}.jsonl')
+        self.results = {}      # config_key -> 精简结果记录
+        self.notified = set()  # 已发送通知的config_key
+        self._lock = threading.Lock()
+        self._load(resume_minutes)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self, resume_minutes: int):
+        """读取未过期的日志条目"""
+        if resume_minutes <= 0 or not os.path.exists(self.path):
+            return
+        cutoff = time.time() - resume_minutes * 60
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 被终止时写了一半的行
+                if entry['ts'] < cutoff:
+                    continue
+                if entry['event'] == 'result':
+                    self.results[entry['key']] = entry['record']
+                elif entry['event'] == 'notified':
+                    self.notified.add(entry['key'])
+        if self.results:
+            print(f"♻️  从运行日志恢复{len(self.results)}条已完成结果，{len(self.notified)}条已发送通知：{self.path}")
+
+    def _append(self, entry: dict):
+        """写入一条日志并立即落盘"""
+        entry['ts'] = time.time()
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def record_result(self, record: dict):
+        """记录一只股票的完成结果（含图表路径）"""
+        key = config_key(record['stock_config'])
+        self.results[key] = record
+        self._append({'event': 'result', 'key': key, 'record': record})
+
+    def record_notified(self, record: dict):
+        """记录已发送的预警通知"""
+        key = config_key(record['stock_config'])
+        self.notified.add(key)
+        self._append({'event': 'notified', 'key': key})
+
+    def was_notified(self, record: dict) -> bool:
+        """该结果的预警通知是否已经发送过"""
+        return config_key(record['stock_config']) in self.notified
+
+    def close(self):
+        """关闭日志文件"""
+        self._file.close()
+
+# ===================== 信号历史 =====================
+# 每次判断的结果都追加到本地SQLite历史表（股票、规则、参数、K线日期、运行时间、预警标志和关键数值），
+# 按股票+规则+日期和日期建索引。报告中的“上次预警”、同一根K线的预警去重和回测对照都直接查询历史表。
+SIGNAL_HISTORY_ENABLED = os.environ.get('SIGNAL_HISTORY', '1') == '1'
+SIGNAL_HISTORY_FILE = os.path.join(DATA_CACHE_DIR, 'signal_history.sqlite')
+SIGNAL_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signal_history (
+    id INTEGER PRIMARY KEY,
+    symbol TEXT NOT NULL,
+    name TEXT,
+    rule TEXT NOT NULL,
+    params TEXT NOT NULL,
+    bar_date TEXT NOT NULL,
+    run_time TEXT NOT NULL,
+    has_alert INTEGER NOT NULL,
+    alert_type TEXT,
+    close REAL,
+    ma_short REAL,
+    ma_long REAL,
+    ma_diff REAL,
+    data TEXT,
+    notified INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_signal_symbol_rule_date ON signal_history (symbol, rule, bar_date);
+CREATE INDEX IF NOT EXISTS idx_signal_date ON signal_history (bar_date);
+"""
+SIGNAL_HISTORY_SHOW_ROWS = 20  # history子命令显示的最近预警条数
+
+def rule_params(stock_config: dict) -> str:
+    """规则参数（不含名称、代码和类型）的规范化JSON，同一规则参数不变时历史记录可以连续对照"""
+    return json.dumps({key: value for key, value in stock_config.items() if key not in ('name', 'code', 'alert_type')},
+                      sort_keys=True, ensure_ascii=False)
+
+def record_bar_date(record: dict) -> str:
+    """结果对应的K线日期，统一为YYYY-MM-DD（没有日期时为今天）"""
+    date = (record['latest_data'] or {}).get('date')
+    return pd.Timestamp(date).strftime('%Y-%m-%d') if date else datetime.now().strftime('%Y-%m-%d')
+
+def _float_or_none(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) else None
+
+class SignalHistory:
+    """判断结果历史表：每条结果一行，多进程（分片）写入时由SQLite加锁"""
+
+    def __init__(self, path: str = SIGNAL_HISTORY_FILE):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.run_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # 本次运行的启动时间
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')  # 写入时不阻塞查询服务等读取方
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SIGNAL_HISTORY_SCHEMA)
+
+    def append(self, record: dict):
+        """追加一条判断结果（make_result_record得到的精简记录）"""
+        latest = record['latest_data'] or {}
+        # 均线按周期从短到长取前两条
+        ma_keys = sorted((key for key in latest if re.fullmatch(r'ma\d+', key)), key=lambda key: int(key[2:]))
+        row = (
+            str(record['stock_code']), record['stock_name'], record['rule'], rule_params(record['stock_config']),
+            record_bar_date(record), self.run_time, int(bool(record['has_alert'])), record['alert_type'],
+            _float_or_none(latest.get('close')),
+            _float_or_none(latest[ma_keys[0]]) if ma_keys else None,
+            _float_or_none(latest[ma_keys[1]]) if len(ma_keys) > 1 else None,
+            _float_or_none(latest.get('ma_diff')),
+            json.dumps(_json_safe(latest), ensure_ascii=False)
+        )
+        with self._lock:
+            self.conn.execute(
+                'INSERT INTO signal_history (symbol, name, rule, params, bar_date, run_time, has_alert, alert_type, '
+                'close, ma_short, ma_long, ma_diff, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.conn.commit()
+
+    @staticmethod
+    def _rule_filter(record: dict) -> tuple:
+        stock_config = record['stock_config']
+        return str(stock_config['code']), stock_config['alert_type'], rule_params(stock_config)
+
+    def mark_notified(self, record: dict):
+        """把该规则在这根K线上的记录标记为已发送预警通知"""
+        bar_date = record_bar_date(record)
+        with self._lock:
+            self.conn.execute('UPDATE signal_history SET notified = 1 WHERE symbol = ? AND rule = ? AND params = ? AND bar_date = ?',
+                              self._rule_filter(record) + (bar_date,))
+            self.conn.commit()
+
+    def was_notified(self, record: dict) -> bool:
+        """该规则在这根K线上的预警是否已经发送过（同一天多次运行不重复发送）"""
+        bar_date = record_bar_date(record)
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM signal_history WHERE symbol = ? AND rule = ? AND params = ? AND bar_date = ? AND notified = 1 LIMIT 1',
+                self._rule_filter(record) + (bar_date,)).fetchone()
+        return row is not None
+
+    def last_alert(self, stock_config: dict, before: str = None) -> str:
+        """该规则最近一次预警的K线日期（before之前），没有时返回None"""
+        sql = 'SELECT MAX(bar_date) FROM signal_history WHERE symbol = ? AND rule = ? AND params = ? AND has_alert = 1'
+        args = (str(stock_config['code']), stock_config['alert_type'], rule_params(stock_config))
+        if before:
+            sql, args = sql + ' AND bar_date < ?', args + (before,)
+        with self._lock:
+            return self.conn.execute(sql, args).fetchone()[0]
+
+    def alert_dates(self, stock_config: dict) -> set:
+        """该规则预警过的全部K线日期"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT DISTINCT bar_date FROM signal_history WHERE symbol = ? AND rule = ? AND params = ? AND has_alert = 1',
+                (str(stock_config['code']), stock_config['alert_type'], rule_params(stock_config))).fetchall()
+        return {row[0] for row in rows}
+
+    def query(self, symbols: list = None, rules: list = None, start: str = None, end: str = None,
+              alerts_only: bool = False, limit: int = None) -> pd.DataFrame:
+        """按股票（代码或名称）、规则和K线日期范围查询历史，最新的在前"""
+        conditions, args = [], []
+        if symbols:
+            marks = ','.join('?' * len(symbols))
+            conditions.append(f'(symbol IN ({marks}) OR name IN ({marks}))')
+            args += list(symbols) * 2
+        if rules:
+            conditions.append(f"rule IN ({','.join('?' * len(rules))})")
+            args += list(rules)
+        if start:
+            conditions.append('bar_date >= ?')
+            args.append(start)
+        if end:
+            conditions.append('bar_date <= ?')
+            args.append(end)
+        if alerts_only:
+            conditions.append('has_alert = 1')
+        sql = 'SELECT * FROM signal_history' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        sql += ' ORDER BY bar_date DESC, run_time DESC, id DESC' + (f' LIMIT {int(limit)}' if limit else '')
+        with self._lock:
+            return pd.read_sql_query(sql, self.conn, params=args)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+_signal_history = None
+_signal_history_lock = threading.Lock()
+
+def get_signal_history() -> SignalHistory:
+    """获取全局信号历史表，SIGNAL_HISTORY=0时返回None"""
+    global _signal_history
+    if not SIGNAL_HISTORY_ENABLED:
+        return None
+    with _signal_history_lock:
+        if _signal_history is None:
+            _signal_history = SignalHistory()
+        return _signal_history
+
+def show_signal_history(symbols: list = None, rules: list = None) -> pd.DataFrame:
+    """history：打印每条规则最近一次预警和最近的预警记录"""
+    history = get_signal_history()
+    if history is None:
+        print("⚠️ 信号历史未启用（SIGNAL_HISTORY=0）")
+        return None
+    alerts = history.query(symbols, rules, alerts_only=True)
+    if alerts.empty:
+        print("ℹ️  信号历史中没有符合条件的预警记录")
+        return alerts
+    columns = ['bar_date', 'name', 'symbol', 'rule', 'alert_type', 'close', 'ma_short', 'ma_long', 'ma_diff', 'run_time']
+    latest = alerts.drop_duplicates(['symbol', 'rule', 'params'])
+    print(f"\n📒 各规则最近一次预警（共{len(alerts)}条预警记录）：")
+    print(latest[columns].to_string(index=False))
+    print(f"\n📒 最近{SIGNAL_HISTORY_SHOW_ROWS}条预警：")
+    print(alerts.head(SIGNAL_HISTORY_SHOW_ROWS)[columns].to_string(index=False))
+    return alerts
+
+# ===================== 监控清单与执行计划 =====================
+# 监控清单可以放在TOML/YAML/JSON文件中（默认查找 config/watchlist.toml|yaml|yml|json，或用环境变量
+# WATCHLIST_FILE / 命令行 --config 指定），没有清单文件时使用上面的STOCK_CONFIGS。
+# 文件格式：{"defaults": {...默认参数，只补充到支持该字段的条目...}, "stocks": [{...与STOCK_CONFIGS相同的配置字典...}]}，
+# 加载时按RULE_SCHEMAS逐条校验，再编译为执行计划：去重后的数据获取任务、指标和规则。
+WATCHLIST_FILE = os.environ.get('WATCHLIST_FILE', '')
+WATCHLIST_CANDIDATES = ['watchlist.toml', 'watchlist.yaml', 'watchlist.yml', 'watchlist.json']
+
+# 所有预警类型共有的字段
+COMMON_FIELDS = {'name': str, 'code': str, 'alert_type': str, 'timeframe': str, 'adjust': str, 'benchmark': str, 'enabled': bool}
+# 每种预警类型的(必填字段, 可选字段)
+RULE_SCHEMAS = {
+    'golden_cross': ({'ma_short': int, 'ma_long': int}, {'within_bars': int}),
+    'three_above_ma': ({'ma_line': int}, {'consecutive_bars': int}),
+    'macd_cross': ({}, {'fast': int, 'slow': int, 'signal': int}),
+    'percentile_low': ({}, {'window': int, 'threshold': float, 'method': str}),
+    'drawdown': ({}, {'window': int, 'threshold': float}),
+    'dividend_yield': ({}, {'window': int, 'green_yield': float, 'red_yield': float, 'green_percentile': float,
+                            'red_percentile': float, 'alert_lights': list}),
+    'relative_strength': ({}, {'period': int, 'threshold': float}),
+    'basket_breadth': ({}, {'members': list, 'board': str, 'index': str, 'metric': str, 'ma_line': int,
+                            'threshold': float, 'direction': str, 'min_coverage': float,
+                            'trigger': str}),
+    'three_carriers_above_ma': ({'ma_line': int, 'carriers': list}, {}),
+    'expression': ({'expr': str}, {'title': str})
+}
+# 取值受限的字段
+FIELD_CHOICES = {
+    'timeframe': TIMEFRAME_UNITS,
+    'adjust': ('qfq', 'hfq', 'none', ''),
+    'method': ('rank', 'range'),
+    'metric': ('pct_above_ma', 'new_crosses'),
+    'direction': ('above', 'below'),
+    'trigger': ('first', 'level'),
+    'alert_lights': tuple(DIVIDEND_LIGHTS.values())
+}
+
+def validate_stock_config(stock_config: dict) -> list:
+    """按预警类型的字段定义校验一条配置，返回错误说明列表（为空表示通过）"""
+    if not isinstance(stock_config, dict):
+        return ['配置必须是字典']
+    alert_type = stock_config.get('alert_type')
+    if alert_type not in RULE_SCHEMAS:
+        return [f"未知的预警类型 {alert_type!r}，可选：{', '.join(RULE_SCHEMAS)}"]
+    required, optional = RULE_SCHEMAS[alert_type]
+    fields = {**COMMON_FIELDS, **required, **optional}
+    errors = [f"缺少字段 {field}" for field in ['name', 'code', *required] if field not in stock_config]
+    for field, value in stock_config.items():
+        expected = fields.get(field)
+        if expected is None:
+            errors.append(f"未知字段 {field}")
+        elif expected is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+            continue
+        elif not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            hint = '（股票代码请加引号写成字符串）' if field == 'code' else ''
+            errors.append(f"字段 {field} 应为{expected.__name__}类型，实际为{type(value).__name__}{hint}")
+        elif field in FIELD_CHOICES:
+            invalid = [item for item in (value if isinstance(value, list) else [value]) if item not in FIELD_CHOICES[field]]
+            if invalid:
+                errors.append(f"字段 {field} 的取值 {invalid} 无效，可选：{', '.join(map(str, FIELD_CHOICES[field]))}")
+    if alert_type == 'expression' and isinstance(stock_config.get('expr'), str):
+        try:
+            parse_expression(stock_config['expr'])
+        except ValueError as e:
+            errors.append(str(e))
+    if alert_type == 'basket_breadth' and not any(stock_config.get(field) for field in ('members', 'board', 'index')):
+        errors.append("篮子规则需要 members、board、index 之一")
+    for member in stock_config.get('members', stock_config.get('carriers', [])) or []:
+        if not isinstance(member, dict) or not isinstance(member.get('code'), str) or 'name' not in member:
+            errors.append(f"成分股 {member!r} 需要包含name和字符串类型的code")
+    return errors
+
+def find_watchlist_file() -> str:
+    """监控清单文件路径：指定的文件优先，否则在config目录中查找，都没有时返回空字符串"""
+    if WATCHLIST_FILE:
+        return WATCHLIST_FILE
+    for filename in WATCHLIST_CANDIDATES:
+        path = os.path.join(os.getcwd(), 'config', filename)
+        if os.path.exists(path):
+            return path
+    return ''
+
+def load_watchlist(path: str) -> list:
+    """读取并校验监控清单文件，返回配置列表；有任何一条配置不合法时抛出ValueError并列出全部问题"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.toml':
+        if tomllib is None:
+            raise ValueError("读取TOML监控清单需要Python 3.11及以上版本，或安装tomli")
+        with open(path, 'rb') as f:
+            content = tomllib.load(f)
+    elif extension in ('.yaml', '.yml'):
+        if yaml is None:
+            raise ValueError("读取YAML监控清单需要安装PyYAML")
+        with open(path, 'r', encoding='utf-8') as f:
+            content = yaml.safe_load(f)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+
+    if isinstance(content, list):
+        content = {'stocks': content}
+    if not isinstance(content, dict) or not isinstance(content.get('stocks'), list):
+        raise ValueError(f"监控清单 {path} 需要包含 stocks 列表")
+    defaults = content.get('defaults', {})
+
+    stock_configs = []
+    errors = []
+    for i, entry in enumerate(content['stocks'], 1):
+        stock_config = entry
+        if isinstance(entry, dict) and entry.get('alert_type') in RULE_SCHEMAS:
+            # 默认参数只补充该预警类型支持的字段
+            required, optional = RULE_SCHEMAS[entry['alert_type']]
+            accepted = {**COMMON_FIELDS, **required, **optional}
+            stock_config = {**{key: value for key, value in defaults.items() if key in accepted}, **entry}
+        problems = validate_stock_config(stock_config)
+        if problems:
+            label = stock_config.get('name', '') if isinstance(stock_config, dict) else ''
+            errors.extend(f"第{i}条{label}：{problem}" for problem in problems)
+        elif stock_config.pop('enabled', True):
+            stock_configs.append(stock_config)
+    if errors:
+        raise ValueError(f"监控清单 {path} 校验失败：\n" + "\n".join(errors))
+    return stock_configs
+
+def get_stock_configs() -> list:
+    """当前生效的预警配置：有监控清单文件时从文件读取，否则使用STOCK_CONFIGS"""
+    path = find_watchlist_file()
+    if not path:
+        return STOCK_CONFIGS
+    stock_configs = load_watchlist(path)
+    print(f"📋 已加载监控清单 {path}（{len(stock_configs)}条配置）")
+    return stock_configs
+
+def data_key(stock_config: dict) -> tuple:
+    """配置所需数据的标识：相同标识的配置共用一次数据获取"""
+    if stock_config['alert_type'] in BASKET_RULES:
+        return ('basket', stock_config['code'])
+    return (stock_config['code'], config_adjust(stock_config))
+
+def rule_indicators(stock_config: dict) -> list:
+    """配置需要计算的指标（带周期和基准，同一数据上相同的指标只需计算一次）"""
+    alert_type = stock_config['alert_type']
+    scope = (stock_config.get('timeframe', 'daily'), stock_config.get('benchmark') if alert_type in BENCHMARK_RULES else None)
+    if alert_type == 'golden_cross':
+        specs = [('sma', stock_config['ma_short']), ('sma', stock_config['ma_long'])]
+    elif alert_type == 'three_above_ma':
+        specs = [('sma', stock_config['ma_line'])]
+    elif alert_type == 'macd_cross':
+        specs = [('macd', stock_config.get('fast', 12), stock_config.get('slow', 26), stock_config.get('signal', 9))]
+    elif alert_type == 'percentile_low':
+        specs = [('percentile', stock_config.get('window', 750), stock_config.get('method', 'rank'))]
+    elif alert_type == 'drawdown':
+        specs = [('rolling_max', stock_config.get('window', 250))]
+    elif alert_type == 'dividend_yield':
+        specs = [('dividend_yield', stock_config.get('window', 750))]
+    elif alert_type == 'relative_strength':
+        specs = [('excess_return', stock_config.get('benchmark', '沪深300'), stock_config.get('period', 20))]
+    elif alert_type == 'expression':
+        # 表达式的每个子节点都是一个指标，不同规则中相同的子表达式在计划中合并
+        specs = [('expression', node) for node in expression_nodes(parse_expression(stock_config['expr'])) if node[0] not in ('num', 'field')]
+    else:
+        specs = [('breadth', basket_config(stock_config).get('ma_line', 20))]
+    return [scope + spec for spec in specs]
+
+class ExecutionPlan:
+    """监控清单编译得到的执行计划：规则、去重后的数据获取任务及每份数据上需要计算的指标"""
+
+    def __init__(self, stock_configs: list):
+        self.rules = {}      # 配置标识 -> 配置
+        self.fetches = {}    # 数据标识 -> 使用该数据的配置标识列表
+        self.indicators = {} # (数据标识, 指标) -> 使用该指标的配置标识列表
+        for stock_config in stock_configs:
+            key = config_key(stock_config)
+            if key in self.rules:
+                continue  # 完全相同的配置只执行一次
+            self.rules[key] = stock_config
+            self.fetches.setdefault(data_key(stock_config), []).append(key)
+            for indicator in rule_indicators(stock_config):
+                self.indicators.setdefault((data_key(stock_config), indicator), []).append(key)
+
+    def groups(self, keys=None) -> list:
+        """按数据标识分组的配置列表，每组只获取一次数据；keys限定只包含部分配置"""
+        groups = []
+        for rule_keys in self.fetches.values():
+            group = [self.rules[key] for key in rule_keys if keys is None or key in keys]
+            if group:
+                groups.append(group)
+        return groups
+
+    def diff(self, other: 'ExecutionPlan') -> tuple:
+        """与新计划比较，返回(新增的配置标识, 删除的配置标识)；参数修改视为删除旧配置并新增新配置"""
+        return [key for key in other.rules if key not in self.rules], [key for key in self.rules if key not in other.rules]
+
+    def summary(self) -> str:
+        return f"{len(self.rules)}条规则，{len(self.fetches)}份数据，{len(self.indicators)}个指标"
+
+class WatchlistWatcher:
+    """监控清单热加载：文件修改后重新加载并编译，校验失败时保留原计划"""
+
+    def __init__(self, stock_configs: list = None):
+        self.path = find_watchlist_file()
+        self.mtime = os.path.getmtime(self.path) if self.path and os.path.exists(self.path) else None
+        self.plan = ExecutionPlan(stock_configs if stock_configs is not None else get_stock_configs())
+
+    def poll(self):
+        """文件有变化时返回(新计划, 新增配置标识, 删除配置标识)，否则返回None"""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return None
+        self.mtime = mtime
+        try:
+            plan = ExecutionPlan(load_watchlist(self.path))
+        except Exception as e:
+            print(f"⚠️ 监控清单重新加载失败，继续使用原配置：{e}")
+            return None
+        added, removed = self.plan.diff(plan)
+        self.plan = plan
+        print(f"🔄 监控清单已重新加载：{plan.summary()}，新增{len(added)}条，删除{len(removed)}条")
+        return plan, added, removed
+
+# ===================== 性能剖析 =====================
+# --profile 时流水线每个阶段的每个任务都在cProfile和tracemalloc快照之间执行：CPU按阶段合并为
+# pstats（可用snakeviz等工具打开.prof文件），内存按分配位置和所属库（akshare/pandas/matplotlib/email等）汇总，
+# 绘图任务在绘图子进程内剖析后把结果传回。未开启时流水线使用原函数，没有任何额外开销。
+# tracemalloc统计整个进程的分配，各阶段并发执行时的内存归属是近似值，按库汇总的结果不受影响。
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '30'))  # 每个阶段输出的热点条数
+PROFILE_DIR = os.path.join(TODAY_DIR, 'profile')
+
+class _ProfileData:
+    """让pstats读取子进程传回的剖析数据"""
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def _allocation_diff(before, after) -> dict:
+    """两次快照之间按分配位置的净增量：位置 -> [字节数, 次数]，剖析工具自身的分配不计入"""
+    ignored = [tracemalloc.Filter(False, module.__file__) for module in (cProfile, pstats, tracemalloc)]
+    return {
+        f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}": [stat.size_diff, stat.count_diff]
+        for stat in after.filter_traces(ignored).compare_to(before.filter_traces(ignored), 'lineno') if stat.size_diff
+    }
+
+def _library_of(location: str) -> str:
+    """分配位置所属的库：第三方包取包名，标准库取模块名"""
+    path = location.rsplit(':', 1)[0].replace('\\', '/')
+    if 'site-packages/' in path:
+        return path.split('site-packages/', 1)[1].split('/', 1)[0]
+    if os.path.basename(path) == os.path.basename(__file__):
+        return 'stock_alert'
+    return f"stdlib:{os.path.splitext(os.path.basename(path))[0]}"
+
+def profiled_call(func, *args, **kwargs):
+    """剖析一次调用（在绘图子进程中使用），返回(结果, CPU剖析数据, 内存分配增量)"""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profile.disable()
+    allocations = _allocation_diff(before, tracemalloc.take_snapshot())
+    if started:
+        tracemalloc.stop()
+    profile.create_stats()
+    return result, profile.stats, allocations
+
+class StageProfiler:
+    """按流水线阶段汇总各任务的CPU剖析和内存分配，运行结束后写入当天输出目录"""
+
+    def __init__(self):
+        self.stages = {}  # 阶段 -> {'stats': pstats.Stats, 'allocations': {位置: [字节数, 次数]}, 'tasks': 任务数, 'wall': 耗时}
+        self.tasks = []   # 每个任务一行：阶段、标识、耗时、CPU时间、净分配字节数
+        self._lock = threading.Lock()
+        # 同一进程中同一时间只能有一个cProfile在工作（Python 3.12起基于sys.monitoring，会同时记录所有线程），
+        # 因此各线程的任务逐个剖析，每份CPU剖析只包含一个任务
+        self._profile_lock = threading.Lock()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def record(self, stage: str, label: str, wall: float, stats: dict, allocations: dict):
+        """并入一个任务的剖析结果"""
+        profile_stats = pstats.Stats(_ProfileData(stats))
+        with self._lock:
+            entry = self.stages.setdefault(stage, {'stats': None, 'allocations': {}, 'tasks': 0, 'wall': 0.0})
+            if entry['stats'] is None:
+                entry['stats'] = profile_stats
+            else:
+                entry['stats'].add(profile_stats)
+            for location, (size, count) in allocations.items():
+                total = entry['allocations'].setdefault(location, [0, 0])
+                total[0] += size
+                total[1] += count
+            entry['tasks'] += 1
+            entry['wall'] += wall
+            self.tasks.append({'stage': stage, 'task': label, 'wall': wall, 'cpu': profile_stats.total_tt,
+                               'allocated': sum(size for size, _ in allocations.values())})
+
+    def run(self, stage: str, label: str, func, *args):
+        """剖析一个任务并返回其结果；剖析本身出错时（例如已有其他剖析工具在工作）照常执行任务，只是不计入剖析"""
+        with self._profile_lock:
+            profile = cProfile.Profile()
+            try:
+                before = tracemalloc.take_snapshot()
+                profile.enable()
+            except Exception as e:
+                print(f"⚠️  {stage}任务{label}无法剖析，照常执行：{e}")
+                return func(*args)
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                wall = time.perf_counter() - started
+                try:
+                    profile.create_stats()
+                    self.record(stage, label, wall, profile.stats, _allocation_diff(before, tracemalloc.take_snapshot()))
+                except Exception as e:
+                    print(f"⚠️  {stage}任务{label}的剖析结果记录失败：{e}")
+
+    def wrap(self, stage: str, func):
+        """包装流水线阶段函数，每个任务单独剖析"""
+        def _profiled(item):
+            return self.run(stage, _task_label(item), func, item)
+        return _profiled
+
+    def write(self) -> str:
+        """写出各阶段的CPU热点（.txt和.prof）、内存分配汇总和任务明细，返回输出目录"""
+        output_dir = os.path.join(PROFILE_DIR, datetime.now().strftime('%H%M%S'))
+        os.makedirs(output_dir, exist_ok=True)
+        current, peak = tracemalloc.get_traced_memory()
+        memory_lines = [f"进程内已跟踪内存：当前{current / 2**20:.1f}MB，峰值{peak / 2**20:.1f}MB", ""]
+        for i, (stage, entry) in enumerate(self.stages.items(), 1):
+            prefix = os.path.join(output_dir, f"{i}_{stage}")
+            if entry['stats'] is not None:
+                entry['stats'].dump_stats(f"{prefix}.prof")
+                with open(f"{prefix}_cpu.txt", 'w', encoding='utf-8') as f:
+                    f.write(f"{stage}：{entry['tasks']}个任务，合计耗时{entry['wall']:.2f}秒\n\n")
+                    stats = pstats.Stats(f"{prefix}.prof", stream=f)
+                    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+                    stats.sort_stats('tottime').print_stats(PROFILE_TOP_N)
+            libraries = {}
+            for location, (size, count) in entry['allocations'].items():
+                library = libraries.setdefault(_library_of(location), [0, 0])
+                library[0] += size
+                library[1] += count
+            memory_lines.append(f"== {stage}：{entry['tasks']}个任务，净分配{sum(v[0] for v in libraries.values()) / 2**20:.1f}MB ==")
+            memory_lines.append("按库汇总：")
+            for library, (size, count) in sorted(libraries.items(), key=lambda item: -abs(item[1][0]))[:PROFILE_TOP_N]:
+                memory_lines.append(f"  {size / 2**20:>10.2f}MB {count:>10}次  {library}")
+            memory_lines.append("按分配位置：")
+            for location, (size, count) in sorted(entry['allocations'].items(), key=lambda item: -abs(item[1][0]))[:PROFILE_TOP_N]:
+                memory_lines.append(f"  {size / 2**20:>10.2f}MB {count:>10}次  {location}")
+            memory_lines.append("")
+        with open(os.path.join(output_dir, 'memory.txt'), 'w', encoding='utf-8') as f:
+            f.write("\n".join(memory_lines))
+        pd.DataFrame(self.tasks, columns=['stage', 'task', 'wall', 'cpu', 'allocated']).sort_values(
+            'wall', ascending=False).to_csv(os.path.join(output_dir, 'tasks.csv'), index=False, encoding='utf-8-sig')
+
+        print(f"\n🔬 性能剖析结果已保存：{output_dir}")
+        for stage, entry in self.stages.items():
+            print(f"   {stage}：{entry['tasks']}个任务，耗时{entry['wall']:.2f}秒，"
+                  f"净分配{sum(size for size, _ in entry['allocations'].values()) / 2**20:.1f}MB")
+        return output_dir
+
+def _task_label(item) -> str:
+    """流水线任务的标识（股票代码）"""
+    if isinstance(item, list):
+        return item[0]['code'] if item else ''
+    if isinstance(item, dict):
+        if 'stock_configs' in item:
+            return item['stock_configs'][0]['code']
+        return str(item.get('stock_code', ''))
+    return str(item)
+
+PROFILER = None  # --profile 时为StageProfiler
+
+# ===================== 流水线执行 =====================
+# 获取 -> 判断 -> 绘图（进程池） -> 通知 四个阶段通过有界队列串联，各阶段同时工作，
+# 队列满时上游自动阻塞（背压），内存中同时存在的K线数据量受队列长度限制。
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '8'))    # 每个阶段间队列长度
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '8'))                 # 数据获取线程数
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))  # 绘图进程数
+CHART_MODE = os.environ.get('CHART_MODE', 'all')  # all: 全部绘图；alert: 只绘制预警股票；none: 不绘图
+
+_PIPELINE_DONE = object()  # 阶段结束标记
+
+class PriorityStageQueue(queue.PriorityQueue):
+    """预警结果优先出队的阶段队列：有预警的在前，其余按进入顺序，结束标记排在最后"""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self._sequence = itertools.count()
+
+    def put(self, item, block=True, timeout=None):
+        rank = 2 if item is _PIPELINE_DONE else 0 if item['has_alert'] else 1
+        super().put((rank, next(self._sequence), item), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        return super().get(block, timeout)[2]
+
+def _start_stage(stage_name, func, in_queue, out_queue, workers, flush=None):
+    """启动一个流水线阶段：workers个线程从in_queue取任务，结果放入out_queue，返回收尾线程
+
+    flush为攒批处理的阶段在全部任务结束后调用一次，返回尚未输出的结果。
+    """
+    def _worker():
+        while True:
+            item = in_queue.get()
+            if item is _PIPELINE_DONE:
+                in_queue.put(_PIPELINE_DONE)  # 让同阶段其他线程也能退出
+                return
+            try:
+                output = func(item)
+            except Exception as e:
+                print(f"❌ 流水线{stage_name}阶段任务失败：{e}")
+                traceback.print_exc()
+                continue
+            _emit(output)
+
+    def _emit(output):
+        if output is None or out_queue is None:
+            return
+        # 返回列表时逐个放入下一阶段（一次获取的数据对应多条规则）
+        for result in (output if isinstance(output, list) else [output]):
+            if result is not None:
+                out_queue.put(result)
+
+    threads = [threading.Thread(target=_worker, name=f"{stage_name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    def _close():
+        for thread in threads:
+            thread.join()
+        if flush is not None:
+            try:
+                _emit(flush())
+            except Exception as e:
+                print(f"❌ 流水线{stage_name}阶段任务失败：{e}")
+                traceback.print_exc()
+        if out_queue is not None:
+            out_queue.put(_PIPELINE_DONE)
+
+    closer = threading.Thread(target=_close, name=f"{stage_name}-closer", daemon=True)
+    closer.start()
+    return closer
+
+def _fetch_task(stock_configs):
+    """获取阶段：为共用同一份数据的一组配置下载一次K线数据；临近截止时间时不再获取（留待续跑）"""
+    if not RUN_DEADLINE.allows('fetch'):
+        return None
+    return {'stock_configs': stock_configs, 'df': get_rule_data(stock_configs[0], stock_configs)}
+
+def _evaluate_task(item, indicators=None):
+    """判断阶段：逐条配置计算指标并检查预警，同组配置共用指标计算结果"""
+    indicators = {} if indicators is None else indicators
+    return [check_stock_alert(stock_config, item['df'], indicators) for stock_config in item['stock_configs']]
+
+class ExpressionBatcher:
+    """判断阶段：含日线表达式规则的组攒够EXPRESSION_PANEL_BATCH组后，先在这批股票的面板上
+    一次求出全部表达式节点，再逐组判断；其余组直接判断，不等待"""
+
+    def __init__(self, size: int = None):
+        self.size = EXPRESSION_PANEL_BATCH if size is None else size
+        self.pending = []
+
+    def __call__(self, item):
+        if self.size <= 1 or not panel_expression_configs(item['stock_configs']):
+            return _evaluate_task(item)
+        self.pending.append(item)
+        return self.flush() if len(self.pending) >= self.size else None
+
+    def flush(self) -> list:
+        batch = [(item['stock_configs'], item['df'], {}) for item in self.pending]
+        self.pending = []
+        prefill_expression_indicators(batch)
+        return [result for stock_configs, df, indicators in batch
+                for result in _evaluate_task({'stock_configs': stock_configs, 'df': df}, indicators)]
+
+def _to_builtin(value):
+    """把numpy/pandas标量转换为Python内置类型，便于保存和序列化"""
+    if isinstance(value, dict):
+        return {key: _to_builtin(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_builtin(item) for item in value]
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+def make_result_record(result: dict) -> dict:
+    """把单只股票的检查结果压缩为精简记录：只保留代码、名称、规则、预警标志和最新数值"""
+    return {
+        'stock_name': result['stock_name'],
+        'stock_code': result['stock_code'],
+        'rule': result['stock_config']['alert_type'],
+        'alert_type': result['alert_type'],
+        'has_alert': bool(result['has_alert']),
+        'latest_data': _to_builtin(result['latest_data']),
+        'chart_path': result.get('chart_path'),
+        'stock_config': result['stock_config']
+    }
+
+def chart_wanted(has_alert: bool) -> bool:
+    """按CHART_MODE判断该结果是否需要绘图"""
+    return CHART_MODE == 'all' or (CHART_MODE == 'alert' and bool(has_alert))
+
+def chart_missing(record: dict) -> bool:
+    """预警结果记录的图表文件不在本机（例如日志从缓存恢复到新的运行器上），续跑时需要重新绘图"""
+    return bool(record['has_alert'] and record.get('chart_path') and not os.path.exists(record['chart_path']))
+
+def _render_task(render_pool, result, journal=None):
+    """绘图阶段：提交到进程池绘制图表，完成后立即释放K线和指标数据"""
+    result['chart_path'] = None
+    if chart_wanted(result['has_alert']) and RUN_DEADLINE.allows('alert_chart' if result['has_alert'] else 'chart'):
+        print(f"\n📊 正在绘制{result['stock_name']}图表...")
+        try:
+            if PROFILER is None:
+                result['chart_path'] = render_pool.submit(
+                    plot_alert_chart, result['df'], result['stock_config'], result['has_alert']
+                ).result(timeout=RUN_DEADLINE.timeout())
+            else:
+                # 剖析模式：在绘图子进程内剖析，结果随图表路径一起传回
+                started = time.perf_counter()
+                result['chart_path'], stats, allocations = render_pool.submit(
+                    profiled_call, plot_alert_chart, result['df'], result['stock_config'], result['has_alert']
+                ).result(timeout=RUN_DEADLINE.timeout())
+                PROFILER.record('绘图', str(result['stock_code']), time.perf_counter() - started, stats, allocations)
+        except Exception as e:
+            print(f"  ❌ {result['stock_name']}图表绘制失败：{e}")
+    # 之后的阶段只需要最新数值，K线和指标数据不再跟随结果传递
+    record = make_result_record(result)
+    if journal:
+        journal.record_result(record)
+    # 按历史日期（--as-of）回放的结果不是实时信号，不写入信号历史
+    history = get_signal_history()
+    if history is not None and AS_OF_DATE is None:
+        history.append(record)
+    return record
+
+def _notify_task(record, journal=None):
+    """通知阶段：有预警时发送邮件，直接使用判断阶段的结果，无需重新获取数据"""
+    if record['has_alert']:
+        if journal and journal.was_notified(record):
+            print(f"\nℹ️  {record['stock_name']}预警邮件已在本轮发送过，跳过")
+            return record
+        history = get_signal_history()
+        if history is not None and history.was_notified(record):
+            print(f"\nℹ️  {record['stock_name']}在这根K线上的预警邮件已发送过，跳过")
+            return record
+        print(f"\n📧 正在发送{record['stock_name']}预警邮件...")
+        if send_alert_email(record, record['chart_path'], record['stock_config']):
+            if journal:
+                journal.record_notified(record)
+            if history is not None:
+                history.mark_notified(record)
+    return record
+
+def run_pipeline(stock_configs: list, notify: bool = True, journal: RunJournal = None) -> list:
+    """以流水线方式执行全部预警检查，返回精简结果记录列表
+
+    每只股票的K线和指标数据在绘图后即被释放，运行期间内存占用只取决于队列长度、并发数和
+    表达式规则的攒批组数，与监控股票数量无关。notify为False时不发送单只股票的预警邮件（分片执行时由合并步骤统一发送）。
+    传入journal时跳过日志中已完成的配置，并把新完成的结果和通知写入日志。
+    """
+    results = []
+    if journal:
+        pending = []
+        for stock_config in stock_configs:
+            record = journal.results.get(config_key(stock_config))
+            # 图表文件已不存在的预警结果重新判断和绘图，补发的邮件才能附上图表（已发送的不会重复发送）
+            if record is None or chart_missing(record):
+                pending.append(stock_config)
+                continue
+            # 已完成的结果直接复用，上次被中断时尚未发出的通知在这里补发
+            results.append(_notify_task(record, journal) if notify else record)
+        if len(pending) < len(stock_configs):
+            print(f"♻️  跳过{len(stock_configs) - len(pending)}条已完成的配置，剩余{len(pending)}条")
+        stock_configs = pending
+        if not stock_configs:
+            return results
+
+    # 编译执行计划：共用同一份数据的配置合为一组，只获取一次
+    plan = ExecutionPlan(stock_configs)
+    groups = plan.groups()
+    print(f"🧭 执行计划：{plan.summary()}")
+
+    # 判断之后的队列让预警结果优先绘图和通知
+    feed_queue, eval_queue = (queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(2))
+    render_queue, notify_queue = (PriorityStageQueue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(2))
+    # 绘图使用spawn子进程：matplotlib非线程安全，且避免在多线程进程中fork
+    mp_context = multiprocessing.get_context('spawn')
+    notify_stage = lambda record: results.append(_notify_task(record, journal) if notify else record)
+    batcher = ExpressionBatcher()
+    fetch_stage, evaluate_stage = _fetch_task, batcher
+    if PROFILER is not None:
+        # 剖析模式：获取、判断、通知阶段的每个任务单独剖析（绘图在子进程内剖析）
+        fetch_stage, evaluate_stage, notify_stage = (
+            PROFILER.wrap('获取', fetch_stage), PROFILER.wrap('判断', evaluate_stage), PROFILER.wrap('通知', notify_stage))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, RENDER_WORKERS), mp_context=mp_context) as render_pool:
+        stages = [
+            _start_stage('获取', fetch_stage, feed_queue, eval_queue, max(1, min(FETCH_WORKERS, len(groups)))),
+            _start_stage('判断', evaluate_stage, eval_queue, render_queue, 1, flush=batcher.flush),
+            _start_stage('绘图', lambda result: _render_task(render_pool, result, journal), render_queue, notify_queue, max(1, RENDER_WORKERS)),
+            _start_stage('通知', notify_stage, notify_queue, None, 1),
+        ]
+        for group in groups:
+            feed_queue.put(group)
+        feed_queue.put(_PIPELINE_DONE)
+        for stage in stages:
+            stage.join()
+    if _bar_archive is not None:
+        # 本轮写入存档的K线，索引在这里统一写出一次
+        _bar_archive.flush()
+    if RUN_DEADLINE.skipped:
+        print(f"\n⏰ 因运行时间不足跳过：{RUN_DEADLINE.summary()}（未完成的配置下次运行时续跑）")
+    return results
+
+# ===================== 分片执行与合并 =====================
+# 按股票代码的哈希把配置确定性地分到N个分片，每个分片独立运行并写出部分结果，
+# 最后由合并步骤汇总为一份HTML报告、一封预警摘要邮件和一份运行指标。
+SHARD_DIR = os.path.join(TODAY_DIR, 'shards')
+
+def parse_shard(shard: str) -> tuple:
+    """解析形如"i/N"的分片参数（i从1开始）"""
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"分片参数格式应为 i/N，例如 1/4：{shard}")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"分片序号超出范围：{shard}")
+    return index, count
+
+def select_shard(stock_configs: list, index: int, count: int) -> list:
+    """选出属于第index个分片的配置，同一股票的所有规则落在同一分片"""
+    return [c for c in stock_configs if zlib.crc32(c['code'].encode('utf-8')) % count == index - 1]
+
+def _shard_file(index: int, count: int) -> str:
+    """分片部分结果文件路径"""
+    return os.path.join(SHARD_DIR, f'shard_{index}of{count}.json')
+
+def write_shard_results(records: list, index: int, count: int, started_at: datetime, config_count: int) -> str:
+    """写出单个分片的部分结果和运行指标"""
+    if not os.path.exists(SHARD_DIR):
+        os.makedirs(SHARD_DIR)
+    finished_at = datetime.now()
+    payload = {
+        'shard': index,
+        'shard_count': count,
+        'metrics': {
+            'started_at': started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'finished_at': finished_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'elapsed_seconds': round((finished_at - started_at).total_seconds(), 2),
+            'configs': config_count,
+            'processed': len(records),
+            'alerts': sum(1 for record in records if record['has_alert'])
+        },
+        'records': records
+    }
+    shard_file = _shard_file(index, count)
+    # 先写临时文件再替换，避免合并时读到写了一半的文件
+    with open(shard_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(shard_file + '.tmp', shard_file)
+    print(f"✅ 分片{index}/{count}结果已保存: {shard_file}（处理{len(records)}只，预警{payload['metrics']['alerts']}只）")
+    return shard_file
+
+def run_shard(stock_configs: list, index: int, count: int, resume: bool = True) -> str:
+    """执行单个分片：不单独发送邮件，只写出部分结果和图表"""
+    started_at = datetime.now()
+    shard_configs = select_shard(stock_configs, index, count)
+    print(f"🧩 分片{index}/{count}：共{len(shard_configs)}条配置")
+    journal = RunJournal(f'run_journal_shard_{index}of{count}', JOURNAL_RESUME_MINUTES if resume else 0)
+    try:
+        records = run_pipeline(shard_configs, notify=False, journal=journal)
+    finally:
+        journal.close()
+    return write_shard_results(records, index, count, started_at, len(shard_configs))
+
+def send_alert_digest_email(records: list):
+    """把所有预警合并为一封摘要邮件发送"""
+    alerts = [record for record in records if record['has_alert']]
+    if not alerts:
+        print("ℹ️  无预警信号，不发送摘要邮件")
+        return False
+
+    msg = MIMEMultipart('related')
+    msg['From'] = EMAIL_CONFIG['sender']
+    msg['To'] = EMAIL_CONFIG['receiver']
+    msg['Subject'] = Header(f"股票预警摘要_{len(alerts)}只_{datetime.now().strftime('%Y%m%d')}", 'utf-8')
+
+    sections = []
+    images = []
+    for i, record in enumerate(alerts):
+        values = "".join(
+            f"<tr><td>{INDICATOR_LABELS.get(key, key)}</td><td>{format_indicator(key, value)}</td></tr>"
+            for key, value in record['latest_data'].items() if not isinstance(value, (list, dict))
+        )
+        chart_html = ""
+        email_chart = chart_variant_path(record.get('chart_path'), 'email')
+        if email_chart and os.path.exists(email_chart):
+            chart_html = f'<img src="cid:alert_chart_{i}" style="border: none; max-width: 100%; display: block;" />'
+            images.append((f'alert_chart_{i}', email_chart))
+        sections.append(f"""
+            <h3>🚨 {record['stock_name']}（{record['stock_code']}）- {record['alert_type']}</h3>
+            <table border="1" cellpadding="8" cellspacing="0" style="border-collapse: collapse;">{values}</table>
+            {chart_html}
+        """)
 
-# ===================== 生成HTML输出函数 =====================
-def generate_html_output(results):
-    """生成HTML输出，将预警结果保存到alert_output文件夹中的以日期命名的子文件夹中"""
-    # 创建以日期命名的子文件夹
-    today_date = datetime.now().strftime('%Y%m%d')
-    html_output_dir = os.path.join(ALERT_OUTPUT_DIR, today_date)
-    if not os.path.exists(html_output_dir):
-        os.makedirs(html_output_dir)
-    
-    # 创建HTML文件
-    html_file = os.path.join(html_output_dir, f'预警结果_{today_date}.html')
-    
-    # 构建HTML内容
     html_content = f"""
-    <!DOCTYPE html>
-    <html lang="zh-CN">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>股票预警结果 - {today_date}</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                background-color: #f5f5f5;
-                margin: 0;
-                padding: 20px;
-            }}
-            .container {{
-                max-width: 1200px;
-                margin: 0 auto;
-                background-color: white;
-                padding: 30px;
-                border-radius: 10px;
-                box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
-            }}
-            h1 {{
-                color: #333;
-                text-align: center;
-                margin-bottom: 30px;
-            }}
-            h2 {{
-                color: #555;
-                margin-top: 30px;
-                margin-bottom: 20px;
-                border-bottom: 2px solid #f0f0f0;
-                padding-bottom: 10px;
-            }}
-            .summary {{
-                background-color: #f9f9f9;
-                padding: 20px;
-                border-radius: 5px;
-                margin-bottom: 30px;
-            }}
-            .summary p {{
-                margin: 10px 0;
-                font-size: 16px;
-            }}
-            .summary strong {{
-                color: #333;
-            }}
-            .stock-table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin-bottom: 30px;
-            }}
-            .stock-table th,
-            .stock-table td {{
-                padding: 12px;
-                text-align: left;
-                border-bottom: 1px solid #f0f0f0;
-            }}
-            .stock-table th {{
-                background-color: #f5f5f5;
-                font-weight: bold;
-                color: #333;
-            }}
-            .stock-table tr:hover {{
-                background-color: #f9f9f9;
-            }}
-            .alert-row {{
-                background-color: #fff3cd;
-                font-weight: bold;
-            }}
-            .alert-row td:first-child {{
-                color: #856404;
-            }}
-            .footer {{
-                text-align: center;
-                margin-top: 50px;
-                padding-top: 20px;
-                border-top: 2px solid #f0f0f0;
-                color: #666;
-                font-size: 14px;
-            }}
-            .timestamp {{
-                text-align: right;
-                color: #999;
-                font-size: 14px;
-                margin-bottom: 20px;
-            }}
-            .chart-container {{
-                margin: 30px 0;
-                padding: 20px;
-                border: 1px solid #e0e0e0;
-                border-radius: 5px;
-                background-color: #f9f9f9;
-            }}
-            .chart-container h3 {{
-                margin-top: 0;
-                color: #555;
-                margin-bottom: 15px;
-            }}
-            .chart-image {{
-                max-width: 100%;
-                height: auto;
-                border-radius: 3px;
-                box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-                display: block;
-                margin: 0 auto;
-            }}
-            .no-chart {{
-                text-align: center;
-                color: #999;
-                padding: 20px;
-                font-style: italic;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>股票预警结果</h1>
-            <div class="timestamp">生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
-            
-            <div class="summary">
-                <h2>执行结果汇总</h2>
-                <p><strong>总计股票数:</strong> {len(STOCK_CONFIGS)}只</p>
-                <p><strong>处理股票数:</strong> {len(results)}只</p>
-                <p><strong>预警股票数:</strong> {sum(1 for result in results if result['has_alert'])}只</p>
-                <p><strong>执行时间:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-            </div>
-            
-            <h2>预警详情</h2>
-            <table class="stock-table">
-                <tr>
-                    <th>股票名称</th>
-                    <th>股票代码</th>
-                    <th>预警类型</th>
-                    <th>预警状态</th>
-                </tr>
-            """
-    
-    # 添加股票预警结果行
-    for result in results:
-        stock_name = result['stock_name']
-        stock_code = result['stock_code']
-        alert_type = result['alert_type']
-        has_alert = result['has_alert']
-        
-        alert_status = '🚨 预警触发' if has_alert else '✅ 无预警信号'
-        row_class = 'alert-row' if has_alert else ''
-        
-        html_content += f"""
-                <tr class="{row_class}">
-                    <td>{stock_name}</td>
-                    <td>{stock_code}</td>
-                    <td>{alert_type}</td>
-                    <td>{alert_status}</td>
-                </tr>
-            """
-    
-    # 完成HTML内容
-    html_content += f"""
-            </table>
-            
-            <h2>股票图表</h2>
-            <div class="chart-container">
-            """
-    
-    # 查找并添加图片
-    for stock_config in STOCK_CONFIGS:
-        stock_name = stock_config['name']
-        # 查找当天的图片文件
-        latest_date = datetime.now().strftime('%Y%m%d')
-        # 构建可能的图片文件名
-        possible_filenames = [
-            f"{stock_name}_均线预警_{latest_date}_预警.png",
-            f"{stock_name}_均线预警_{latest_date}_正常.png"
-        ]
-        
-        # 检查图片是否存在
-        chart_path = None
-        for filename in possible_filenames:
-            full_path = os.path.join(PICTURE_DIR, filename)
-            if os.path.exists(full_path):
-                chart_path = full_path
-                break
-        
-        # 添加图表到HTML
-        if chart_path:
-            # 生成相对路径
-            relative_path = os.path.relpath(chart_path, html_output_dir)
-            html_content += f"""
-                <h3>{stock_name}</h3>
-                <img src="{relative_path}" alt="{stock_name}图表" class="chart-image">
-            """
-        else:
-            html_content += f"""
-                <h3>{stock_name}</h3>
-                <div class="no-chart">暂无图表数据</div>
-            """
-    
-    # 完成HTML内容
-    html_content += f"""
-            </div>
-            
-            <div class="footer">
-                <p>© {datetime.now().year} 股票预警系统 | 本预警仅供参考，不构成投资建议</p>
-            </div>
-        </div>
-    </body>
+    <html>
+      <body>
+        <h2>🚨 股票预警摘要（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}）</h2>
+        <p>本次共检查<b>{len(records)}</b>只股票，其中<b>{len(alerts)}</b>只触发预警。</p>
+        {''.join(sections)}
+        <br>
+        <p>⚠️ 本预警仅供参考，不构成投资建议</p>
+      </body>
     </html>
     """
-    
-    # 写入HTML文件
-    with open(html_file, 'w', encoding='utf-8') as f:
-        f.write(html_content)
-    
-    print(f"✅ HTML输出已生成: {html_file}")
+    msg.attach(MIMEText(html_content, 'html', 'utf-8'))
+    for content_id, chart_path in images:
+        try:
+            with open(chart_path, 'rb') as f:
+                img = MIMEImage(f.read(), _subtype=image_subtype(chart_path))
+            img.add_header('Content-ID', f'<{content_id}>')
+            msg.attach(img)
+        except Exception as e:
+            print(f"⚠️ 图表嵌入失败：{e}")
+    return deliver_email(msg)
+
+def merge_shard_results(notify: bool = True, stock_configs: list = None) -> str:
+    """合并当天所有分片结果：生成一份HTML报告、一封摘要邮件和一份运行指标文件"""
+    shard_files = sorted(glob.glob(os.path.join(SHARD_DIR, 'shard_*of*.json')))
+    if not shard_files:
+        print(f"❌ 未找到分片结果：{SHARD_DIR}")
+        return None
+
+    records = {}
+    shard_metrics = []
+    expected = set()
+    for shard_file in shard_files:
+        with open(shard_file, 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+        expected.add(payload['shard_count'])
+        shard_metrics.append(dict(payload['metrics'], shard=payload['shard'], shard_count=payload['shard_count']))
+        for record in payload['records']:
+            records[(record['stock_code'], record['rule'])] = record
+
+    found = {(m['shard'], m['shard_count']) for m in shard_metrics}
+    for count in expected:
+        missing = [i for i in range(1, count + 1) if (i, count) not in found]
+        if missing:
+            print(f"⚠️ 分片数{count}中缺少分片：{missing}，报告只包含已完成的分片")
+
+    records = list(records.values())
+    html_file = generate_html_output(records, stock_configs)
+    if notify:
+        send_alert_digest_email(records)
+
+    metrics = {
+        'date': TODAY_DATE,
+        'merged_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'shards': sorted(shard_metrics, key=lambda m: (m['shard_count'], m['shard'])),
+        'processed': len(records),
+        'alerts': sum(1 for record in records if record['has_alert']),
+        'max_shard_seconds': max(m['elapsed_seconds'] for m in shard_metrics),
+        'total_shard_seconds': round(sum(m['elapsed_seconds'] for m in shard_metrics), 2)
+    }
+    metrics_file = os.path.join(TODAY_DIR, f'运行指标_{TODAY_DATE}.json')
+    with open(metrics_file, 'w', encoding='utf-8') as f:
+        json.dump(metrics, f, ensure_ascii=False, indent=2)
+    print(f"✅ 已合并{len(shard_files)}个分片（{len(records)}只股票），运行指标: {metrics_file}")
     return html_file
 
-# ===================== 单个股票预警检查函数 =====================
-def check_stock_alert(stock_config):
-    """检查单个股票的预警信号"""
-    stock_name = stock_config['name']
-    stock_code = stock_config['code']
+# ===================== 历史回测与参数扫描 =====================
+# --mode backtest 用缓存的完整历史回放监控清单中的规则（--universe 时套用到存档中的全部股票），
+# 找出每一个历史触发日并统计其后5/20/60根K线的收益。--sweep 对一种规则做参数扫描：
+# 参数网格用到的均线一次算好，全部参数组合在参数维度上广播比较，再按股票分块、用矩阵乘法
+# 汇总每个组合的触发次数、平均收益和胜率，不需要逐个参数循环。
+BACKTEST_DIR = os.path.join(TODAY_DIR, 'backtest')
+BACKTEST_HORIZONS = [int(h) for h in os.environ.get('BACKTEST_HORIZONS', '5,20,60').split(',')]  # 统计之后多少根K线的收益
+SWEEP_SYMBOL_CHUNK = int(os.environ.get('SWEEP_SYMBOL_CHUNK', '128'))  # 参数扫描每块股票数
+SWEEP_PARAM_CHUNK = int(os.environ.get('SWEEP_PARAM_CHUNK', '64'))     # 参数扫描每块参数组合数
+# 触发信号所在的列（其余预警类型取图表配置中的signal）
+RULE_SIGNAL_COLUMNS = {'golden_cross': 'golden_cross', 'three_above_ma': 'first_three_above_ma'}
+# 支持参数扫描的规则及默认网格
+SWEEP_GRIDS = {
+    'golden_cross': {'ma_short': range(5, 61), 'ma_long': range(5, 61)},
+    'three_above_ma': {'ma_line': range(5, 61), 'consecutive_bars': range(1, 11)},
+}
+
+def forward_returns(close, horizon: int) -> np.ndarray:
+    """每根K线之后horizon根的收益率（沿时间方向，面板亦可），之后数据不足为NaN"""
+    x = np.asarray(close, dtype=float)
+    result = np.full(x.shape, np.nan)
+    if horizon < len(x):
+        result[:len(x) - horizon] = x[horizon:] / x[:len(x) - horizon] - 1.0
+    return result
+
+def signal_column(stock_config: dict) -> str:
+    """规则的触发信号列"""
     alert_type = stock_config['alert_type']
-    
-    print(f"\n🔍 开始检查：{stock_name}({stock_code}) - {alert_type}")
-    print("-"*80)
-    
+    if alert_type in RULE_SIGNAL_COLUMNS:
+        return RULE_SIGNAL_COLUMNS[alert_type]
+    if alert_type in BASKET_RULES:
+        return 'breadth_alert'
+    return RULE_CHART_SPECS[alert_type](stock_config)['signal']
+
+def backtest_rule(df: pd.DataFrame, stock_config: dict, indicators: dict = None) -> tuple:
+    """回放一条规则的全部历史，返回(触发日及其后各周期收益, 全部K线的平均收益作为基准)"""
+    data = calculate_ma_and_check_alert(df, stock_config, indicators)['df']
+    columns = ['date', 'close'] + [f'ret_{h}' for h in BACKTEST_HORIZONS]
+    if data.empty:
+        return pd.DataFrame(columns=columns), {}
+    hits = data[signal_column(stock_config)].fillna(False).to_numpy(dtype=bool)
+    # 相对基准的规则用实际股价计算收益
+    price = data['price' if 'price' in data.columns else 'close'].to_numpy(dtype=float)
+    signals = {'date': data['date'].to_numpy()[hits], 'close': price[hits]}
+    baseline = {}
+    for h in BACKTEST_HORIZONS:
+        returns = forward_returns(price, h)
+        signals[f'ret_{h}'] = returns[hits]
+        baseline[h] = np.nanmean(returns) if np.isfinite(returns).any() else np.nan
+    return pd.DataFrame(signals, columns=columns), baseline
+
+def rule_label(stock_config: dict) -> str:
+    """规则类型加参数的简写（不含名称和代码），回测中按此汇总同一规则在各股票上的表现"""
+    params = ','.join(f"{key}={value}" for key, value in stock_config.items() if key not in ('name', 'code', 'alert_type'))
+    return f"{stock_config['alert_type']}({params})"
+
+def summarize_signals(signals: pd.DataFrame) -> dict:
+    """触发次数及各周期的平均收益和胜率"""
+    summary = {'signals': len(signals)}
+    for h in BACKTEST_HORIZONS:
+        returns = signals[f'ret_{h}'].dropna()
+        summary[f'mean_{h}'] = returns.mean() if len(returns) else np.nan
+        summary[f'win_{h}'] = (returns > 0).mean() if len(returns) else np.nan
+    return summary
+
+def archived_stock_data(stock_code: str, adjust: str = None) -> pd.DataFrame:
+    """只读取本地K线存档和已缓存的复权因子，不访问网络（全市场回测使用）"""
+    adjust = PRICE_ADJUST if adjust is None else adjust
+    df = get_bar_archive().read_frame(stock_code)
+    factor_file = os.path.join(ADJUST_FACTOR_DIR, f'{stock_code}.csv')
+    if df.empty or adjust not in ('qfq', 'hfq') or not os.path.exists(factor_file):
+        return df
+    return apply_adjustment(df, pd.read_csv(factor_file, parse_dates=['date']), adjust)
+
+def universe_configs(stock_configs: list) -> list:
+    """把监控清单中的规则（去掉名称和代码）套用到存档中的全部股票，篮子规则不适用"""
+    templates = []
+    for stock_config in stock_configs:
+        template = {key: value for key, value in stock_config.items() if key not in ('name', 'code')}
+        if stock_config['alert_type'] not in BASKET_RULES and template not in templates:
+            templates.append(template)
+    codes = sorted(get_bar_archive().symbols)
+    return [{'name': code, 'code': code, **template} for template in templates for code in codes]
+
+def run_backtest(stock_configs: list, universe: bool = False) -> str:
+    """回放全部规则的历史触发，输出每次触发的明细和每条规则的汇总，返回汇总文件路径"""
+    if universe:
+        stock_configs = universe_configs(stock_configs)
+    plan = ExecutionPlan(stock_configs)
+    print(f"\n🔁 历史回测：{plan.summary()}，统计之后{'/'.join(map(str, BACKTEST_HORIZONS))}根K线的收益")
+
+    details, summaries = [], []
+    history = get_signal_history()
+    groups = plan.groups()
+    for start in range(0, len(groups), max(1, EXPRESSION_PANEL_BATCH)):
+        # 每批组的数据一起载入，日线表达式规则在这批股票的面板上一次求值
+        batch = []
+        for group in groups[start:start + max(1, EXPRESSION_PANEL_BATCH)]:
+            first = group[0]
+            df = archived_stock_data(first['code'], config_adjust(first)) if universe else get_rule_data(first, group)
+            if not df.empty:
+                batch.append((group, df, {}))
+        prefill_expression_indicators(batch)
+        for group, df, indicators in batch:
+            for stock_config in group:
+                try:
+                    signals, baseline = backtest_rule(df, stock_config, indicators)
+                except Exception as e:
+                    print(f"  ❌ {stock_config['name']}({stock_config['code']}) {stock_config['alert_type']}回测失败：{e}")
+                    continue
+                rule = rule_label(stock_config)
+                signals.insert(0, 'rule', rule)
+                signals.insert(0, 'name', stock_config['name'])
+                signals.insert(0, 'code', stock_config['code'])
+                details.append(signals)
+                summary = {'code': stock_config['code'], 'name': stock_config['name'], 'rule': rule,
+                           'bars': len(df), **summarize_signals(signals)}
+                summary.update({f'base_{h}': value for h, value in baseline.items()})
+                if history is not None:
+                    # 与信号历史对照：实盘记录的预警日中有多少也是回测信号日
+                    live = history.alert_dates(stock_config)
+                    summary['live_alerts'] = len(live)
+                    summary['live_matched'] = len(live & set(pd.to_datetime(signals['date']).dt.strftime('%Y-%m-%d')))
+                summaries.append(summary)
+
+    if not os.path.exists(BACKTEST_DIR):
+        os.makedirs(BACKTEST_DIR)
+    stamp = datetime.now().strftime('%H%M%S')
+    detail_file = os.path.join(BACKTEST_DIR, f'backtest_signals_{stamp}.csv')
+    summary_file = os.path.join(BACKTEST_DIR, f'backtest_summary_{stamp}.csv')
+    detail_df = pd.concat(details, ignore_index=True) if details else pd.DataFrame()
+    detail_df.to_csv(detail_file, index=False, encoding='utf-8-sig')
+    summary_df = pd.DataFrame(summaries)
+    summary_df.to_csv(summary_file, index=False, encoding='utf-8-sig')
+
+    # 按规则汇总（全市场回测时同一规则有很多只股票）
+    if not detail_df.empty:
+        print(f"\n{'规则':<50}{'触发次数':>8}" + ''.join(f"{f'{h}根均值':>10}{f'{h}根胜率':>10}" for h in BACKTEST_HORIZONS))
+        for rule, signals in detail_df.groupby('rule', sort=False):
+            summary = summarize_signals(signals)
+            print(f"{rule[:48]:<50}{summary['signals']:>8}" + ''.join(
+                f"{summary[f'mean_{h}']:>10.2%}{summary[f'win_{h}']:>10.1%}" for h in BACKTEST_HORIZONS))
+    if 'live_alerts' in summary_df.columns and summary_df['live_alerts'].sum():
+        print("\n📒 与信号历史对照（盘中未完成的K线、数据修订会造成不一致）：")
+        for rule, rows in summary_df[summary_df['live_alerts'] > 0].groupby('rule', sort=False):
+            print(f"  {rule[:48]}：实盘预警{rows['live_alerts'].sum()}次，其中{rows['live_matched'].sum()}次与回测信号一致")
+    print(f"\n✅ 回测明细已保存：{detail_file}")
+    print(f"✅ 回测汇总已保存：{summary_file}")
+    return summary_file
+
+def parse_grid(items: list) -> dict:
+    """解析 --grid 参数：name=起:止[:步长]（含终点）或 name=a,b,c"""
+    grid = {}
+    for item in items or []:
+        name, _, values = item.partition('=')
+        if ':' in values:
+            parts = [int(part) for part in values.split(':')]
+            grid[name.strip()] = range(parts[0], parts[1] + 1, parts[2] if len(parts) > 2 else 1)
+        else:
+            grid[name.strip()] = [int(value) for value in values.split(',') if value.strip()]
+    return grid
+
+def _sweep_returns(close: np.ndarray) -> np.ndarray:
+    """扫描时与触发信号相乘的矩阵：每个周期依次为[收益有效, 收益, 是否上涨]，行对应日期×股票"""
+    columns = []
+    for h in BACKTEST_HORIZONS:
+        returns = forward_returns(close, h).reshape(-1)
+        valid = np.isfinite(returns)
+        columns += [valid, np.where(valid, returns, 0.0), valid & (returns > 0)]
+    return np.stack(columns, axis=1).astype(np.float32)
+
+def _sweep_golden_cross(close: np.ndarray, grid: dict) -> tuple:
+    """金叉参数扫描：返回(参数组合列表, 各组合触发次数, 各组合×统计量的汇总矩阵)"""
+    pairs = [(s, l) for s in grid['ma_short'] for l in grid['ma_long'] if s < l]
+    windows = sorted({w for pair in pairs for w in pair})
+    position = {w: i for i, w in enumerate(windows)}
+    ma = np.stack([_as_panel(sma(close, w)).astype(np.float32) for w in windows])  # 窗口×日期×股票
+    returns = _sweep_returns(close)
+    counts = np.zeros(len(pairs))
+    totals = np.zeros((len(pairs), returns.shape[1]))
+    for start in range(0, len(pairs), SWEEP_PARAM_CHUNK):
+        chunk = pairs[start:start + SWEEP_PARAM_CHUNK]
+        diff = ma[[position[s] for s, _ in chunk]] - ma[[position[l] for _, l in chunk]]
+        cross = np.zeros(diff.shape, dtype=np.float32)
+        with np.errstate(invalid='ignore'):
+            cross[:, 1:] = (diff[:, :-1] <= 0) & (diff[:, 1:] > 0)
+        flat = cross.reshape(len(chunk), -1)
+        counts[start:start + len(chunk)] = flat.sum(axis=1)
+        totals[start:start + len(chunk)] = flat @ returns
+    return pairs, counts, totals
+
+def _sweep_three_above_ma(close: np.ndarray, grid: dict) -> tuple:
+    """连续N根站上均线参数扫描：游程只按均线周期计算一次，不同N在游程结果上广播比较"""
+    lines = list(grid['ma_line'])
+    bars = np.asarray(list(grid['consecutive_bars']))
+    x = _as_panel(close)
+    returns = _sweep_returns(close)
+    combos, counts, totals = [], [], []
+    step = max(1, SWEEP_PARAM_CHUNK // len(bars))
+    for start in range(0, len(lines), step):
+        chunk = lines[start:start + step]
+        with np.errstate(invalid='ignore'):
+            above = np.stack([x > _as_panel(sma(x, w)) for w in chunk], axis=1)  # 日期×均线×股票
+        streak = streak_length(above)
+        hits = (streak[..., None] == bars).transpose(1, 3, 0, 2).reshape(len(chunk) * len(bars), -1).astype(np.float32)
+        combos += [(w, int(b)) for w in chunk for b in bars]
+        counts.append(hits.sum(axis=1))
+        totals.append(hits @ returns)
+    return combos, np.concatenate(counts), np.vstack(totals)
+
+SWEEP_KERNELS = {'golden_cross': _sweep_golden_cross, 'three_above_ma': _sweep_three_above_ma}
+
+def run_parameter_sweep(rule: str, stock_configs: list, grid: dict = None, universe: bool = False) -> str:
+    """对一种规则在参数网格上做回测扫描（日线），股票分块处理以控制内存，返回结果文件路径"""
+    grid = {**SWEEP_GRIDS[rule], **(grid or {})}
+    if universe:
+        symbols = [(code, code) for code in sorted(get_bar_archive().symbols)]
+        load = lambda code, name: archived_stock_data(code)
+    else:
+        symbols = list(dict.fromkeys((c['code'], c['name']) for c in stock_configs if c['alert_type'] not in BASKET_RULES))
+        load = get_stock_data
+    names = list(grid)
+    print(f"\n🧪 参数扫描：{rule}，网格 {', '.join(f'{k}={min(v)}~{max(v)}' for k, v in grid.items())}，{len(symbols)}只股票")
+
+    started = time.time()
+    combos, counts, totals = None, None, None
+    for start in range(0, len(symbols), SWEEP_SYMBOL_CHUNK):
+        chunk = symbols[start:start + SWEEP_SYMBOL_CHUNK]
+        frames = {code: load(code, name) for code, name in chunk}
+        # 每只股票在自己的K线轴上计算，与逐只回测一致（按日期对齐时停牌会在序列中留下NaN）
+        codes, close = stack_bars(frames, 'close')
+        if not codes:
+            continue
+        combos, chunk_counts, chunk_totals = SWEEP_KERNELS[rule](close, grid)
+        counts = chunk_counts if counts is None else counts + chunk_counts
+        totals = chunk_totals if totals is None else totals + chunk_totals
+        print(f"  ⏱️  已完成{min(start + SWEEP_SYMBOL_CHUNK, len(symbols))}/{len(symbols)}只，用时{time.time() - started:.1f}秒")
+    if combos is None:
+        print("⚠️  没有可用的K线数据")
+        return None
+
+    result = pd.DataFrame(combos, columns=names)
+    result['signals'] = counts.astype(int)
+    for i, h in enumerate(BACKTEST_HORIZONS):
+        valid = totals[:, 3 * i]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[f'mean_{h}'] = totals[:, 3 * i + 1] / valid
+            result[f'win_{h}'] = totals[:, 3 * i + 2] / valid
+    sort_key = f'mean_{BACKTEST_HORIZONS[len(BACKTEST_HORIZONS) // 2]}'
+    result = result.sort_values(sort_key, ascending=False, na_position='last').reset_index(drop=True)
+
+    if not os.path.exists(BACKTEST_DIR):
+        os.makedirs(BACKTEST_DIR)
+    sweep_file = os.path.join(BACKTEST_DIR, f"sweep_{rule}_{datetime.now().strftime('%H%M%S')}.csv")
+    result.to_csv(sweep_file, index=False, encoding='utf-8-sig')
+    print(f"\n{len(result)}个参数组合，按{sort_key}排序前20：")
+    print(result.head(20).to_string(index=False))
+    print(f"\n✅ 参数扫描结果已保存：{sweep_file}（用时{time.time() - started:.1f}秒）")
+    return sweep_file
+
+# ===================== 分阶段命令 =====================
+# 子命令只执行需要的阶段：fetch 只把数据下载到本地缓存；evaluate 只判断（不绘图、不发邮件）；
+# render 判断并绘图；notify 发送已判断结果的预警邮件；report 用已判断结果生成HTML报告。
+# 各阶段的结果写入当天的阶段日志，后面的阶段直接读取，例如盘前fetch预热、14:00再快速evaluate。
+# serve 和 history 不属于流水线阶段：分别启动本地查询服务（见“查询服务”）和查询信号历史（见“信号历史”）。
+STAGE_COMMANDS = ['run', 'fetch', 'evaluate', 'render', 'notify', 'report', 'serve', 'history']
+STAGE_JOURNAL_NAME = 'stage_journal'
+STAGE_RECORD_MINUTES = 24 * 60  # notify/report读取当天全部阶段结果
+# --as-of只用于这些子命令：结果写入单独的阶段日志（stage_journal）和alert_output/as_of/<日期>报告，
+# 不会与当天的实时运行日志、报告和归档索引混用
+AS_OF_COMMANDS = ['evaluate', 'render', 'notify', 'report']
+
+def parse_list(text: str) -> list:
+    """解析逗号分隔的列表参数"""
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+def parse_as_of(text: str) -> pd.Timestamp:
+    """解析--as-of日期（YYYY-MM-DD或YYYYMMDD）"""
     try:
-        # 1. 获取股票数据
-        df = get_stock_data(stock_code, stock_name)
-        
-        if df.empty:
-            print(f"❌ 未获取到{stock_name}数据，跳过该股票")
-            return None
-        
-        # 2. 计算均线并检查预警
-        alert_info = calculate_ma_and_check_alert(df, stock_config)
-        
-        # 3. 输出预警结果
-        print("\n" + "="*80)
-        print(f"股票预警检查结果（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("="*80)
-        
-        latest_data = alert_info['latest_data']
-        print(f"📊 {stock_name}({stock_code})")
-        
-        if alert_type == 'golden_cross':
-            # 金叉预警类型输出
-            print(f"   收盘价: {latest_data['close']:.2f}")
-            ma_short = stock_config['ma_short']
-            ma_long = stock_config['ma_long']
-            print(f"   {ma_short}日均线: {latest_data[f'ma{ma_short}']:.2f}")
-            print(f"   {ma_long}日均线: {latest_data[f'ma{ma_long}']:.2f}")
-            print(f"   均线差值: {latest_data['ma_diff']:.2f}")
-            
-            if alert_info['has_alert']:
-                print(f"\n🚨 预警触发！{alert_info['alert_type']}")
-                print(f"   {ma_short}日均线刚刚上穿{ma_long}日均线")
-            else:
-                print(f"\n✅ 无预警信号")
-        
-        elif alert_type == 'three_above_ma':
-            # 连续站上均线预警类型输出
-            print(f"   收盘价: {latest_data['close']:.2f}")
-            ma_line = stock_config['ma_line']
-            print(f"   {ma_line}日均线: {latest_data[f'ma{ma_line}']:.2f}")
-            print(f"   连续站上均线天数: {latest_data['consecutive_above_ma']}")
-            
-            if alert_info['has_alert']:
-                print(f"\n🚨 预警触发！{alert_info['alert_type']}")
-                print(f"   连续3个交易日收盘价站在{ma_line}日均线上方")
+        return pd.Timestamp(text).normalize()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式应为 YYYY-MM-DD 或 YYYYMMDD：{text}")
+
+def filter_stock_configs(stock_configs: list, symbols: list = None, rules: list = None) -> list:
+    """按股票代码（或名称）和预警类型筛选配置"""
+    if symbols:
+        stock_configs = [c for c in stock_configs if c['code'] in symbols or c['name'] in symbols]
+    if rules:
+        stock_configs = [c for c in stock_configs if c['alert_type'] in rules]
+    return stock_configs
+
+def stage_journal(resume_minutes: int) -> RunJournal:
+    """阶段日志；按历史日期判断的结果单独记录，不与当天的实时结果混用"""
+    name = STAGE_JOURNAL_NAME if AS_OF_DATE is None else f"{STAGE_JOURNAL_NAME}_asof_{AS_OF_DATE.strftime('%Y%m%d')}"
+    return RunJournal(name, resume_minutes)
+
+def _warm_group(stock_configs: list) -> int:
+    """预热一组配置的数据：K线存档和复权因子（或篮子成分），以及规则用到的基准指数和分红记录"""
+    if not RUN_DEADLINE.allows('fetch'):
+        return 0
+    df = get_rule_data(stock_configs[0], stock_configs)
+    for stock_config in stock_configs:
+        alert_type = stock_config['alert_type']
+        if alert_type == 'relative_strength':
+            get_benchmark(stock_config.get('benchmark', '沪深300'))
+        elif alert_type in BENCHMARK_RULES and stock_config.get('benchmark'):
+            get_benchmark(stock_config['benchmark'])
+        elif alert_type == 'dividend_yield':
+            get_dividend_history(stock_config['code'])
+    return len(df)
+
+def warm_data_store(stock_configs: list) -> int:
+    """fetch：只下载数据写入本地缓存，不做判断，返回获取成功的数据份数"""
+    started = time.time()
+    plan = ExecutionPlan(stock_configs)
+    groups = plan.groups()
+    print(f"📥 预热本地数据：{plan.summary()}")
+    done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(groups)))) as pool:
+        futures = {pool.submit(_warm_group, group): group for group in groups}
+        for future in concurrent.futures.as_completed(futures):
+            group = futures[future]
+            try:
+                bars = future.result()
+            except Exception as e:
+                print(f"  ❌ {group[0]['name']}({group[0]['code']})数据获取失败：{e}")
+                continue
+            if bars:
+                done += 1
             else:
-                print(f"\n✅ 无预警信号")
-        
-        print("="*80)
-        
-        # 4. 返回结果（包含数据以便后续在主线程中绘制图表）
-        return {
-            'stock_name': stock_name,
-            'stock_code': stock_code,
-            'has_alert': alert_info['has_alert'],
-            'alert_type': alert_info['alert_type'],
-            'df': alert_info['df'],
-            'stock_config': stock_config
-        }
-        
-    except Exception as e:
-        print(f"\n❌ {stock_name}检查失败：{str(e)}")
-        import traceback
-        traceback.print_exc()
+                print(f"  ⚠️  未获取到{group[0]['name']}({group[0]['code']})数据")
+    if RUN_DEADLINE.skipped:
+        print(f"⏰ 因运行时间不足跳过：{RUN_DEADLINE.summary()}")
+    print(f"✅ 已预热{done}/{len(groups)}份数据（用时{time.time() - started:.1f}秒）")
+    return done
+
+def run_stage_pipeline(stock_configs: list, resume: bool = True) -> list:
+    """evaluate/render：执行获取、判断（和绘图）阶段，不发送邮件，结果写入阶段日志"""
+    journal = stage_journal(JOURNAL_RESUME_MINUTES if resume else 0)
+    # 之前只判断未绘图的结果需要补画图表，不能直接复用
+    for key, record in list(journal.results.items()):
+        if not record.get('chart_path') and chart_wanted(record['has_alert']):
+            del journal.results[key]
+    try:
+        records = run_pipeline(stock_configs, notify=False, journal=journal)
+    finally:
+        journal.close()
+    alerts = [record for record in records if record['has_alert']]
+    print(f"\n✅ 已判断{len(records)}条配置，{len(alerts)}条预警，结果已写入阶段日志：{journal.path}")
+    for record in alerts:
+        print(f"  🚨 {record['stock_name']}({record['stock_code']}) {record['alert_type']}")
+    return records
+
+def load_stage_records(stock_configs: list) -> tuple:
+    """notify/report：读取阶段日志中当天的判断结果，返回(日志, 结果列表)"""
+    journal = stage_journal(STAGE_RECORD_MINUTES)
+    records = [journal.results[config_key(c)] for c in stock_configs if config_key(c) in journal.results]
+    missing = len(stock_configs) - len(records)
+    if missing:
+        print(f"⚠️ {missing}条配置没有阶段结果，请先执行 evaluate 或 render")
+    return journal, records
+
+def run_stage_command(command: str, stock_configs: list, resume: bool = True):
+    """执行一个分阶段子命令"""
+    if command == 'fetch':
+        return warm_data_store(stock_configs)
+    if command in ('evaluate', 'render'):
+        return run_stage_pipeline(stock_configs, resume)
+    journal, records = load_stage_records(stock_configs)
+    try:
+        if not records:
+            return None
+        if command == 'notify':
+            return [_notify_task(record, journal) for record in records]
+        html_file = generate_html_output(records, stock_configs)
+        print(f"\n✅ HTML预警结果已生成：{html_file}")
+        return html_file
+    finally:
+        journal.close()
+
+# ===================== 查询服务 =====================
+# 可选的本地HTTP服务（serve子命令），供看板等工具查询JSON：最新信号、单只股票的指标序列和预警历史。
+# 数据从本地存档和内存读取，同一份数据两次获取至少间隔SERVE_REFRESH_SECONDS，且同一时刻只有一个请求触发获取；
+# 判断结果按最新K线缓存，K线不变时所有请求直接复用，查询方再多也不会引起额外的数据获取。
+SERVE_HOST = os.environ.get('SERVE_HOST', '127.0.0.1')
+SERVE_PORT = int(os.environ.get('SERVE_PORT', '8765'))
+SERVE_REFRESH_SECONDS = int(os.environ.get('SERVE_REFRESH_SECONDS', '300'))  # 同一份数据两次获取的最短间隔
+SERVE_SERIES_BARS = 250   # 指标序列默认返回的K线数
+SERVE_HISTORY_DAYS = 30   # 预警历史默认查询的天数
+
+def roll_over_day() -> bool:
+    """长时间运行的进程跨过零点后，把当天日期、数据截止日期和按日期划分的目录切换到新的一天"""
+    global TODAY_DATE, DATA_END_DATE, TODAY_DIR, PICTURE_DIR, CHART_EMAIL_DIR, CHART_THUMBNAIL_DIR
+    global JOURNAL_DIR, PROFILE_DIR, SHARD_DIR, BACKTEST_DIR
+    today = datetime.now().strftime('%Y%m%d')
+    if today == TODAY_DATE:
+        return False
+    TODAY_DATE = DATA_END_DATE = today
+    TODAY_DIR = os.path.join(ALERT_OUTPUT_DIR, TODAY_DATE)
+    PICTURE_DIR = os.path.join(TODAY_DIR, 'picture')
+    CHART_EMAIL_DIR = os.path.join(PICTURE_DIR, 'email')
+    CHART_THUMBNAIL_DIR = os.path.join(PICTURE_DIR, 'thumbs')
+    JOURNAL_DIR = os.path.join(DATA_CACHE_DIR, 'journal', TODAY_DATE)
+    PROFILE_DIR = os.path.join(TODAY_DIR, 'profile')
+    SHARD_DIR = os.path.join(TODAY_DIR, 'shards')
+    BACKTEST_DIR = os.path.join(TODAY_DIR, 'backtest')
+    if not os.path.exists(PICTURE_DIR):
+        os.makedirs(PICTURE_DIR)
+    print(f"📅 日期切换为{TODAY_DATE}")
+    return True
+
+def _json_safe(value):
+    """转换为可序列化的JSON值：numpy/pandas标量转为内置类型，NaN转为null"""
+    value = _to_builtin(value)
+    if isinstance(value, dict):
+        return {key: _json_safe(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_json_safe(item) for item in value]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+def bar_stamp(df: pd.DataFrame) -> tuple:
+    """数据的K线标识：最新K线日期、K线数和最新收盘价（盘中未完成的K线更新后标识也会变化）"""
+    if df.empty:
         return None
+    return (df['date'].iloc[-1], len(df), float(df['close'].iloc[-1]))
+
+def frame_records(df: pd.DataFrame) -> list:
+    """把K线和指标表转换为JSON记录列表"""
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime('%Y-%m-%d')
+    return _json_safe(df.astype(object).where(df.notna(), None).to_dict('records'))
+
+def signal_payload(stock_config: dict, result: dict) -> dict:
+    """一条配置的最新信号"""
+    return _json_safe({
+        'stock_name': stock_config['name'],
+        'stock_code': stock_config['code'],
+        'rule': stock_config['alert_type'],
+        'description': describe_rule(stock_config),
+        'has_alert': bool(result['has_alert']),
+        'alert_type': result['alert_type'],
+        'latest_data': result['latest_data'],
+        'stock_config': stock_config
+    })
+
+class QueryCache:
+    """查询服务的数据和结果缓存：数据按标识定时刷新，判断结果按K线标识缓存"""
+
+    def __init__(self, stock_configs: list, symbols: list = None, rules: list = None):
+        self.watcher = WatchlistWatcher(stock_configs)
+        self.filters = (symbols, rules)
+        self.data = {}       # 数据标识 -> (获取时间, 数据)
+        self.results = {}    # 配置标识 -> (K线标识, 判断结果)
+        self.indicators = {} # 数据标识 -> (K线标识, 共用指标缓存)
+        self.stats = {'fetches': 0, 'evaluations': 0, 'hits': 0}
+        self.memos_at = time.monotonic()  # 上次清空进程内基准指数和成分股缓存的时间
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def stock_configs(self) -> list:
+        """当前生效的配置（监控清单修改后自动重新加载）"""
+        with self._lock:
+            change = self.watcher.poll()
+            if change:
+                for key in change[2]:
+                    self.results.pop(key, None)
+        return filter_stock_configs(list(self.watcher.plan.rules.values()), *self.filters)
+
+    def expire_memos(self):
+        """进程内的基准指数和成分股K线缓存与数据同周期过期（否则相对强弱和篮子宽度停留在启动时），跨过零点时切换日期"""
+        with self._lock:
+            if time.monotonic() - self.memos_at < SERVE_REFRESH_SECONDS:
+                return
+            self.memos_at = time.monotonic()
+        roll_over_day()
+        clear_benchmark_memo()
+        clear_member_frames()
+
+    def get_data(self, stock_config: dict) -> pd.DataFrame:
+        """读取配置所需数据：距上次获取不足SERVE_REFRESH_SECONDS时直接使用内存中的数据，获取失败时沿用旧数据"""
+        key = data_key(stock_config)
+        with self._key_lock(('data',) + key):
+            cached = self.data.get(key)
+            if cached is not None and time.monotonic() - cached[0] < SERVE_REFRESH_SECONDS:
+                return cached[1]
+            self.expire_memos()
+            plan = self.watcher.plan
+            group = [plan.rules[rule_key] for rule_key in plan.fetches.get(key, [])] or [stock_config]
+            try:
+                df = get_rule_data(stock_config, group)
+            except Exception as e:
+                print(f"⚠️ {stock_config['name']}({stock_config['code']})数据刷新失败：{e}")
+                df = pd.DataFrame()
+            with self._lock:
+                self.stats['fetches'] += 1
+            if df.empty and cached is not None:
+                df = cached[1]
+            elif cached is not None and bar_stamp(df) == bar_stamp(cached[1]):
+                df = cached[1]  # K线没有变化：保留原数据，缓存的判断结果继续有效
+            self.data[key] = (time.monotonic(), df)
+            return df
+
+    def get_result(self, stock_config: dict) -> dict:
+        """配置的判断结果（含指标序列），K线没有变化时复用缓存"""
+        df = self.get_data(stock_config)
+        if df.empty:
+            return None
+        stamp = bar_stamp(df)
+        key = config_key(stock_config)
+        with self._key_lock(('result',) + data_key(stock_config)):
+            cached = self.results.get(key)
+            if cached is not None and cached[0] == stamp:
+                with self._lock:
+                    self.stats['hits'] += 1
+                return cached[1]
+            # 同一份数据上的配置共用指标计算结果，K线变化后重新计算
+            shared = self.indicators.get(data_key(stock_config))
+            if shared is None or shared[0] != stamp:
+                shared = self.indicators[data_key(stock_config)] = (stamp, {})
+            result = calculate_ma_and_check_alert(df, stock_config, shared[1])
+            self.results[key] = (stamp, result)
+            with self._lock:
+                self.stats['evaluations'] += 1
+            return result
+
+    def get_results(self, stock_configs: list) -> list:
+        """并发读取多条配置的判断结果，返回[(配置, 结果)]，没有数据的配置跳过"""
+        plan = ExecutionPlan(stock_configs)
+        groups = plan.groups()
+        def _group_results(group):
+            return [(stock_config, self.get_result(stock_config)) for stock_config in group]
+        pairs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(groups)))) as pool:
+            for group_pairs in pool.map(_group_results, groups):
+                pairs.extend(pair for pair in group_pairs if pair[1] is not None)
+        return pairs
+
+    def alert_history(self, since: str, symbols: list = None, rules: list = None) -> list:
+        """从信号历史表读取预警记录：每条规则每根K线取最后一次运行的结果，之后被撤销的盘中预警不计入"""
+        history = get_signal_history()
+        if history is None:
+            return []
+        results = history.query(symbols, rules, start=since)
+        keys = ['symbol', 'rule', 'params', 'bar_date']
+        results['notified'] = results.groupby(keys)['notified'].transform('max')
+        latest = results.drop_duplicates(keys)
+        alerts = latest[latest['has_alert'] == 1]
+        return [{
+            'time': row['run_time'], 'bar_date': row['bar_date'], 'stock_name': row['name'], 'stock_code': row['symbol'],
+            'rule': row['rule'], 'params': json.loads(row['params']), 'alert_type': row['alert_type'],
+            'has_alert': True, 'notified': bool(row['notified']), 'latest_data': json.loads(row['data'])
+        } for row in alerts.to_dict('records')]
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """查询服务的请求处理：只支持GET，返回JSON"""
+
+    routes = {
+        '/': 'health', '/health': 'health', '/signals': 'signals', '/series': 'series', '/alerts': 'alerts'
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/') or '/'
+        route, _, code = path.partition('/series/')
+        if code:
+            params['code'], route = code, '/series'
+        handler = self.routes.get(route)
+        if handler is None:
+            return self._send(404, {'error': f'未知路径：{url.path}', 'paths': sorted(self.routes)})
+        try:
+            status, payload = getattr(self, f'_{handler}')(self.server.cache, params)
+        except (KeyError, ValueError) as e:
+            status, payload = 400, {'error': f'参数错误：{e}'}
+        except Exception as e:
+            traceback.print_exc()
+            status, payload = 500, {'error': str(e)}
+        self._send(status, payload)
+
+    def _send(self, status: int, payload):
+        """发送JSON响应；内容未变化时按ETag返回304，轮询的客户端不必重复下载"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        etag = f'"{zlib.crc32(body):08x}"'
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不逐条打印请求日志
+
+    @staticmethod
+    def _selected(cache: QueryCache, params: dict) -> list:
+        """按symbols/rules查询参数筛选配置"""
+        symbols = parse_list(params['symbols']) if params.get('symbols') else None
+        rules = parse_list(params['rules']) if params.get('rules') else None
+        return filter_stock_configs(cache.stock_configs(), symbols, rules)
+
+    def _health(self, cache: QueryCache, params: dict) -> tuple:
+        return 200, {'status': 'ok', 'plan': cache.watcher.plan.summary(), 'cached_data': len(cache.data),
+                     'cached_results': len(cache.results), 'stats': dict(cache.stats), 'paths': sorted(self.routes)}
+
+    def _signals(self, cache: QueryCache, params: dict) -> tuple:
+        """/signals?symbols=&rules=&alert=1：最新信号，alert=1时只返回触发预警的配置"""
+        signals = [signal_payload(stock_config, result) for stock_config, result in cache.get_results(self._selected(cache, params))]
+        if params.get('alert') == '1':
+            signals = [signal for signal in signals if signal['has_alert']]
+        return 200, {'count': len(signals), 'signals': signals}
+
+    def _series(self, cache: QueryCache, params: dict) -> tuple:
+        """/series/<代码>?rules=&bars=250：该股票各条规则的K线和指标序列"""
+        stock_configs = filter_stock_configs(self._selected(cache, params), [params['code']])
+        if not stock_configs:
+            return 404, {'error': f"没有监控{params['code']}的配置"}
+        bars = int(params.get('bars', SERVE_SERIES_BARS))
+        series = [dict(signal_payload(stock_config, result), columns=list(result['df'].columns), rows=frame_records(result['df'].tail(bars)))
+                  for stock_config, result in cache.get_results(stock_configs)]
+        return 200, {'count': len(series), 'series': series}
+
+    def _alerts(self, cache: QueryCache, params: dict) -> tuple:
+        """/alerts?days=30&symbols=&rules=：最近若干天的预警历史"""
+        since = (datetime.now() - timedelta(days=int(params.get('days', SERVE_HISTORY_DAYS)))).strftime('%Y-%m-%d')
+        history = cache.alert_history(since, parse_list(params['symbols']) if params.get('symbols') else None,
+                                      parse_list(params['rules']) if params.get('rules') else None)
+        return 200, {'count': len(history), 'alerts': _json_safe(history)}
+
+def run_query_server(stock_configs: list, host: str = SERVE_HOST, port: int = SERVE_PORT, symbols: list = None, rules: list = None):
+    """serve：启动查询服务，直到Ctrl+C"""
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.cache = QueryCache(stock_configs, symbols, rules)
+    print(f"🌐 查询服务已启动：http://{host}:{port}/（{server.cache.watcher.plan.summary()}）")
+    print("   /signals  最新信号    /series/<代码>  指标序列    /alerts  预警历史    /health  状态")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️  查询服务已停止")
+    finally:
+        server.server_close()
 
 # ===================== 主函数 =====================
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="股票预警系统")
+    parser.add_argument('command', nargs='?', choices=STAGE_COMMANDS, default='run',
+                        help="run: 按--mode执行（默认）；fetch: 只下载数据到本地缓存；evaluate: 只判断，不绘图不发邮件；"
+                             "render: 判断并绘图；notify: 发送已判断结果的预警邮件；report: 用已判断结果生成HTML报告；"
+                             "serve: 启动本地HTTP查询服务（JSON）；history: 查询信号历史中的预警记录")
+    parser.add_argument('--mode', choices=['full', 'premarket', 'intraday', 'merge', 'backtest'], default='full',
+                        help="full: 完整检查（默认）；premarket: 盘前计算触发价；intraday: 盘中按触发价快速检查；"
+                             "merge: 合并当天各分片结果；backtest: 用缓存的历史数据回测预警规则")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='i/N',
+                        help="只执行第i个分片（共N个），结果写入分片文件，之后用 --mode merge 合并")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="忽略运行日志，从头执行（默认会跳过最近一次被中断运行中已完成的部分）")
+    parser.add_argument('--interval', type=int, default=INTRADAY_CHECK_INTERVAL,
+                        help="盘中检查间隔（秒）")
+    parser.add_argument('--config', default=None, metavar='PATH',
+                        help="监控清单文件（TOML/YAML/JSON），默认查找 config/watchlist.*，都没有时使用STOCK_CONFIGS")
+    parser.add_argument('--profile', action='store_true',
+                        help="性能剖析：按流水线阶段记录CPU热点和内存分配，结果保存到当天输出目录的profile文件夹")
+    parser.add_argument('--deadline', type=float, default=RUN_DEADLINE_MINUTES, metavar='MINUTES',
+                        help="完整检查/分片执行的总时长（分钟，0为不限时），临近截止时优先保证预警通知和报告")
+    parser.add_argument('--chart-profile', choices=list(CHART_PROFILES), default=None,
+                        help="图表输出配置：full 原样PNG；standard 压缩PNG+邮件小图+缩略图（默认）；compact WebP；vector SVG")
+    parser.add_argument('--universe', action='store_true',
+                        help="回测时把规则套用到本地K线存档中的全部股票（只读本地缓存，不访问网络）")
+    parser.add_argument('--sweep', choices=list(SWEEP_GRIDS), default=None,
+                        help="回测时对该规则做参数扫描")
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=START:STOP[:STEP]',
+                        help="参数扫描的网格（可多次指定），如 --grid ma_short=5:30 --grid ma_long=20,30,60")
+    parser.add_argument('--symbols', type=parse_list, action='extend', default=[], metavar='CODE[,CODE...]',
+                        help="只处理这些股票（代码或名称，逗号分隔，可多次指定）")
+    parser.add_argument('--rules', type=parse_list, action='extend', default=[], metavar='TYPE[,TYPE...]',
+                        help="只处理这些预警类型（逗号分隔，可多次指定），如 --rules golden_cross,macd_cross")
+    parser.add_argument('--no-charts', action='store_true',
+                        help="不绘制图表（等同CHART_MODE=none）")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="演练：照常检查和生成报告，但不发送邮件")
+    parser.add_argument('--as-of', type=parse_as_of, default=None, metavar='DATE',
+                        help="按历史日期判断（evaluate/render/notify/report）：只使用该日期及之前的K线，不检查交易日、不发送邮件，"
+                             "结果写入单独的阶段日志和 alert_output/as_of/<日期> 报告")
+    parser.add_argument('--host', default=SERVE_HOST, help="查询服务监听地址")
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help="查询服务端口")
+    args = parser.parse_args(argv)
+    unknown = [rule for rule in args.rules if rule not in RULE_SCHEMAS]
+    if unknown:
+        parser.error(f"未知的预警类型：{', '.join(unknown)}（可选：{', '.join(RULE_SCHEMAS)}）")
+    if args.command != 'run' and (args.mode != 'full' or args.shard):
+        parser.error(f"{args.command} 子命令不能与 --mode {args.mode} 或 --shard 同时使用")
+    if args.as_of is not None and args.command not in AS_OF_COMMANDS:
+        parser.error(f"--as-of 只能用于 {'/'.join(AS_OF_COMMANDS)} 子命令（结果记录在单独的阶段日志和报告目录中）")
+    if args.command == 'render' and args.no_charts:
+        parser.error("render 子命令不能与 --no-charts 同时使用")
+    return args
+
 if __name__ == "__main__":
+    args = parse_args()
+
     print("="*100)
     print(f"股票预警系统启动（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*100)
     
-    # 检查是否为交易日
-    if not is_trading_day():
+    # 性能剖析（默认关闭，关闭时没有任何开销）
+    if args.profile:
+        PROFILER = StageProfiler()
+
+    # 图表输出配置通过环境变量传给绘图子进程
+    if args.chart_profile:
+        CHART_PROFILE = os.environ['CHART_PROFILE'] = args.chart_profile
+
+    # 加载监控清单（配置校验失败时直接退出并列出全部问题）
+    if args.config:
+        WATCHLIST_FILE = args.config
+    try:
+        stock_configs = get_stock_configs()
+    except Exception as e:
+        print(f"❌ {e}")
+        exit(1)
+
+    # 信号历史随时可查询，包括已不在监控清单中的股票
+    if args.command == 'history':
+        show_signal_history(args.symbols, args.rules)
+        exit()
+
+    # 按股票和预警类型筛选，对所有子命令和模式都生效
+    if args.symbols or args.rules:
+        stock_configs = filter_stock_configs(stock_configs, args.symbols, args.rules)
+        print(f"🔎 筛选后剩余{len(stock_configs)}条配置")
+        if not stock_configs:
+            print("❌ 没有符合筛选条件的配置")
+            exit(1)
+
+    if args.no_charts or args.command == 'evaluate':
+        CHART_MODE = 'none'
+    if args.dry_run:
+        DRY_RUN = True
+        print("🧪 演练模式：不发送邮件")
+    if args.as_of is not None:
+        # 历史日期的信号只用于查看，不再发送邮件
+        AS_OF_DATE, DRY_RUN = args.as_of, True
+        print(f"🕰️  按{AS_OF_DATE.strftime('%Y-%m-%d')}的数据判断（不发送邮件）")
+
+    # 回测只使用历史数据，不受交易日限制
+    if args.mode == 'backtest':
+        if args.sweep:
+            run_parameter_sweep(args.sweep, stock_configs, parse_grid(args.grid), universe=args.universe)
+        else:
+            run_backtest(stock_configs, universe=args.universe)
+        exit()
+
+    # 查询服务随时可用，不受交易日限制
+    if args.command == 'serve':
+        run_query_server(stock_configs, args.host, args.port, args.symbols, args.rules)
+        exit()
+
+    # 检查是否为交易日（按历史日期判断和生成报告时不需要）
+    if args.as_of is None and args.command != 'report' and not is_trading_day():
         print("\n⏸️  非交易日，系统自动退出")
         exit()
+
+    # 分阶段子命令：只执行需要的阶段
+    if args.command != 'run':
+        RUN_DEADLINE.set_budget(args.deadline)
+        run_stage_command(args.command, stock_configs, resume=not args.no_resume)
+        if PROFILER is not None:
+            PROFILER.write()
+        exit()
+
+    if args.mode == 'premarket':
+        precompute_trigger_thresholds(stock_configs)
+        exit()
+
+    if args.mode == 'intraday':
+        run_intraday_monitor(interval=args.interval, stock_configs=stock_configs)
+        exit()
+
+    if args.mode == 'merge':
+        merge_shard_results(stock_configs=stock_configs)
+        exit()
+
+    # 完整检查和分片执行从启动时开始计算截止时间
+    RUN_DEADLINE.set_budget(args.deadline)
+
+    if args.shard:
+        run_shard(stock_configs, *args.shard, resume=not args.no_resume)
+        if PROFILER is not None:
+            PROFILER.write()
+        exit()
     
     # 输出预警配置
-    output_alert_configs()
-    
-    # 使用多线程检查股票预警
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(STOCK_CONFIGS)) as executor:
-        # 提交任务
-        future_to_stock = {executor.submit(check_stock_alert, stock_config): stock_config for stock_config in STOCK_CONFIGS}
-        
-        # 收集结果
-        for future in concurrent.futures.as_completed(future_to_stock):
-            stock_config = future_to_stock[future]
-            try:
-                result = future.result()
-                if result:
-                    results.append(result)
-            except Exception as e:
-                print(f"❌ 线程执行失败：{e}")
+    output_alert_configs(stock_configs)
     
-    # 在主线程中绘制图表并发送邮件
-    print("\n" + "="*80)
-    print("在主线程中绘制图表并发送邮件")
-    print("="*80)
-    
-    chart_paths = {}
-    for result in results:
-        stock_name = result['stock_name']
-        stock_config = result['stock_config']
-        has_alert = result['has_alert']
-        df = result['df']
-        
-        # 绘制图表
-        print(f"\n📊 正在绘制{stock_name}图表...")
-        chart_path = plot_alert_chart(df, stock_config, has_alert)
-        chart_paths[stock_name] = chart_path
-        
-        # 发送邮件
-        if has_alert:
-            print(f"\n📧 正在发送{stock_name}预警邮件...")
-            # 重新计算预警信息（确保数据完整）
-            alert_df = get_stock_data(stock_config['code'], stock_config['name'])
-            if not alert_df.empty:
-                alert_info = calculate_ma_and_check_alert(alert_df, stock_config)
-                send_alert_email(alert_info, chart_path, stock_config)
+    # 流水线执行：获取、判断、绘图、通知各阶段并行，完成情况写入运行日志以便超时后续跑
+    journal = RunJournal(resume_minutes=0 if args.no_resume else JOURNAL_RESUME_MINUTES)
+    try:
+        results = run_pipeline(stock_configs, journal=journal)
+    finally:
+        journal.close()
     
     # 生成HTML输出
     try:
-        html_file = generate_html_output(results)
+        if PROFILER is not None:
+            html_file = PROFILER.run('报告', 'html', generate_html_output, results, stock_configs)
+        else:
+            html_file = generate_html_output(results, stock_configs)
         print(f"\n✅ HTML预警结果已生成：{html_file}")
     except Exception as e:
         print(f"\n❌ 生成HTML输出失败：{e}")
-        import traceback
         traceback.print_exc()
     
+    if PROFILER is not None:
+        PROFILER.write()
+    
     print("\n" + "="*100)
     print(f"股票预警系统执行完成（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*100)
\ No newline at end of file
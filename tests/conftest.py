@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 输出和缓存目录指向临时目录，导入模块时不在仓库中创建文件
+_TMP = tempfile.mkdtemp(prefix='stock_alert_test_')
+os.environ.setdefault('ALERT_OUTPUT_DIR', os.path.join(_TMP, 'alert_output'))
+os.environ.setdefault('DATA_CACHE_DIR', os.path.join(_TMP, 'data_cache'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_bars(n: int = 300, seed: int = 0, start: str = '2024-01-01') -> pd.DataFrame:
+    """随机游走的工作日K线"""
+    rng = np.random.default_rng(seed)
+    close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+    return pd.DataFrame({
+        'date': pd.bdate_range(start, periods=n),
+        'open': close * (1 + rng.normal(0, 0.005, n)),
+        'high': close * 1.01,
+        'low': close * 0.99,
+        'close': close,
+        'volume': rng.integers(1_000_000, 5_000_000, n).astype(float),
+        'amount': close * 1e7,
+    })
+
+
+@pytest.fixture
+def bars():
+    return make_bars
+
+
+@pytest.fixture(scope='session')
+def sa():
+    import stock_alert
+    return stock_alert
@@ -0,0 +1,90 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import make_bars
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+
+
+def rounded_bars(n, seed=0):
+    """价格保留两位小数、成交量为整数的K线（与数据源一致）"""
+    df = make_bars(n, seed=seed)
+    df[PRICE_COLUMNS] = df[PRICE_COLUMNS].round(2)
+    df['volume'] = df['volume'].round()
+    return df
+
+
+def assert_same_bars(actual: pd.DataFrame, expected: pd.DataFrame):
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False,
+                                  check_index_type=False)
+
+
+def test_write_read_roundtrip(sa, tmp_path):
+    archive = sa.BarArchive(str(tmp_path))
+    frames = {code: rounded_bars(n, seed=i) for i, (code, n) in enumerate([('600000', 300), ('000001', 40)])}
+    for code, df in frames.items():
+        archive.write(code, df)
+    for code, df in frames.items():
+        assert_same_bars(archive.read_frame(code), df)
+    assert archive.read_frame('missing').empty
+
+
+def test_append_in_place_and_relocated(sa, tmp_path):
+    archive = sa.BarArchive(str(tmp_path))
+    full = rounded_bars(700, seed=1)
+    archive.write('600000', full.iloc[:100])
+    archive.write('600001', full.iloc[:10])
+    offset = archive.symbols['600000'][0]
+    archive.append('600000', full.iloc[100:200])     # 预留空间内原地追加
+    assert archive.symbols['600000'][0] == offset
+    archive.append('600000', full.iloc[200:700])     # 容量不足，搬到文件末尾
+    assert archive.symbols['600000'][0] != offset
+    assert_same_bars(archive.read_frame('600000'), full)
+    assert_same_bars(archive.read_frame('600001'), full.iloc[:10])
+
+
+def test_index_is_flushed_and_visible_to_new_readers(sa, tmp_path):
+    archive = sa.BarArchive(str(tmp_path))
+    df = rounded_bars(50, seed=2)
+    archive.write('600000', df, start_date='2020-01-01')
+    archive.flush()
+    reopened = sa.BarArchive(str(tmp_path))
+    assert_same_bars(reopened.read_frame('600000'), df)
+    assert reopened.covered_from('600000') == pd.Timestamp('2020-01-01')
+    np.testing.assert_array_equal(reopened.calendar, df['date'].to_numpy(dtype='datetime64[D]').astype(np.int64))
+
+
+def test_compact_keeps_data(sa, tmp_path):
+    archive = sa.BarArchive(str(tmp_path))
+    frames = {f'60000{i}': rounded_bars(30 + i, seed=i) for i in range(3)}
+    for code, df in frames.items():
+        archive.write(code, df.iloc[:10])
+        archive.append(code, df.iloc[10:])
+    archive.compact()
+    reopened = sa.BarArchive(str(tmp_path))
+    for code, df in frames.items():
+        assert_same_bars(reopened.read_frame(code), df)
+
+
+def test_legacy_float32_archive_is_migrated(sa, tmp_path):
+    archive = sa.BarArchive(str(tmp_path))
+    df = rounded_bars(60, seed=3)
+    df[PRICE_COLUMNS] += 1800  # 高价股的两位小数价格无法用float32精确表示
+    archive.write('600519', df)
+    archive.flush()
+    # 改写为旧版格式：价格列为float32，索引中没有dtypes
+    for field in PRICE_COLUMNS:
+        path = os.path.join(str(tmp_path), f'{field}.bin')
+        np.fromfile(path, dtype=np.float64).astype(np.float32).tofile(path)
+    index_file = os.path.join(str(tmp_path), 'index.json')
+    with open(index_file, encoding='utf-8') as f:
+        index = json.load(f)
+    del index['dtypes']
+    with open(index_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    migrated = sa.BarArchive(str(tmp_path))
+    assert migrated.column('600519', 'close').dtype == np.float64
+    assert_same_bars(migrated.read_frame('600519'), df)
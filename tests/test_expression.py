@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from conftest import make_bars
+
+# 覆盖表达式中可用的全部函数和运算
+EXPRESSIONS = [
+    'ma(close,5) > ema(close,10)',
+    'std(close,10) > 0 and highest(high,10) > lowest(low,10)',
+    'percentile(close,20) < 0.5 or drawdown(close,20) < -5%',
+    'rsi(close,14) > 50',
+    'ref(close,3) < close and roc(close,5) > 0',
+    'dif(close,12,26) > dea(close) and macd(close) > 0',
+    'abs(roc(close,1)) > 1%',
+    'close crosses_above ma(close,10) within 5 bars',
+    'close crosses_below ma(close,10) or not (close > open for 2 bars)',
+    'volume > ma(volume,5) * 1.2 and amount / volume > 0',
+]
+
+
+def test_expressions_cover_every_function(sa):
+    used = {node[1] for text in EXPRESSIONS for node in sa.expression_nodes(sa.parse_expression(text)) if node[0] == 'call'}
+    assert used == set(sa.EXPRESSION_FUNCTIONS)
+
+
+def test_panel_matches_per_symbol_evaluation(sa):
+    # 长度不同的股票在面板中前面补NaN，每个节点的结果都应与逐只计算完全一致
+    frames = {i: make_bars(n, seed=i) for i, n in enumerate([60, 30, 45, 15])}
+    configs = [{'name': 'x', 'code': 'x', 'alert_type': 'expression', 'expr': text} for text in EXPRESSIONS]
+    caches, _ = sa.evaluate_expression_panel(frames, configs)
+    for key, df in frames.items():
+        evaluator = sa.ExpressionEvaluator({field: df[field].to_numpy(dtype=float) for field in sa.EXPRESSION_FIELDS})
+        for text in EXPRESSIONS:
+            for node in sa.expression_nodes(sa.parse_expression(text)):
+                expected = np.broadcast_to(evaluator.evaluate(node), (len(df),)).astype(float)
+                actual = np.broadcast_to(caches[key][node], (len(df),)).astype(float)
+                np.testing.assert_array_equal(actual, expected, err_msg=f"{key}: {sa.expression_text(node)}")
+
+
+def test_prefilled_indicators_give_same_alerts(sa):
+    frames = [make_bars(n, seed=10 + n) for n in (80, 50, 120)]
+    batch = [([{'name': 'x', 'code': str(i), 'alert_type': 'expression', 'expr': text} for text in EXPRESSIONS], df, {})
+             for i, df in enumerate(frames)]
+    sa.prefill_expression_indicators(batch)
+    for configs, df, indicators in batch:
+        for config in configs:
+            panel = sa.calculate_ma_and_check_alert(df, config, indicators)['df']['expression_alert'].to_numpy()
+            single = sa.calculate_ma_and_check_alert(df, config, {})['df']['expression_alert'].to_numpy()
+            np.testing.assert_array_equal(panel, single)
+
+
+@pytest.mark.parametrize('left, right', [
+    ('ma(close,20) < close', 'close > ma(close,20)'),
+    ('sma(close, 20) >= 1', 'MA(close,20) >= 1'),
+    ('close > open and volume > 0', 'volume > 0 and close > open'),
+    ('close > 5%', 'close > 0.05'),
+])
+def test_parse_expression_canonicalizes_equivalent_text(sa, left, right):
+    assert sa.parse_expression(left) == sa.parse_expression(right)
+
+
+def test_shared_subexpressions_evaluate_once(sa):
+    df = make_bars(100)
+    evaluator = sa.ExpressionEvaluator({field: df[field].to_numpy(dtype=float) for field in sa.EXPRESSION_FIELDS})
+    evaluator.evaluate(sa.parse_expression('close > ma(close,20) and ma(close,20) > ma(close,60)'))
+    first = evaluator.evaluations
+    # 第二条规则与第一条共用 close、ma(close,20)、ma(close,60) 以及比较节点，只新增 and/for 两个节点
+    evaluator.evaluate(sa.parse_expression('ma(close,20) > ma(close,60) and close > ma(close,20) for 3 bars'))
+    assert evaluator.evaluations - first == 2
+
+
+@pytest.mark.parametrize('text', ['close +', 'ma(close)', 'foo(close,3) > 1', 'close + 1', 'close > 1 for 0 bars'])
+def test_parse_expression_rejects_invalid(sa, text):
+    with pytest.raises(ValueError):
+        sa.parse_expression(text)
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def pandas_rsi(close: pd.Series, period: int) -> pd.Series:
+    """Wilder RSI参考实现：前period个涨跌幅的均值作为初值，之后ewm(alpha=1/period, adjust=False)"""
+    change = close.diff()
+    result = pd.Series(np.nan, index=close.index)
+    averages = []
+    for values in (change.clip(lower=0), (-change).clip(lower=0)):
+        seeded = pd.concat([pd.Series([values.iloc[1:period + 1].mean()]), values.iloc[period + 1:]], ignore_index=True)
+        averages.append(seeded.ewm(alpha=1.0 / period, adjust=False).mean().to_numpy())
+    gain, loss = averages
+    result.iloc[period:] = 100.0 - 100.0 / (1.0 + gain / loss)
+    return result
+
+
+@pytest.mark.parametrize('period', [6, 14])
+def test_rsi_matches_wilder_reference(sa, bars, period):
+    close = bars(200, seed=period)['close']
+    expected = pandas_rsi(close, period)
+    actual = sa.rsi(close.to_numpy(), period)['rsi']
+    assert np.isnan(actual[:period]).all()
+    np.testing.assert_allclose(actual, expected.to_numpy(), rtol=1e-10, equal_nan=True)
+
+
+def test_rsi_incremental_state_matches_full_run(sa, bars):
+    close = bars(120, seed=3)['close'].to_numpy()
+    full = sa.rsi(close, 14)['rsi']
+    for split in (5, 14, 60):
+        head = sa.rsi(close[:split], 14)
+        tail = sa.rsi(close[split:], 14, head['state'])['rsi']
+        np.testing.assert_allclose(np.concatenate([head['rsi'], tail]), full, equal_nan=True)
+
+
+@pytest.mark.parametrize('window', [1, 5, 20])
+def test_sma_and_std_match_pandas_rolling(sa, bars, window):
+    close = bars(120, seed=window)['close']
+    np.testing.assert_allclose(sa.sma(close.to_numpy(), window), close.rolling(window).mean(), equal_nan=True)
+    # 累计平方和实现的舍入误差约为1e-6量级
+    np.testing.assert_allclose(sa.rolling_std(close.to_numpy(), window), close.rolling(window).std(ddof=0),
+                               atol=1e-5, equal_nan=True)
+
+
+def test_ema_and_macd_match_pandas_ewm(sa, bars):
+    close = bars(150, seed=1)['close']
+    np.testing.assert_allclose(sa.ema(close.to_numpy(), 12), close.ewm(span=12, adjust=False).mean())
+    dif = close.ewm(span=12, adjust=False).mean() - close.ewm(span=26, adjust=False).mean()
+    dea = dif.ewm(span=9, adjust=False).mean()
+    result = sa.macd(close.to_numpy())
+    np.testing.assert_allclose(result['dif'], dif)
+    np.testing.assert_allclose(result['dea'], dea)
+    np.testing.assert_allclose(result['macd'], 2 * (dif - dea))
+
+
+def test_bollinger_matches_pandas(sa, bars):
+    close = bars(80, seed=2)['close']
+    result = sa.bollinger(close.to_numpy(), 20, 2.0)
+    mid = close.rolling(20).mean()
+    std = close.rolling(20).std(ddof=0)
+    np.testing.assert_allclose(result['mid'], mid, equal_nan=True)
+    np.testing.assert_allclose(result['upper'], mid + 2 * std, atol=1e-5, equal_nan=True)
+    np.testing.assert_allclose(result['lower'], mid - 2 * std, atol=1e-5, equal_nan=True)
+
+
+def naive_streak(mask):
+    """逐根计数的连续成立根数"""
+    result, run = [], 0
+    for value in mask:
+        run = run + 1 if value else 0
+        result.append(run)
+    return np.array(result)
+
+
+def test_streak_kernels_match_naive_loops(sa):
+    rng = np.random.default_rng(7)
+    mask = rng.random((200, 3)) > 0.4
+    for j in range(mask.shape[1]):
+        column = mask[:, j]
+        expected = naive_streak(column)
+        np.testing.assert_array_equal(sa.streak_length(mask)[:, j], expected)
+        np.testing.assert_array_equal(sa.streak_length(column), expected)
+        np.testing.assert_array_equal(sa.streak_start(column, 3), expected == 3)
+        hits = np.flatnonzero(column)
+        since = [i - hits[hits <= i][-1] if (hits <= i).any() else -1 for i in range(len(column))]
+        np.testing.assert_array_equal(sa.bars_since(column), since)
+        within = [0 <= s < 4 for s in since]
+        np.testing.assert_array_equal(sa.within_bars(column, 4), within)
+
+
+def test_crosses_match_shifted_comparison(sa, bars):
+    df = bars(150, seed=4)
+    a = df['close']
+    b = a.rolling(10).mean()
+    diff = a - b
+    above = (diff.shift(1) <= 0) & (diff > 0)
+    below = (diff.shift(1) >= 0) & (diff < 0)
+    np.testing.assert_array_equal(sa.crosses_above(a.to_numpy(), b.to_numpy()), above.to_numpy())
+    np.testing.assert_array_equal(sa.crosses_below(a.to_numpy(), b.to_numpy()), below.to_numpy())
+    np.testing.assert_array_equal(sa.crosses_above(a.to_numpy(), 10.0), ((a.shift(1) <= 10) & (a > 10)).to_numpy())
+
+
+def test_evaluate_streak_rules_matches_per_rule(sa, bars):
+    close = np.column_stack([bars(120, seed=s)['close'] for s in range(3)])
+    variants = [(5, 2), (5, 3), (10, 3)]
+    signals = sa.evaluate_streak_rules(close, variants)
+    for ma_line, n in variants:
+        for j in range(close.shape[1]):
+            series = pd.Series(close[:, j])
+            expected = naive_streak((series > series.rolling(ma_line).mean()).to_numpy()) == n
+            np.testing.assert_array_equal(signals[(ma_line, n)][:, j], expected)
+
+
+@pytest.mark.parametrize('window', [1, 7, 30])
+def test_rolling_extremes_match_pandas(sa, bars, window):
+    close = bars(100, seed=window)['close']
+    np.testing.assert_array_equal(sa.rolling_max(close.to_numpy(), window), close.rolling(window).max())
+    np.testing.assert_array_equal(sa.rolling_min(close.to_numpy(), window), close.rolling(window).min())
+    high, low = sa.RollingExtreme(window, 'max'), sa.RollingExtreme(window, 'min')
+    np.testing.assert_array_equal([high.update(v) for v in close], close.rolling(window).max())
+    np.testing.assert_array_equal([low.update(v) for v in close], close.rolling(window).min())
+
+
+def test_percentile_kernels_match_pandas_rank(sa, bars):
+    # 价格取整制造并列值，检验平均名次
+    close = bars(150, seed=5)['close'].round(1)
+    expected = close.rolling(30).rank(pct=True)
+    np.testing.assert_allclose(sa.rolling_percentile(close.to_numpy(), 30), expected, equal_nan=True)
+    np.testing.assert_allclose(sa.latest_percentile(close.to_numpy(), 30, lookback=5), expected.iloc[-5:])
+
+
+def test_drawdown_and_range_position_match_pandas(sa, bars):
+    close = bars(120, seed=6)['close']
+    high, low = close.rolling(20).max(), close.rolling(20).min()
+    np.testing.assert_allclose(sa.drawdown(close.to_numpy(), 20), close / high - 1, equal_nan=True)
+    np.testing.assert_allclose(sa.range_position(close.to_numpy(), 20), (close - low) / (high - low), equal_nan=True)
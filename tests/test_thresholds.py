@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_bars
+
+CONFIGS = [
+    {'name': 't', 'code': '600000', 'alert_type': 'golden_cross', 'ma_short': 5, 'ma_long': 20},
+    {'name': 't', 'code': '600000', 'alert_type': 'golden_cross', 'ma_short': 20, 'ma_long': 5},
+    {'name': 't', 'code': '600000', 'alert_type': 'three_above_ma', 'ma_line': 10, 'consecutive_bars': 3},
+    {'name': 't', 'code': '600000', 'alert_type': 'three_above_ma', 'ma_line': 20, 'consecutive_bars': 1},
+    {'name': 't', 'code': '600000', 'alert_type': 'macd_cross'},
+    {'name': 't', 'code': '600000', 'alert_type': 'drawdown', 'window': 60, 'threshold': 0.10},
+    {'name': 't', 'code': '600000', 'alert_type': 'percentile_low', 'window': 60, 'threshold': 0.10},
+    {'name': 't', 'code': '600000', 'alert_type': 'percentile_low', 'window': 60, 'threshold': 0.10, 'method': 'range'},
+]
+
+
+def with_today(df: pd.DataFrame, price: float) -> pd.DataFrame:
+    """在K线末尾追加收盘价为price的下一根K线"""
+    row = {**df.iloc[-1].to_dict(), 'date': df['date'].iloc[-1] + pd.offsets.BDay(1), 'close': price}
+    return pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+
+
+def solvable_cases(sa, config, wanted=3):
+    """在随机K线的不同截止位置中找出今天可能触发（触发价有限）的历史"""
+    cases = []
+    for seed in range(40):
+        bars = make_bars(160, seed=seed)
+        for end in range(90, 160, 7):
+            history = bars.iloc[:end].reset_index(drop=True)
+            result = sa.compute_trigger_threshold(history, config)
+            if np.isfinite(result['threshold']) and result['threshold'] > 0:
+                cases.append((history, result))
+                if len(cases) >= wanted:
+                    return cases
+    return cases
+
+
+@pytest.mark.parametrize('config', CONFIGS, ids=lambda c: f"{c['alert_type']}-{c.get('ma_short', c.get('ma_line', c.get('method', '')))}")
+def test_solved_price_reproduces_the_alert(sa, config):
+    cases = solvable_cases(sa, config)
+    assert cases, '没有找到可以求出触发价的历史'
+    for history, result in cases:
+        threshold, direction = result['threshold'], result['direction']
+        # 越过触发价一点点会触发，差一点点不会触发
+        hit = with_today(history, threshold * (1 + direction * 1e-6))
+        miss = with_today(history, threshold * (1 - direction * 1e-6))
+        assert sa.calculate_ma_and_check_alert(hit, config)['has_alert']
+        assert not sa.calculate_ma_and_check_alert(miss, config)['has_alert']
+
+
+def test_check_trigger_thresholds_compares_by_direction(sa):
+    thresholds = pd.DataFrame({'key': ['a', 'b', 'c'], 'code': ['1', '2', '3'], 'threshold': [10.0, 10.0, np.nan],
+                               'direction': [1, -1, 1]})
+    hits = sa.check_trigger_thresholds(thresholds, pd.Series({'1': 10.5, '2': 10.5, '3': 99.0}))
+    assert hits['key'].tolist() == ['a']
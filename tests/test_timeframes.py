@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_bars
+
+AGGREGATES = {'date': 'last', 'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum', 'amount': 'sum'}
+RULES = {'weekly': 'W-SUN', 'monthly': 'ME'}
+
+
+def holiday_bars():
+    """跨年、跨月且含长假（整周停市）的日线"""
+    df = make_bars(260, seed=11, start='2024-09-02')
+    holidays = pd.to_datetime(['2024-10-01', '2024-10-02', '2024-10-03', '2024-10-04', '2024-10-07',
+                               '2025-01-01', '2025-01-28', '2025-01-29', '2025-01-30', '2025-01-31'])
+    return df[~df['date'].isin(holidays)].reset_index(drop=True)
+
+
+def pandas_resample(df: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+    grouped = df.groupby(pd.Grouper(key='date', freq=RULES[timeframe]))
+    result = grouped.agg({field: AGGREGATES[field] for field in AGGREGATES if field != 'date'})
+    result.insert(0, 'date', grouped['date'].max())
+    return result.dropna(subset=['close']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('timeframe', ['weekly', 'monthly'])
+def test_resample_matches_pandas_calendar_periods(sa, timeframe):
+    df = holiday_bars()
+    actual = sa.resample_bars(df, timeframe).drop(columns='period')
+    pd.testing.assert_frame_equal(actual, pandas_resample(df, timeframe), check_dtype=False)
+
+
+def test_week_boundaries(sa):
+    dates = pd.to_datetime(['2024-12-27', '2024-12-30', '2024-12-31', '2025-01-02', '2025-01-03', '2025-01-06'])
+    keys = sa.period_keys(dates.to_numpy(), 'weekly')
+    # 周五 | 跨年的同一周（周一至周五） | 下周一
+    assert len(set(keys[1:5])) == 1
+    assert keys[0] != keys[1] and keys[4] != keys[5]
+    months = sa.period_keys(dates.to_numpy(), 'monthly')
+    assert months[2] != months[3] and months[3] == months[5]
+
+
+@pytest.mark.parametrize('timeframe', ['weekly', 'monthly'])
+def test_incremental_resampling_matches_full(sa, timeframe):
+    df = holiday_bars()
+    state = sa.ResampledBars(timeframe)
+    for end in range(20, len(df) + 1, 3):
+        pd.testing.assert_frame_equal(state.update(df.iloc[:end]), sa.resample_bars(df.iloc[:end], timeframe))
+
+
+def test_panel_resampling_handles_suspended_stock(sa):
+    df = holiday_bars()
+    suspended = df['close'].to_numpy(copy=True)
+    suspended[(df['date'] >= '2024-11-04') & (df['date'] <= '2024-11-15')] = np.nan  # 停牌两周
+    fields = {'close': np.column_stack([df['close'], suspended])}
+    dates, _, resampled = sa.resample_panel(df['date'].to_numpy(), fields, 'weekly')
+    weekly = resampled['close']
+    np.testing.assert_array_equal(weekly[:, 0], sa.resample_bars(df, 'weekly')['close'])
+    stopped = (dates >= np.datetime64('2024-11-04')) & (dates <= np.datetime64('2024-11-16'))
+    assert np.isnan(weekly[stopped, 1]).all() and stopped.sum() == 2
+    np.testing.assert_array_equal(weekly[~stopped, 1], weekly[~stopped, 0])